@@ -0,0 +1,624 @@
+"""Sinh file export KiotViet giả lập và đo hiệu năng các hàm xử lý trong main1.py.
+
+Cách dùng:
+    python benchmark.py generate --rows 1000 100000
+    python benchmark.py run --rows 1000 5000 10000 --output baseline.json
+    python benchmark.py run --rows 5000 --cases process_multiple_invoice_files
+    python benchmark.py run --engines openpyxl fast --cases read_sheet process_excel_file_updated
+    python benchmark.py compare baseline_cu.json baseline_moi.json
+    python benchmark.py verify --rows 1000 10000 --files export_that.xlsx
+
+Mỗi case chạy trong một process riêng (spawn) để peak RSS không bị lẫn giữa các case.
+Thời gian là giá trị nhỏ nhất qua --repeat lần chạy; tracemalloc đo trong một lần chạy
+riêng (chậm hơn nhiều) và có thể tắt bằng --no-tracemalloc.
+
+verify đọc cùng một file bằng cả hai engine (openpyxl và FastSheetReader) rồi so từng
+dòng, từng giá trị (kể cả kiểu), và so kết quả của các hàm xử lý với từng engine.
+"""
+import os
+import sys
+import json
+import time
+import random
+import re
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import warnings
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import zip_longest
+from typing import Callable, NamedTuple, Tuple
+
+from openpyxl import Workbook
+import openpyxl
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASELINE_VERSION = 1
+# Tăng khi đổi cách sinh dữ liệu để không dùng lại file cũ trong data_dir
+GENERATOR_VERSION = 2
+ENGINES = ["openpyxl", "fast"]
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "excel_bot_bench")
+
+# ============================================================================
+# SINH DỮ LIỆU GIẢ LẬP
+# ============================================================================
+
+HO = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Phan", "Vũ", "Võ", "Đặng",
+      "Bùi", "Đỗ", "Hồ", "Ngô", "Dương", "Lý"]
+TEN_DEM = ["Văn", "Thị", "Hữu", "Minh", "Ngọc", "Thanh", "Đức", "Quốc", "Thu", "Xuân"]
+TEN = ["An", "Anh", "Bảo", "Bình", "Chi", "Cường", "Dũng", "Duyên", "Đạt", "Giang", "Hà",
+       "Hải", "Hằng", "Hiếu", "Hoa", "Hùng", "Hương", "Khánh", "Lan", "Linh", "Long", "Mai",
+       "Nam", "Nga", "Nhung", "Phúc", "Quân", "Sơn", "Thảo", "Thủy", "Trang", "Tuấn", "Uyên",
+       "Việt", "Yến", "Ánh", "Ân", "Ơn", "Ưng"]
+MAT_HANG = ["Bánh quy", "Kẹo dừa", "Nước ngọt", "Sữa tươi", "Mì gói", "Dầu ăn", "Nước mắm",
+            "Đường cát", "Bột giặt", "Nước rửa chén", "Cà phê", "Trà xanh", "Bia lon",
+            "Gạo thơm", "Xúc xích", "Ớt tương", "Ăn vặt"]
+THUONG_HIEU = ["Vinamilk", "Hảo Hảo", "Ômachi", "Tường An", "Nam Ngư", "Biên Hòa", "Ô Long",
+               "Trung Nguyên", "Sài Gòn", "Ánh Dương", "Đại Việt", "Kinh Đô"]
+QUY_CACH = ["100g", "250g", "500g", "1kg", "chai 1L", "lốc 6", "thùng 24", "gói 5 cái"]
+NHOM_HANG = ["Thực phẩm>>Bánh kẹo>>Bánh quy", "Thực phẩm>>Bánh kẹo>>Kẹo", "Đồ uống>>Nước ngọt",
+             "Đồ uống>>Bia", "Đồ uống>>Cà phê - Trà", "Gia vị>>Nước mắm", "Gia vị>>Dầu ăn",
+             "Hóa phẩm>>Bột giặt", "Nước rửa chén", "Lương thực>>Gạo", "Ăn liền>>Mì - Phở"]
+LOAI_THU_CHI = ["Thu tiền khách trả", "Chi tiền ship", "Chi phí khác", "Chi trả nhà cung cấp",
+                "Thu khác", "Chi lương nhân viên"]
+
+# Cột của từng loại file (giống file export thật, có cả cột mà bot không dùng)
+COLUMNS = {
+    "danhsachhoadon": ["Mã hóa đơn", "Thời gian", "Khách hàng", "Điện thoại", "Tổng tiền hàng",
+                       "Giảm giá", "Khách cần trả", "Khách đã trả", "Ghi chú"],
+    "soquy": ["Mã phiếu", "Thời gian", "Loại thu chi", "Người nộp/nhận", "Giá trị", "Ghi chú"],
+    "danhsachsanpham": ["Mã hàng", "Nhóm hàng(3 Cấp)", "Tên hàng", "Giá bán", "Giá vốn",
+                        "Tồn kho", "Đơn vị tính"],
+    "danhsachchitietdathang": ["Mã đặt hàng", "Thời gian", "Tên nhà cung cấp", "Mã hàng",
+                               "Tên hàng", "Số lượng", "Giá nhập", "Thành tiền"],
+}
+
+def _person_name(rng):
+    return f"{rng.choice(HO)} {rng.choice(TEN_DEM)} {rng.choice(TEN)}"
+
+def _product_name(rng, index):
+    return f"{rng.choice(MAT_HANG)} {rng.choice(THUONG_HIEU)} {rng.choice(QUY_CACH)} #{index % 5000}"
+
+def _timestamp(rng):
+    return datetime(2025, 10, rng.randint(1, 28), rng.randint(7, 21), rng.randint(0, 59))
+
+def _maybe(rng, value, ratio):
+    """Trả về None với xác suất ratio (ô trống)."""
+    return None if rng.random() < ratio else value
+
+def _malformed_number(rng, value):
+    """Số bị nhập sai định dạng như trong file thật: có dấu chấm, đơn vị, hoặc chữ."""
+    return rng.choice([f"{value:,}".replace(",", "."), f"{value}đ", "N/A", f" {value} ", "-"])
+
+def _invoice_rows(rng, rows, dirty):
+    # process_excel_file từ chối cả file nếu tiền không phải số: chỉ để trống tên khách/ghi chú
+    for i in range(rows):
+        subtotal = rng.randint(1, 500) * 1000
+        discount = rng.choice([0, 0, 0, 5000, 10000])
+        total = max(subtotal - discount, 0)
+        paid = rng.choice([total, total, 0, total // 2])
+        yield [f"HD{i:07d}", _timestamp(rng), _maybe(rng, _person_name(rng), dirty),
+               _maybe(rng, f"09{rng.randint(10000000, 99999999)}", 0.3), subtotal, discount,
+               total, paid, _maybe(rng, "Giao tận nơi", 0.9)]
+
+def _soquy_rows(rng, rows, dirty):
+    for i in range(rows):
+        kind = rng.choice(LOAI_THU_CHI)
+        amount = rng.randint(1, 300) * 1000 * (1 if kind.startswith("Thu") else -1)
+        if rng.random() < dirty:
+            amount = str(amount)  # số lưu dạng text
+        yield [_maybe(rng, f"PC{i:07d}", dirty), _timestamp(rng), kind, _person_name(rng),
+               _maybe(rng, amount, dirty), _maybe(rng, f"Ghi chú {i}", 0.5)]
+
+def _product_rows(rng, rows, dirty):
+    # Tồn kho luôn là số (process_excel_file_updated gọi float(stock) cho mọi dòng có tồn)
+    for i in range(rows):
+        unit_cost = rng.randint(1, 400) * 500
+        cost_value = _malformed_number(rng, unit_cost) if rng.random() < dirty else _maybe(rng, unit_cost, dirty)
+        yield [f"SP{i:07d}", _maybe(rng, rng.choice(NHOM_HANG), dirty), _product_name(rng, i),
+               unit_cost + rng.randint(1, 50) * 500, cost_value,
+               rng.choice([0, 0, 1, 2, 5, 10, 24, -1, -3]), rng.choice(["Cái", "Gói", "Chai", "Thùng"])]
+
+def _purchase_order_rows(rng, rows, dirty):
+    suppliers = [f"Công ty {brand}" for brand in THUONG_HIEU] + [f"Đại lý {name}" for name in TEN[:20]]
+    for i in range(rows):
+        quantity = rng.randint(1, 48)
+        price = rng.randint(1, 400) * 500
+        quantity_value = _malformed_number(rng, quantity) if rng.random() < dirty else _maybe(rng, quantity, dirty)
+        price_value = _malformed_number(rng, price) if rng.random() < dirty else _maybe(rng, price, dirty)
+        yield [f"DH{i // 20:06d}", _timestamp(rng), _maybe(rng, rng.choice(suppliers), dirty),
+               f"SP{i % 5000:07d}", _product_name(rng, i), quantity_value, price_value, quantity * price]
+
+ROW_GENERATORS = {
+    "danhsachhoadon": _invoice_rows,
+    "soquy": _soquy_rows,
+    "danhsachsanpham": _product_rows,
+    "danhsachchitietdathang": _purchase_order_rows,
+}
+
+def generate_workbook(kind, rows, path, seed=0, dirty=0.02):
+    """Ghi một file export giả lập (kind: tiền tố tên file KiotViet) gồm rows dòng dữ liệu.
+
+    dirty là tỷ lệ ô trống/sai định dạng, chỉ đặt ở những cột mà hàm xử lý tương ứng
+    chấp nhận được (file thật cũng vậy, file hỏng hoàn toàn không có ý nghĩa để đo).
+    """
+    rng = random.Random(f"{kind}:{rows}:{seed}")
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(COLUMNS[kind])
+    for row in ROW_GENERATORS[kind](rng, rows, dirty):
+        sheet.append(row)
+    workbook.save(path)
+    _use_shared_strings(path)
+    return path
+
+_INLINE_STRING_CELL = re.compile(r'<c ([^>]*)t="inlineStr"><is><t((?: [^>]*)?)>(.*?)</t></is></c>', re.S)
+
+def _use_shared_strings(path):
+    """Chuyển chuỗi inline (openpyxl luôn ghi kiểu này) sang bảng sharedStrings như file export thật."""
+    with zipfile.ZipFile(path) as archive:
+        parts = {name: archive.read(name) for name in archive.namelist()}
+
+    strings = {}
+
+    def to_shared(match):
+        key = (match.group(2), match.group(3))
+        index = strings.setdefault(key, len(strings))
+        return f'<c {match.group(1)}t="s"><v>{index}</v></c>'
+
+    sheet_name = "xl/worksheets/sheet1.xml"
+    parts[sheet_name] = _INLINE_STRING_CELL.sub(to_shared, parts[sheet_name].decode("utf-8")).encode("utf-8")
+    items = "".join(f"<si><t{attrs}>{text}</t></si>" for attrs, text in strings)
+    parts["xl/sharedStrings.xml"] = (
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        f'count="{len(strings)}" uniqueCount="{len(strings)}">{items}</sst>'
+    ).encode("utf-8")
+    parts["xl/_rels/workbook.xml.rels"] = parts["xl/_rels/workbook.xml.rels"].replace(
+        b"</Relationships>",
+        b'<Relationship Id="rIdSharedStrings" Target="sharedStrings.xml" Type="http://schemas.'
+        b'openxmlformats.org/officeDocument/2006/relationships/sharedStrings" /></Relationships>')
+    parts["[Content_Types].xml"] = parts["[Content_Types].xml"].replace(
+        b"</Types>",
+        b'<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-'
+        b'officedocument.spreadsheetml.sharedStrings+xml" /></Types>')
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in parts.items():
+            archive.writestr(name, data)
+
+def ensure_workbook(kind, rows, data_dir, seed=0):
+    """Trả về đường dẫn file giả lập, chỉ sinh mới nếu chưa có trong data_dir."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"{kind}_{rows}_{seed}_v{GENERATOR_VERSION}.xlsx")
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        generate_workbook(kind, rows, path, seed)
+        print(f"Đã sinh {os.path.basename(path)} ({time.perf_counter() - started:.1f}s)")
+    return path
+
+# ============================================================================
+# CÁC CASE ĐO
+# ============================================================================
+
+class BenchmarkCase(NamedTuple):
+    """setup(main1, files, engine) chạy một lần, trả về prepare(); prepare() chạy trước mỗi lần đo
+    (không tính giờ) và trả về hàm được đo. engine là engine đọc Excel (main1.SHEET_READER_ENGINES)."""
+    kinds: Tuple[str, ...]
+    needs_template: bool
+    setup: Callable
+    returns_result: bool = True     # None/chuỗi lỗi nghĩa là hàm xử lý thất bại
+
+def _prepare_soquy_sheet(main1, soquy_path, engine):
+    """Clone template và ghi các dòng sổ quỹ xen kẽ dòng trống (như trước bước xóa dòng trống)."""
+    part = main1.process_single_file(soquy_path, os.path.basename(soquy_path), engine)
+    template = main1.get_report_template()
+
+    def prepare():
+        sheet = template.clone().active
+        total_chi_row = template.total_chi_row
+        extra_rows = 2 * len(part['rows']) - (total_chi_row - main1.TEMPLATE_DATA_START_ROW)
+        if extra_rows > 0:
+            main1._insert_row_block(sheet, total_chi_row, extra_rows, style_row=total_chi_row - 1)
+            total_chi_row += extra_rows
+        for index, row in enumerate(part['rows']):
+            main1.write_soquy_rows(sheet, [row], main1.TEMPLATE_DATA_START_ROW + 2 * index)
+        return sheet, total_chi_row
+
+    return part, template, prepare
+
+def _setup_remove_empty_rows(main1, files, engine):
+    _, _, prepare_sheet = _prepare_soquy_sheet(main1, files["soquy"], engine)
+
+    def prepare():
+        sheet, total_chi_row = prepare_sheet()
+        return lambda: main1.remove_empty_rows(sheet, main1.TEMPLATE_DATA_START_ROW, total_chi_row - 1,
+                                               total_chi_row=total_chi_row)
+    return prepare
+
+def _setup_update_summary_values(main1, files, engine):
+    part, template, prepare_sheet = _prepare_soquy_sheet(main1, files["soquy"], engine)
+    totals = dict(part['totals'], khach_can_tra=12_500_000, khach_da_tra=7_300_000)
+
+    def prepare():
+        sheet, total_chi_row = prepare_sheet()
+        _, total_chi_row = main1.remove_empty_rows(sheet, main1.TEMPLATE_DATA_START_ROW, total_chi_row - 1,
+                                                   total_chi_row=total_chi_row)
+        return lambda: main1.update_summary_values(sheet, totals, total_chi_row,
+                                                   summary_cells=dict(template.summary_cells))
+    return prepare
+
+def _setup_read_sheet(main1, files, engine):
+    def run():
+        # Chỉ đo phần đọc/parse: duyệt mọi dòng, lấy mọi cột
+        with main1.open_sheet_reader(files["danhsachchitietdathang"], engine) as reader:
+            count = sum(1 for _ in reader.rows(range(len(reader.header))))
+        return count
+    return lambda: run
+
+def _setup_process_excel_file(main1, files, engine):
+    run = lambda: main1.process_excel_file(files["danhsachhoadon"], None, engine)
+    return lambda: run
+
+def _setup_process_multiple_invoice_files(main1, files, engine):
+    run = lambda: main1.process_multiple_invoice_files([files["danhsachhoadon"], files["soquy"]], None,
+                                                       engine=engine)
+    return lambda: run
+
+def _setup_process_excel_file_updated(main1, files, engine):
+    run = lambda: main1.process_excel_file_updated(files["danhsachsanpham"], engine)
+    return lambda: run
+
+def _setup_process_purchase_order_detail_file(main1, files, engine):
+    run = lambda: main1.process_purchase_order_detail_file(files["danhsachchitietdathang"], engine)
+    return lambda: run
+
+CASES = {
+    "read_sheet": BenchmarkCase(("danhsachchitietdathang",), False, _setup_read_sheet),
+    "process_excel_file": BenchmarkCase(("danhsachhoadon",), False, _setup_process_excel_file),
+    "process_multiple_invoice_files": BenchmarkCase(
+        ("danhsachhoadon", "soquy"), True, _setup_process_multiple_invoice_files),
+    "process_excel_file_updated": BenchmarkCase(("danhsachsanpham",), False, _setup_process_excel_file_updated),
+    "process_purchase_order_detail_file": BenchmarkCase(
+        ("danhsachchitietdathang",), False, _setup_process_purchase_order_detail_file),
+    "remove_empty_rows": BenchmarkCase(("soquy",), True, _setup_remove_empty_rows, returns_result=False),
+    "update_summary_values": BenchmarkCase(("soquy",), True, _setup_update_summary_values, returns_result=False),
+}
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _run_case(case_name, rows, files, repeat, trace, engine="openpyxl"):
+    """Chạy một case trong process con; trả về dict kết quả cho baseline."""
+    # Log từng dòng (cảnh báo dữ liệu lỗi) không phải thứ cần đo
+    logging.disable(logging.WARNING)
+    import main1
+
+    case = CASES[case_name]
+    result = {"case": case_name, "rows": rows, "engine": engine}
+    if case.needs_template and not (os.getenv("EXCEL_TEMPLATE_BASE64") or main1.EXCEL_TEMPLATE_BASE64):
+        result["skipped"] = "EXCEL_TEMPLATE_BASE64 chưa được cấu hình"
+        return result
+
+    prepare = case.setup(main1, files, engine)
+    baseline_rss = _peak_rss_mb()
+    timings = []
+    for _ in range(repeat):
+        func = prepare()
+        started = time.perf_counter()
+        output = func()
+        timings.append(time.perf_counter() - started)
+    if case.returns_result and (output is None or isinstance(output, str)):
+        result["error"] = output or "hàm trả về None"
+
+    wall = min(timings)
+    result.update({
+        "wall_s": round(wall, 4),
+        "wall_all_s": [round(t, 4) for t in timings],
+        "rows_per_s": round(rows / wall) if wall > 0 else None,
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+
+    if trace:
+        func = prepare()
+        tracemalloc.start()
+        func()
+        result["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+    return result
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(case_names, row_counts, data_dir, repeat=3, trace=True, seed=0, engines=("openpyxl",)):
+    """Chạy các case với từng kích thước và engine, mỗi lần chạy một process con mới."""
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for rows in row_counts:
+        for case_name in case_names:
+            files = {kind: ensure_workbook(kind, rows, data_dir, seed) for kind in CASES[case_name].kinds}
+            for engine in engines:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(_run_case, case_name, rows, files, repeat, trace, engine).result()
+                results.append(result)
+                if "wall_s" in result:
+                    print(f"{case_name:<36} {engine:<8} {rows:>8} dòng  {result['wall_s']:>9.3f}s  "
+                          f"{result['rows_per_s'] or 0:>10} dòng/s  RSS {result['peak_rss_mb']} MB"
+                          + (f"  tracemalloc {result['tracemalloc_peak_mb']} MB" if trace else "")
+                          + (f"  LỖI: {result['error']}" if "error" in result else ""))
+                else:
+                    print(f"{case_name:<36} {engine:<8} {rows:>8} dòng  bỏ qua: {result['skipped']}")
+    return {
+        "version": BASELINE_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "openpyxl": openpyxl.__version__,
+        "repeat": repeat,
+        "seed": seed,
+        "results": results,
+    }
+
+def compare_baselines(old, new, threshold=0.10):
+    """In so sánh thời gian giữa hai baseline; trả về số case chậm đi quá threshold."""
+    # Baseline cũ chưa có trường engine: khi đó là openpyxl
+    result_key = lambda r: (r["case"], r["rows"], r.get("engine", "openpyxl"))
+    old_results = {result_key(r): r for r in old["results"] if "wall_s" in r}
+    regressions = 0
+    print(f"So sánh {old.get('git_commit')} -> {new.get('git_commit')}")
+    for result in new["results"]:
+        previous = old_results.get(result_key(result))
+        if previous is None or "wall_s" not in result:
+            continue
+        ratio = result["wall_s"] / previous["wall_s"] if previous["wall_s"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  ⚠️ chậm hơn"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "  ✅ nhanh hơn"
+        print(f"{result['case']:<36} {result_key(result)[2]:<8} {result['rows']:>8} dòng  {previous['wall_s']:>9.3f}s -> "
+              f"{result['wall_s']:>9.3f}s  (x{ratio:.2f}){flag}")
+    return regressions
+
+# ============================================================================
+# ĐỐI CHIẾU HAI ENGINE ĐỌC EXCEL
+# ============================================================================
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+# Các trường hợp khó mà file sinh bằng openpyxl không có: rich text, phiên âm, ô không có
+# tọa độ, dòng bị bỏ qua/trùng, lỗi công thức, hệ ngày 1904, định dạng thời lượng,
+# sheet active không phải sheet đầu tiên
+_EDGE_CASE_PARTS = {
+    "[Content_Types].xml": (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.'
+        'spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-'
+        'officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/worksheets/data.xml" ContentType="application/vnd.openxmlformats-'
+        'officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.'
+        'spreadsheetml.styles+xml"/>'
+        '<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-'
+        'officedocument.spreadsheetml.sharedStrings+xml"/>'
+        '</Types>'),
+    "_rels/.rels": (
+        f'<Relationships xmlns="{_PKG_REL_NS}"><Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'),
+    "xl/workbook.xml": (
+        f'<workbook xmlns="{_MAIN_NS}" xmlns:r="{_REL_NS}"><workbookPr date1904="1"/>'
+        '<bookViews><workbookView activeTab="1"/></bookViews><sheets>'
+        '<sheet name="Trống" sheetId="1" r:id="rId1"/><sheet name="Dữ liệu" sheetId="2" r:id="rId2"/>'
+        '</sheets></workbook>'),
+    "xl/_rels/workbook.xml.rels": (
+        f'<Relationships xmlns="{_PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Target="worksheets/sheet1.xml" Type="{_REL_NS}/worksheet"/>'
+        f'<Relationship Id="rId2" Target="/xl/worksheets/data.xml" Type="{_REL_NS}/worksheet"/>'
+        f'<Relationship Id="rId3" Target="styles.xml" Type="{_REL_NS}/styles"/>'
+        f'<Relationship Id="rId4" Target="sharedStrings.xml" Type="{_REL_NS}/sharedStrings"/>'
+        '</Relationships>'),
+    "xl/styles.xml": (
+        f'<styleSheet xmlns="{_MAIN_NS}"><numFmts count="2">'
+        '<numFmt numFmtId="164" formatCode="dd/mm/yyyy hh:mm"/><numFmt numFmtId="165" formatCode="[h]:mm:ss"/>'
+        '</numFmts><cellXfs count="5"><xf numFmtId="0"/><xf numFmtId="14"/><xf numFmtId="164"/>'
+        '<xf numFmtId="165"/><xf numFmtId="10"/></cellXfs></styleSheet>'),
+    "xl/sharedStrings.xml": (
+        f'<sst xmlns="{_MAIN_NS}"><si><t>Tên hàng</t></si><si><t>Số lượng</t></si>'
+        '<si><r><t>Bánh </t></r><r><rPr><b/></rPr><t xml:space="preserve">quy  </t></r></si>'
+        '<si><t>Kẹo</t><rPh sb="0" eb="1"><t>phiên âm</t></rPh></si><si><t/></si>'
+        '<si><t>a_x005F_x000D_b</t></si><si><t>Ghi chú</t></si></sst>'),
+    "xl/worksheets/sheet1.xml": f'<worksheet xmlns="{_MAIN_NS}"><sheetData/></worksheet>',
+    "xl/worksheets/data.xml": (
+        f'<worksheet xmlns="{_MAIN_NS}"><dimension ref="A1:B2"/><sheetData>'
+        '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c><c r="D1" t="s"><v>6</v></c></row>'
+        '<row r="2"><c r="A2" t="s"><v>2</v></c><c r="B2"><v>12</v></c><c r="C2" s="1"><v>45000</v></c>'
+        '<c r="D2" s="2"><v>45000.5</v></c><c r="E2" s="3"><v>1.25</v></c><c r="F2" s="4"><v>0.5</v></c></row>'
+        '<row r="3"><c t="s"><v>3</v></c><c><v>1E3</v></c><c t="b"><v>0</v></c><c t="e"><v>#DIV/0!</v></c>'
+        '<c t="str"><f>A1&amp;B1</f><v>Tên hàngSố lượng</v></c></row>'
+        '<row r="5"><c r="A5" t="s"><v>4</v></c><c r="C5" t="inlineStr"><is><r><t>in</t></r><r><t>line</t></r></is></c>'
+        '<c r="E5" s="2"/></row>'
+        '<row r="6"/>'
+        '<row r="4"><c r="A4"><v>99</v></c></row>'
+        '<row r="7"><c r="B7" t="s"><v>5</v></c><c r="C7" s="1"><v>99999999</v></c><c r="D7"><v>-0.25</v></c>'
+        '<c r="E7" t="d"><v>2025-10-17T08:30:00</v></c><c r="F7" t="inlineStr"/></row>'
+        '<row><c r="A8"><v>8</v></c></row>'
+        '<!-- </row> trong comment --><row r=\'9\'><c r=\'A9\' t=\'str\'><v>a &amp; b &lt;c&gt; &#x1F600;&#13;</v></c>'
+        '<c r="B9" t="inlineStr"><is><t><![CDATA[<CDATA> & "nháy"]]></t></is></c>'
+        '<c r="C9" t="inlineStr"><is><t xml:space="preserve"> dòng 1\r\ndòng 2 </t></is></c>'
+        '<c r="D9" t="s"><v> 3 </v></c><c r="E9"><v></v></c><c r="F9"><v>-1.5e-3</v></c></row>'
+        '</sheetData></worksheet>'),
+}
+
+def _with_namespace_prefix(xml):
+    """Cùng nội dung nhưng các thẻ SpreadsheetML dùng prefix x: (một số thư viện ghi kiểu này)."""
+    xml = re.sub(r"<(/?)(?=[A-Za-z])(?!x:)", r"<\1x:", xml)
+    return xml.replace(f'xmlns="{_MAIN_NS}"', f'xmlns:x="{_MAIN_NS}"')
+
+def write_edge_case_workbook(path, prefixed=False):
+    """Ghi file xlsx viết tay chứa các trường hợp khó cho bộ đọc."""
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in _EDGE_CASE_PARTS.items():
+            if prefixed and name in ("xl/worksheets/data.xml", "xl/sharedStrings.xml"):
+                data = _with_namespace_prefix(data)
+            archive.writestr(name, data)
+    return path
+
+def _same_value(a, b):
+    return type(a) is type(b) and (a == b or (a != a and b != b))  # NaN == NaN
+
+def verify_reader(main1, path):
+    """So từng dòng giữa openpyxl và FastSheetReader; trả về danh sách khác biệt (tối đa 10)."""
+    differences = []
+    with main1.StreamingSheetReader(path) as expected, main1.FastSheetReader(path) as actual:
+        if len(expected.header) != len(actual.header) or not all(map(_same_value, expected.header, actual.header)):
+            differences.append(f"header: {expected.header!r} / {actual.header!r}")
+        for row_number, (expected_row, actual_row) in enumerate(zip_longest(expected, actual), 2):
+            if expected_row is None or actual_row is None:
+                differences.append(f"dòng {row_number}: số dòng khác nhau ({expected_row!r} / {actual_row!r})")
+                break
+            if type(expected_row) is not type(actual_row) or len(expected_row) != len(actual_row) \
+                    or not all(map(_same_value, expected_row, actual_row)):
+                differences.append(f"dòng {row_number}: {expected_row!r} / {actual_row!r}")
+                if len(differences) >= 10:
+                    return differences
+
+    # rows() của FastSheetReader có đường đi riêng (chỉ chuyển đổi cột được hỏi)
+    with main1.StreamingSheetReader(path) as expected, main1.FastSheetReader(path) as actual:
+        indices = [len(expected.header) + 2, None, *reversed(range(len(expected.header)))]
+        for row_number, (expected_row, actual_row) in enumerate(
+                zip_longest(expected.rows(indices), actual.rows(indices)), 2):
+            if expected_row is None or actual_row is None or not all(map(_same_value, expected_row, actual_row)):
+                differences.append(f"rows() dòng {row_number}: {expected_row!r} / {actual_row!r}")
+                if len(differences) >= 10:
+                    break
+    return differences
+
+def verify_processors(main1, files):
+    """So kết quả của các hàm xử lý giữa hai engine; trả về danh sách hàm cho kết quả khác."""
+    checks = {
+        "danhsachsanpham": [main1.process_excel_file_updated, main1.process_product_file],
+        "danhsachchitietdathang": [main1.process_purchase_order_detail_file],
+        "soquy": [lambda path, engine: main1.process_single_file(path, os.path.basename(path), engine)],
+        "danhsachhoadon": [lambda path, engine: main1.process_single_file(path, os.path.basename(path), engine)],
+    }
+    differences = []
+    for kind, path in files.items():
+        for func in checks.get(kind, []):
+            results = [func(path, engine=engine) for engine in ENGINES]
+            if results[0] != results[1]:
+                differences.append(f"{getattr(func, '__name__', 'process_single_file')}({os.path.basename(path)})")
+    return differences
+
+def run_verify(row_counts, data_dir, seed=0, extra_files=()):
+    """Đối chiếu hai engine trên file giả lập, file viết tay và các file thật truyền vào."""
+    logging.disable(logging.WARNING)
+    # openpyxl cảnh báo về style mặc định/ngày ngoài giới hạn trong file viết tay, không phải lỗi
+    warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+    import main1
+
+    os.makedirs(data_dir, exist_ok=True)
+    paths = [
+        write_edge_case_workbook(os.path.join(data_dir, "edge_cases.xlsx")),
+        write_edge_case_workbook(os.path.join(data_dir, "edge_cases_prefixed.xlsx"), prefixed=True),
+        *extra_files,
+    ]
+    failures = 0
+    for rows in row_counts:
+        files = {kind: ensure_workbook(kind, rows, data_dir, seed) for kind in sorted(COLUMNS)}
+        paths.extend(files.values())
+        differences = verify_processors(main1, files)
+        for difference in differences:
+            print(f"❌ Kết quả khác nhau: {difference}")
+        failures += len(differences)
+
+    for path in paths:
+        differences = verify_reader(main1, path)
+        status = "✅" if not differences else "❌"
+        print(f"{status} {os.path.basename(path)}")
+        for difference in differences:
+            print(f"    {difference}")
+        failures += bool(differences)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các hàm xử lý Excel của bot")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Sinh file giả lập")
+    generate_parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    generate_parser.add_argument("--kinds", nargs="+", choices=sorted(COLUMNS), default=sorted(COLUMNS))
+    generate_parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="Chạy benchmark và ghi baseline JSON")
+    # 5000 dòng ~ sổ quỹ một tháng (nhiều vùng merge phải chèn khi tổng hợp)
+    run_parser.add_argument("--rows", type=int, nargs="+", default=[1000, 5000, 10000])
+    run_parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--no-tracemalloc", action="store_true")
+    run_parser.add_argument("--engines", nargs="+", choices=ENGINES, default=["openpyxl"])
+    run_parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="File baseline JSON (mặc định: benchmark_<commit>_<thời gian>.json)")
+
+    verify_parser = subparsers.add_parser("verify", help="Đối chiếu engine fast với openpyxl")
+    verify_parser.add_argument("--rows", type=int, nargs="*", default=[1000])
+    verify_parser.add_argument("--files", nargs="*", default=[], help="Thêm file export thật để đối chiếu")
+    verify_parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    verify_parser.add_argument("--seed", type=int, default=0)
+
+    compare_parser = subparsers.add_parser("compare", help="So sánh hai baseline")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="Ngưỡng chậm đi (0.10 = 10%%)")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        for rows in args.rows:
+            for kind in args.kinds:
+                ensure_workbook(kind, rows, args.data_dir, args.seed)
+    elif args.command == "run":
+        baseline = run_benchmarks(args.cases, args.rows, args.data_dir, max(args.repeat, 1),
+                                  not args.no_tracemalloc, args.seed, args.engines)
+        output = args.output or f"benchmark_{baseline['git_commit'] or 'local'}_{datetime.now():%Y%m%d_%H%M%S}.json"
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"Đã ghi baseline: {output}")
+    elif args.command == "compare":
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        sys.exit(1 if compare_baselines(old, new, args.threshold) else 0)
+    elif args.command == "verify":
+        sys.exit(1 if run_verify(args.rows, args.data_dir, args.seed, args.files) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+"""Server KiotViet Public API giả lập và kiểm tra đồng bộ KiotVietClient của main1.py.
+
+Cách dùng:
+    python kiotviet_mock.py verify --records 300
+    python kiotviet_mock.py verify --records 300 --fail-rate 0.2
+    python kiotviet_mock.py serve --port 8765 --records 500
+
+serve chạy mock (token + /invoices, /cashflow, /products, /purchaseorders) và in các biến
+môi trường cần đặt cho bot (KIOTVIET_API_URL, KIOTVIET_TOKEN_URL...) để thử lệnh /kiotviet.
+
+verify đồng bộ toàn bộ, sửa/hủy/xóa/thêm dữ liệu trên mock rồi đồng bộ tăng dần, và kiểm tra:
+- dữ liệu lưu cục bộ khớp với mock (bỏ bản ghi bị hủy/xóa),
+- lần đồng bộ sau chỉ tải bản ghi thay đổi, checkpoint được giữ qua lần khởi động lại,
+- token hết hạn (401) được lấy lại; lỗi 429/503 (--fail-rate) được gửi lại,
+- các hàm process_* cho cùng kết quả khi đọc RecordReader và khi đọc file xlsx cùng dữ liệu.
+"""
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import asyncio
+import logging
+import secrets
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from openpyxl import Workbook
+
+from benchmark import LOAI_THU_CHI, NHOM_HANG, THUONG_HIEU, _person_name, _product_name
+
+CLIENT_ID = "mock-client"
+CLIENT_SECRET = "mock-secret"
+RETAILER = "mockshop"
+
+# ============================================================================
+# SERVER KIOTVIET GIẢ LẬP
+# ============================================================================
+
+def _api_time(value):
+    """Thời gian theo định dạng KiotViet (7 chữ số thập phân, không múi giờ)."""
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%f") + "0"
+
+class MockKiotViet:
+    """Dữ liệu của gian hàng giả lập: hóa đơn, phiếu thu chi, sản phẩm, đơn đặt hàng nhập.
+
+    Dữ liệu ban đầu trải đều days ngày gần nhất, thời gian sửa cũ hơn hiện tại ít nhất một giờ.
+    fail_rate là tỉ lệ request API (trừ lấy token) bị trả về 429 hoặc 503.
+    """
+
+    def __init__(self, records=300, days=7, seed=0, fail_rate=0.0):
+        self.rng = random.Random(seed)
+        self.fail_rate = fail_rate
+        self.tokens = set()
+        self.request_log = []           # (endpoint, tham số) theo thứ tự nhận
+        self.fault_counts = {}
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self.data = {"invoices": {}, "cashflow": {}, "products": {}, "purchaseorders": {}}
+        self.removed_products = {}      # id -> thời gian xóa
+        now = datetime.now()
+        for index in range(records):
+            self._add_product(index, now - timedelta(days=days, hours=self.rng.randint(1, 48)))
+        for _ in range(records):
+            self._add_invoice(self._past_time(now, days))
+            self._add_cashflow(self._past_time(now, days))
+        for _ in range(max(1, records // 5)):
+            self._add_purchase_order(self._past_time(now, days))
+
+    # --- sinh dữ liệu ---
+
+    def _past_time(self, now, days):
+        return now - timedelta(days=self.rng.randint(0, days - 1), hours=1,
+                               minutes=self.rng.randint(0, 60 * min(now.hour, 23)))
+
+    def _new_id(self):
+        record_id = self._next_id
+        self._next_id += 1
+        return record_id
+
+    def _add_product(self, index, when):
+        record_id = self._new_id()
+        self.data["products"][record_id] = {
+            "id": record_id, "code": f"SP{record_id:06d}", "name": _product_name(self.rng, index),
+            "fullName": _product_name(self.rng, index), "categoryName": self.rng.choice(NHOM_HANG),
+            "createdDate": _api_time(when), "modifiedDate": None,
+            "inventories": [{"branchId": branch, "cost": self.rng.randint(1, 400) * 500,
+                             "onHand": self.rng.choice([0, 0, 1, 2, 5, 10, -1])} for branch in (1, 2)],
+        }
+
+    def _add_invoice(self, when):
+        record_id = self._new_id()
+        total = self.rng.randint(1, 500) * 1000
+        self.data["invoices"][record_id] = {
+            "id": record_id, "code": f"HD{record_id:06d}", "purchaseDate": _api_time(when),
+            "branchId": self.rng.choice([1, 2]), "customerName": self.rng.choice([_person_name(self.rng), None]),
+            "total": total, "totalPayment": self.rng.choice([total, total, 0, total // 2]),
+            "status": 1, "statusValue": "Hoàn thành", "createdDate": _api_time(when), "modifiedDate": None,
+        }
+
+    def _add_cashflow(self, when):
+        record_id = self._new_id()
+        group = self.rng.choice(LOAI_THU_CHI)
+        self.data["cashflow"][record_id] = {
+            "id": record_id, "code": f"{'PT' if group.startswith('Thu') else 'PC'}{record_id:06d}",
+            "transDate": _api_time(when), "branchId": self.rng.choice([1, 2]), "cashGroup": group,
+            "partnerName": _person_name(self.rng), "amount": self.rng.randint(1, 300) * 1000,
+            "isReceipt": group.startswith("Thu"), "description": self.rng.choice(["", f"Ghi chú {record_id}"]),
+            "status": 0, "statusValue": "Đã thanh toán",
+        }
+
+    def _add_purchase_order(self, when):
+        record_id = self._new_id()
+        products = list(self.data["products"].values())
+        self.data["purchaseorders"][record_id] = {
+            "id": record_id, "code": f"DHN{record_id:06d}", "purchaseDate": _api_time(when),
+            "branchId": self.rng.choice([1, 2]), "supplierName": f"Công ty {self.rng.choice(THUONG_HIEU)}",
+            "status": 1, "statusValue": "Phiếu tạm", "createdDate": _api_time(when), "modifiedDate": None,
+            "purchaseOrderDetails": [
+                {"productCode": product["code"], "productName": product["fullName"],
+                 "quantity": self.rng.randint(1, 48), "price": self.rng.randint(1, 400) * 500}
+                for product in self.rng.sample(products, min(len(products), self.rng.randint(1, 5)))
+            ],
+        }
+
+    def mutate(self, changes=10):
+        """Sửa, hủy, xóa và thêm dữ liệu như cửa hàng đang bán; trả về số bản ghi bị đổi theo loại.
+
+        Phiếu thu chi và đơn đặt hàng chỉ đổi trong ngày hôm nay (API chỉ lọc được theo ngày).
+        """
+        now = datetime.now()
+        today = now.date().isoformat()
+        stamp = _api_time(now)
+        changed = {}
+        with self._lock:
+            invoices = list(self.data["invoices"].values())
+            for invoice in self.rng.sample(invoices, min(changes, len(invoices))):
+                invoice["totalPayment"] = invoice["total"]
+                invoice["modifiedDate"] = stamp
+            cancelled = self.rng.choice(invoices)
+            cancelled.update(status=2, statusValue="Đã hủy", modifiedDate=stamp)
+            for _ in range(changes):
+                self._add_invoice(now)
+            changed["invoices"] = 2 * changes + 1
+
+            products = list(self.data["products"].values())
+            for product in self.rng.sample(products, min(changes, len(products))):
+                product["inventories"][0]["onHand"] += 3
+                product["modifiedDate"] = stamp
+            removed = self.rng.choice(products)
+            del self.data["products"][removed["id"]]
+            self.removed_products[removed["id"]] = stamp
+            changed["products"] = changes
+
+            for _ in range(changes):
+                self._add_cashflow(now)
+            todays = [entry for entry in self.data["cashflow"].values() if entry["transDate"][:10] == today]
+            self.rng.choice(todays).update(status=1, statusValue="Đã hủy")
+            changed["cashflow"] = len(todays)
+
+            self._add_purchase_order(now)
+            changed["purchaseorders"] = sum(order["purchaseDate"][:10] == today
+                                            for order in self.data["purchaseorders"].values())
+        return changed
+
+    # --- API ---
+
+    def issue_token(self, form):
+        if form.get("client_id") != CLIENT_ID or form.get("client_secret") != CLIENT_SECRET:
+            return 400, {"error": "invalid_client"}
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self.tokens.add(token)
+        return 200, {"access_token": token, "expires_in": 86400, "token_type": "Bearer"}
+
+    def expire_tokens(self):
+        with self._lock:
+            self.tokens.clear()
+
+    def _fault(self):
+        with self._lock:
+            if self.rng.random() >= self.fail_rate:
+                return None
+            status = self.rng.choice((429, 503))
+            self.fault_counts[status] = self.fault_counts.get(status, 0) + 1
+            return status
+
+    def query(self, endpoint, params, headers):
+        """Trả về (HTTP status, JSON) cho GET /<endpoint>."""
+        authorization = headers.get("Authorization", "")
+        with self._lock:
+            authorized = authorization.startswith("Bearer ") and authorization[7:] in self.tokens
+        if not authorized:
+            return 401, {"responseStatus": {"errorCode": "Unauthorized", "message": "Token không hợp lệ"}}
+        if headers.get("Retailer") != RETAILER:
+            return 400, {"responseStatus": {"errorCode": "BadRequest", "message": "Retailer không đúng"}}
+        if endpoint not in self.data:
+            return 404, {"responseStatus": {"errorCode": "NotFound", "message": endpoint}}
+        fault = self._fault()
+        if fault:
+            return fault, {"responseStatus": {"errorCode": "Busy", "message": "Thử lại sau"}}
+        page_size = int(params.get("pageSize", 20))
+        if not 1 <= page_size <= 100:
+            return 400, {"responseStatus": {"errorCode": "BadRequest", "message": "pageSize tối đa 100"}}
+        current_item = int(params.get("currentItem", 0))
+
+        with self._lock:
+            self.request_log.append((endpoint, dict(params)))
+            records = sorted(self.data[endpoint].values(), key=lambda record: record["id"])
+            since = params.get("lastModifiedFrom")
+            if since:
+                records = [r for r in records if (r.get("modifiedDate") or r["createdDate"])[:19] >= since[:19]]
+            for param, field in (("startDate", "transDate"), ("fromPurchaseDate", "purchaseDate")):
+                if params.get(param):
+                    records = [r for r in records if r[field][:10] >= params[param][:10]]
+            if params.get("branchIds") and endpoint != "products":
+                branches = {int(branch) for branch in params["branchIds"].split(",")}
+                records = [r for r in records if r.get("branchId") in branches]
+            payload = {"total": len(records), "pageSize": page_size,
+                       "data": json.loads(json.dumps(records[current_item:current_item + page_size]))}
+            if endpoint == "products" and params.get("includeRemoveIds") == "true" and current_item == 0:
+                payload["removeIds"] = [record_id for record_id, stamp in self.removed_products.items()
+                                        if not since or stamp[:19] >= since[:19]]
+        return 200, payload
+
+    def modified_since(self, endpoint, since):
+        """Số bản ghi có thời gian sửa (hoặc tạo) từ since trở đi."""
+        with self._lock:
+            return sum((record.get("modifiedDate") or record["createdDate"])[:19] >= since[:19]
+                       for record in self.data[endpoint].values())
+
+    def request_count(self, endpoint=None):
+        with self._lock:
+            return sum(1 for name, _ in self.request_log if endpoint is None or name == endpoint)
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        if urlsplit(self.path).path != "/connect/token":
+            self._reply(404, {"error": "not_found"})
+            return
+        self._reply(*self.server.mock.issue_token(dict(parse_qsl(body))))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self._reply(*self.server.mock.query(url.path.strip("/"), dict(parse_qsl(url.query)), self.headers))
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_server(mock, host="127.0.0.1", port=0):
+    """Chạy mock trong thread nền; trả về (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), _MockRequestHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, name="kiotviet-mock", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+# ============================================================================
+# KIỂM TRA ĐỒNG BỘ
+# ============================================================================
+
+def expected_rows(main1, mock, name, day=None):
+    """Các dòng mà store cục bộ phải có sau khi đồng bộ (đã sắp xếp như KiotVietClient.reader)."""
+    entity = main1.KIOTVIET_ENTITIES[name]
+    rows = []
+    for record in mock.data[name].values():
+        if main1._is_cancelled_record(record):
+            continue
+        if day is not None and entity.date_field and record[entity.date_field][:10] != day.isoformat():
+            continue
+        rows.extend(tuple(row) for row in entity.to_rows(json.loads(json.dumps(record))))
+    rows.sort(key=lambda row: (str(row[1]), str(row[0])))
+    return rows
+
+def _check(failures, condition, message):
+    print(f"  {'✅' if condition else '❌'} {message}")
+    if not condition:
+        failures.append(message)
+
+def _write_workbook(path, header, rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(list(header))
+    for row in rows:
+        sheet.append(list(row))
+    workbook.save(path)
+
+def verify_processors(main1, client, work_dir, failures):
+    """So kết quả các hàm process_* giữa RecordReader và file xlsx cùng dữ liệu."""
+    today = datetime.now().date()
+    for name, day in (("invoices", today), ("cashflow", today), ("products", None), ("purchaseorders", today)):
+        reader = pickle.loads(pickle.dumps(client.reader(name, day)))
+        file_name = client.file_name(name, day)
+        path = os.path.join(work_dir, file_name)
+        _write_workbook(path, reader.header, reader.records)
+        if name in ("invoices", "cashflow"):
+            from_api = main1.process_single_file(reader, file_name)
+            from_file = main1.process_single_file(path, file_name)
+            same = (from_api["totals"] == from_file["totals"] and from_api["rows"] == from_file["rows"]
+                    and not from_api["missing_columns_info"])
+            detail = f"{from_api['totals']}, {len(from_api['rows'])} dòng sổ quỹ"
+        elif name == "products":
+            from_api = main1.process_excel_file_updated(reader)
+            from_file = main1.process_excel_file_updated(path)
+            same = isinstance(from_api, dict) and from_api == from_file
+            detail = f"{len(from_api['all_products']) if isinstance(from_api, dict) else from_api} sản phẩm"
+        else:
+            from_api = main1.process_purchase_order_detail_file(reader)
+            from_file = main1.process_purchase_order_detail_file(path)
+            same = isinstance(from_api, dict) and from_api == from_file
+            detail = f"{len(from_api) if isinstance(from_api, dict) else from_api} nhà cung cấp"
+        _check(failures, same, f"{file_name}: RecordReader và file xlsx cho cùng kết quả ({detail})")
+
+    readers = [client.reader(name, today) for name in ("invoices", "cashflow")]
+    names = [client.file_name(name, today) for name in ("invoices", "cashflow")]
+    result = main1.process_multiple_invoice_files(readers, None, file_names=names)
+    _check(failures, bool(result and result.get("file_data")), "Báo cáo tổng hợp từ dữ liệu API được tạo")
+
+async def _verify(main1, mock, base_url, sync_dir, work_dir, fail_rate):
+    failures = []
+    names = tuple(main1.KIOTVIET_ENTITIES)
+
+    def new_client(page_size=37):
+        return main1.KiotVietClient(CLIENT_ID, CLIENT_SECRET, RETAILER, api_url=base_url,
+                                    token_url=f"{base_url}/connect/token", sync_dir=sync_dir,
+                                    page_size=page_size, pool_size=4)
+
+    def check_store(client, label):
+        for name in names:
+            stored = client.reader(name).records
+            _check(failures, stored == expected_rows(main1, mock, name),
+                   f"{label}: {name} khớp với mock ({len(stored)} dòng)")
+
+    print("Đồng bộ lần đầu (toàn bộ)")
+    client = new_client()
+    started = time.perf_counter()
+    counts = await client.sync(names)
+    print(f"  {counts}, {mock.request_count()} request, {time.perf_counter() - started:.2f}s")
+    check_store(client, "Lần đầu")
+
+    def overlap_counts(client):
+        # Bản ghi sửa trong SYNC_OVERLAP trước checkpoint được tải lại có chủ đích
+        counts = {}
+        for name in incremental:
+            since = datetime.fromisoformat(client.store(name).checkpoint[:19]) - client.SYNC_OVERLAP
+            counts[name] = mock.modified_since(name, since.isoformat())
+        return counts
+
+    print("Đồng bộ lại khi không có thay đổi")
+    incremental = ("invoices", "products")
+    overlap = overlap_counts(client)
+    before = mock.request_count()
+    counts = await client.sync(incremental)
+    _check(failures, counts == overlap,
+           f"Chỉ tải lại bản ghi trong khoảng chồng lấn {client.SYNC_OVERLAP} ({counts}, "
+           f"{mock.request_count() - before} request)")
+
+    print("Sửa/hủy/xóa/thêm dữ liệu rồi đồng bộ tăng dần (sau khi khởi động lại, token hết hạn)")
+    overlap = overlap_counts(client)
+    changed = mock.mutate()
+    limits = {name: changed[name] + overlap.get(name, 0) for name in names}
+    mock.expire_tokens()
+    await client.close()
+    client = new_client()
+    counts = await client.sync(names)
+    _check(failures, all(counts[name] <= limits[name] for name in names),
+           f"Chỉ tải bản ghi thay đổi: {counts} (tối đa {limits})")
+    check_store(client, "Tăng dần")
+
+    print("So kết quả xử lý giữa dữ liệu API và file xlsx")
+    verify_processors(main1, client, work_dir, failures)
+    await client.close()
+    if fail_rate:
+        print(f"Lỗi giả lập đã gửi lại: {mock.fault_counts}")
+    return failures
+
+def run_verify(records, seed, fail_rate):
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s - %(message)s")
+    os.environ.setdefault("RETRY_DELAY", "0")
+    import main1
+
+    mock = MockKiotViet(records=records, seed=seed, fail_rate=fail_rate)
+    server, base_url = start_mock_server(mock)
+    try:
+        with tempfile.TemporaryDirectory(prefix="kiotviet_verify_") as work_dir:
+            failures = asyncio.run(_verify(main1, mock, base_url, os.path.join(work_dir, "sync"), work_dir,
+                                           fail_rate))
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"\n{'✅ Tất cả kiểm tra đều đạt' if not failures else f'❌ {len(failures)} kiểm tra không đạt'}")
+    return 0 if not failures else 1
+
+def run_serve(host, port, records, seed, fail_rate):
+    mock = MockKiotViet(records=records, seed=seed, fail_rate=fail_rate)
+    server, base_url = start_mock_server(mock, host, port)
+    print(f"KiotViet giả lập: {base_url}\n")
+    print(f"KIOTVIET_API_URL={base_url}\nKIOTVIET_TOKEN_URL={base_url}/connect/token\n"
+          f"KIOTVIET_CLIENT_ID={CLIENT_ID}\nKIOTVIET_CLIENT_SECRET={CLIENT_SECRET}\nKIOTVIET_RETAILER={RETAILER}\n")
+    print("Nhấn Enter để sửa/thêm dữ liệu, Ctrl+C để dừng.")
+    try:
+        while True:
+            input()
+            print(f"Đã thay đổi: {mock.mutate()}")
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="KiotViet Public API giả lập")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("verify", "Kiểm tra đồng bộ KiotVietClient với mock"), ("serve", "Chạy mock")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--records", type=int, default=300, help="Số hóa đơn/phiếu thu chi/sản phẩm")
+        sub.add_argument("--seed", type=int, default=0)
+        sub.add_argument("--fail-rate", type=float, default=0.0, help="Tỉ lệ request bị trả về 429/503")
+    subparsers.choices["serve"].add_argument("--host", default="127.0.0.1")
+    subparsers.choices["serve"].add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        return run_verify(args.records, args.seed, args.fail_rate)
+    return run_serve(args.host, args.port, args.records, args.seed, args.fail_rate)
+
+if __name__ == "__main__":
+    sys.exit(main())
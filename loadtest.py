@@ -0,0 +1,700 @@
+"""Load test bot với server Bot API giả lập, không cần kết nối Telegram thật.
+
+Cách dùng:
+    python loadtest.py --users 20 --uploads 5 --rows 2000 --latency 50
+    python loadtest.py --webhook --users 20 --uploads 5
+
+Script mở FakeBotAPI trên localhost, chạy main1.py trong process con với
+TELEGRAM_BASE_URL trỏ vào server đó, rồi mô phỏng N user cùng gửi các file export
+(hóa đơn, sổ quỹ, sản phẩm, đơn đặt hàng) do benchmark.py sinh ra. Mỗi user gửi lần
+lượt từng file và chờ bot trả lời xong mới gửi file tiếp theo.
+
+Độ trễ đầu-cuối của một file được tính từ lúc bot nhận update (qua getUpdates, hoặc
+lúc POST tới webhook) đến khi bot gửi tin nhắn kết thúc (✅ Xử lý file..., ✅ Tổng hợp
+thành công, 💡 Đã lưu file sổ quỹ, hoặc ❌ lỗi). Với --webhook, bot chạy BOT_MODE=webhook
+và driver POST update thẳng vào webhook của bot (kèm secret token).
+
+Với --fail-rate, server giả lập làm hỏng ngẫu nhiên một phần request của các method trong
+--fail-methods (trả HTTP 502 hoặc đóng kết nối không trả lời) để kiểm tra bot gửi lại
+request; số lần gửi lại đọc từ /metrics của bot và in cùng kết quả.
+
+Với --proxy-latency (vd: 40,10), bot đi qua 1-2 HTTP proxy giả lập (PROXY_* và
+BACKUP_PROXY_*, có user/mật khẩu) với độ trễ tương ứng; --kill-proxy-after N tắt proxy
+nhanh nhất sau N giây để kiểm tra bot chuyển sang proxy còn lại giữa chừng.
+
+Cache kết quả của bot bị tắt (RESULT_CACHE_MAX_MB=0) để mọi file đều đi qua đường xử lý
+thật; các biến môi trường khác (MAX_CONCURRENT_JOBS, PROCESS_POOL_WORKERS...) được truyền
+nguyên cho bot để so sánh cấu hình.
+"""
+import os
+import sys
+import json
+import re
+import time
+import random
+import base64
+import socket
+import secrets
+import argparse
+import threading
+import subprocess
+import http.client
+import email.policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import Request, urlopen
+
+from benchmark import DEFAULT_DATA_DIR, ensure_workbook
+
+FAKE_TOKEN = "123456:LOADTEST"
+
+# Tin nhắn đánh dấu bot đã xử lý xong một file
+FINAL_PREFIXES = ("✅ Xử lý file", "✅ Tổng hợp thành công", "💡 Đã lưu file sổ quỹ", "❌")
+
+EXPORT_KINDS = ("danhsachhoadon", "soquy", "danhsachsanpham", "danhsachchitietdathang")
+
+# ============================================================================
+# SERVER BOT API GIẢ LẬP
+# ============================================================================
+
+def _parse_multipart(content_type, body):
+    """Tách multipart/form-data thành (các trường text, các file {tên: (tên file, bytes)})."""
+    message = BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    fields, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True) or b""
+        if part.get_filename() is not None:
+            files[name] = (part.get_filename(), payload)
+        else:
+            fields[name] = payload.decode("utf-8")
+    return fields, files
+
+class FakeBotAPI:
+    """Trạng thái của Bot API giả lập: hàng đợi update, file đã upload, tin nhắn bot đã gửi.
+
+    Hỗ trợ getMe, getUpdates (long polling), setWebhook, getFile, tải file, sendMessage,
+    sendDocument, editMessageText, editMessageReplyMarkup, answerCallbackQuery; các method
+    khác trả về True. latency (giây) được cộng vào mỗi request trừ getUpdates.
+    Sau setWebhook, update được POST thẳng tới webhook của bot.
+    fail_rate là tỉ lệ request của fail_methods ("download" = tải file) bị làm hỏng.
+    """
+
+    def __init__(self, latency=0.0, fail_rate=0.0, fail_methods=(), seed=0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_methods = frozenset(fail_methods)
+        self._fault_rng = random.Random(seed)
+        self.fault_counts = {}
+        self._lock = threading.Condition()
+        self._updates = []              # update chưa được bot xác nhận
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._next_file_id = 1
+        self._files = {}                # file_id -> (file_unique_id, bytes)
+        self._events = {}               # chat_id -> [(thời điểm, method, text)]
+        self._delivered = {}            # update_id -> thời điểm bot nhận update
+        self.closing = False
+        self.polling_started = threading.Event()
+        self.webhook = None             # (url, secret_token) sau khi bot gọi setWebhook
+        self.webhook_set = threading.Event()
+        self.request_counts = {}
+
+    # --- phía driver ---
+
+    def push_document(self, user_id, file_name, data):
+        """Thêm update "user gửi file"; trả về (update_id, số sự kiện hiện có của chat)."""
+        with self._lock:
+            file_id = self._add_file(data)
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            update = {
+                "update_id": update_id,
+                "message": {
+                    "message_id": self._new_message_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                    "document": {
+                        "file_id": file_id,
+                        "file_unique_id": f"u{file_id}",
+                        "file_name": file_name,
+                        "file_size": len(data),
+                        "mime_type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    },
+                },
+            }
+            since = len(self._events.get(user_id, []))
+            if self.webhook is None:
+                self._updates.append(update)
+                self._lock.notify_all()
+                return update_id, since
+            self._delivered[update_id] = time.monotonic()
+
+        url, secret_token = self.webhook
+        post_update(url, update, secret_token)
+        return update_id, since
+
+    def wait_for_final(self, chat_id, since, timeout):
+        """Chờ tin nhắn kết thúc của chat sau sự kiện thứ since; trả về (thời điểm, text) hoặc None."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                for sent_at, _, text in self._events.get(chat_id, [])[since:]:
+                    if text and text.startswith(FINAL_PREFIXES):
+                        return sent_at, text
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+
+    def delivered_at(self, update_id):
+        with self._lock:
+            return self._delivered.get(update_id)
+
+    def close(self):
+        with self._lock:
+            self.closing = True
+            self._lock.notify_all()
+
+    # --- phía bot ---
+
+    def _new_message_id(self):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+
+    def _add_file(self, data):
+        file_id = f"file{self._next_file_id}"
+        self._next_file_id += 1
+        self._files[file_id] = (f"u{file_id}", data)
+        return file_id
+
+    def _message(self, chat_id, text=None, **extra):
+        message = {"message_id": self._new_message_id(), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"},
+                   "from": {"id": 1, "is_bot": True, "first_name": "LoadTestBot"}}
+        if text is not None:
+            message["text"] = text
+        message.update(extra)
+        return message
+
+    def _record(self, chat_id, method, text):
+        self._events.setdefault(chat_id, []).append((time.monotonic(), method, text))
+        self._lock.notify_all()
+
+    def pick_fault(self, method):
+        """Lỗi giả lập cho request này: "502", "drop" (đóng kết nối) hoặc None."""
+        if method not in self.fail_methods:
+            return None
+        with self._lock:
+            if self._fault_rng.random() >= self.fail_rate:
+                return None
+            fault = self._fault_rng.choice(("502", "drop"))
+            key = f"{method}:{fault}"
+            self.fault_counts[key] = self.fault_counts.get(key, 0) + 1
+            return fault
+
+    def get_updates(self, params):
+        self.polling_started.set()
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            # offset xác nhận các update đã xử lý
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and not self.closing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            now = time.monotonic()
+            for update in self._updates:
+                self._delivered.setdefault(update["update_id"], now)
+            return list(self._updates)
+
+    def call(self, method, params, files):
+        """Xử lý một method Bot API, trả về giá trị 'result'."""
+        with self._lock:
+            self.request_counts[method] = self.request_counts.get(method, 0) + 1
+        if method == "getUpdates":
+            return self.get_updates(params)
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = int(params["chat_id"]) if params.get("chat_id") else None
+        with self._lock:
+            if method == "setWebhook":
+                self.webhook = (params["url"], params.get("secret_token"))
+                self.webhook_set.set()
+                return True
+            if method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+            if method == "getFile":
+                unique_id, data = self._files[params["file_id"]]
+                return {"file_id": params["file_id"], "file_unique_id": unique_id,
+                        "file_size": len(data), "file_path": f"documents/{params['file_id']}.xlsx"}
+            if method in ("sendMessage", "editMessageText"):
+                self._record(chat_id, method, params.get("text"))
+                return self._message(chat_id, params.get("text"))
+            if method == "sendDocument":
+                document = files.get("document")
+                data = document[1] if document else b""
+                file_id = self._add_file(data)
+                self._record(chat_id, method, params.get("caption"))
+                return self._message(chat_id, caption=params.get("caption"), document={
+                    "file_id": file_id, "file_unique_id": f"u{file_id}",
+                    "file_name": document[0] if document else "document", "file_size": len(data),
+                })
+            if method == "editMessageReplyMarkup":
+                return self._message(chat_id)
+            return True
+
+    def download(self, file_path):
+        if self.latency:
+            time.sleep(self.latency)
+        file_id = os.path.splitext(os.path.basename(file_path))[0]
+        with self._lock:
+            entry = self._files.get(file_id)
+        return entry[1] if entry else None
+
+class _BotAPIRequestHandler(BaseHTTPRequestHandler):
+    """Định tuyến /bot<token>/<method> và /file/bot<token>/<đường dẫn> tới FakeBotAPI."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body, content_type="application/json"):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Bot đã đóng kết nối (vd: long polling bị hủy khi bot dừng)
+            pass
+
+    def _handle(self):
+        api = self.server.api
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        method = "download" if parts[0] == "file" else parts[-1]
+        fault = api.pick_fault(method)
+        if fault == "drop":
+            # Đóng kết nối mà không trả lời (như proxy/mạng bị ngắt giữa chừng)
+            self.close_connection = True
+            return
+        if fault == "502":
+            self._reply(502, b"Bad Gateway", "text/plain")
+            return
+
+        if len(parts) >= 3 and parts[0] == "file":
+            data = api.download("/".join(parts[2:]))
+            if data is None:
+                self._reply(404, b"not found", "text/plain")
+            else:
+                self._reply(200, data, "application/octet-stream")
+            return
+
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            self._reply(404, json.dumps({"ok": False, "error_code": 404, "description": "Not Found"}).encode())
+            return
+
+        params = dict(parse_qsl(url.query))
+        files = {}
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            fields, files = _parse_multipart(content_type, body)
+            params.update(fields)
+        elif body:
+            params.update(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+
+        try:
+            result = api.call(parts[1], params, files)
+            payload = {"ok": True, "result": result}
+        except (KeyError, ValueError) as e:
+            payload = {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+        self._reply(200, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+def post_update(url, update, secret_token):
+    """POST một update tới webhook của bot như Telegram; trả về HTTP status."""
+    request = Request(url, data=json.dumps(update).encode("utf-8"), method="POST",
+                      headers={"Content-Type": "application/json"})
+    if secret_token is not None:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret_token)
+    try:
+        with urlopen(request, timeout=30) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+def wait_for_webhook(api, timeout=60):
+    """Chờ bot đăng ký webhook và server webhook nhận request; kiểm tra bot từ chối sai secret."""
+    if not api.webhook_set.wait(timeout):
+        return False
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status = post_update(api.webhook[0], {"update_id": 0}, "sai-secret")
+        except URLError:
+            time.sleep(0.2)
+            continue
+        if status != 403:
+            print(f"⚠️ Webhook nhận request sai secret token (HTTP {status})")
+        return True
+    return False
+
+# ============================================================================
+# PROXY GIẢ LẬP
+# ============================================================================
+
+# Header chỉ có nghĩa trên từng chặng, không chuyển tiếp
+HOP_BY_HOP_HEADERS = frozenset({"connection", "keep-alive", "proxy-authorization", "proxy-connection",
+                                "te", "trailer", "transfer-encoding", "upgrade"})
+
+class _ForwardProxyHandler(BaseHTTPRequestHandler):
+    """HTTP forward proxy tối giản: nhận request dạng absolute-URI, kiểm tra Proxy-Authorization."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.stand_in.track(self.connection)
+
+    def _reply(self, status, body, content_type):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def _handle(self):
+        proxy = self.server.stand_in
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if proxy.down:
+            self.close_connection = True
+            return
+        if self.headers.get("Proxy-Authorization") != proxy.authorization:
+            proxy.count("rejected")
+            self._reply(407, b"Proxy Authentication Required", "text/plain")
+            return
+        if proxy.latency:
+            time.sleep(proxy.latency)
+        url = urlsplit(self.path)
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=120)
+        try:
+            connection.request(self.command, url.path + (f"?{url.query}" if url.query else ""), body=body,
+                               headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except OSError:
+            proxy.count("upstream_error")
+            self._reply(502, b"Bad Gateway", "text/plain")
+            return
+        finally:
+            connection.close()
+        proxy.count("forwarded")
+        self._reply(response.status, data, response.getheader("Content-Type", "application/octet-stream"))
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInProxy:
+    """HTTP proxy giả lập chạy trong thread nền, có thể tắt đột ngột bằng kill()."""
+
+    def __init__(self, latency=0.0, user="loadtest@proxy", password="p:a/ss@1", host="127.0.0.1"):
+        self.latency = latency
+        self.user = user
+        self.password = password
+        self.authorization = "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.down = False
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._connections = set()
+        self.server = ThreadingHTTPServer((host, 0), _ForwardProxyHandler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.host, self.port = host, self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name=f"proxy-{self.port}", daemon=True).start()
+
+    def track(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def count(self, outcome):
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+    def kill(self):
+        """Ngừng nhận kết nối mới và cắt mọi kết nối đang mở (như proxy bị sập)."""
+        if self.down:
+            return
+        self.down = True
+        self.server.shutdown()
+        self.server.server_close()
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def env(self, prefix):
+        """Biến môi trường cấu hình proxy này cho bot (prefix: PROXY_ hoặc BACKUP_PROXY_)."""
+        return {f"{prefix}ENABLED": "1", f"{prefix}TYPE": "http", f"{prefix}HOST": self.host,
+                f"{prefix}PORT": str(self.port), f"{prefix}USER": self.user, f"{prefix}PASS": self.password}
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_fake_server(api, host="127.0.0.1", port=0):
+    """Chạy server giả lập trong thread nền; trả về (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), _BotAPIRequestHandler)
+    server.daemon_threads = True
+    server.api = api
+    threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+# ============================================================================
+# DRIVER
+# ============================================================================
+
+def percentile(values, pct):
+    """Percentile theo nearest-rank trên danh sách đã sắp xếp."""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+def run_user(api, user_id, uploads, workbooks, rng, timeout, results):
+    """Một user gửi lần lượt uploads file (loại ngẫu nhiên), chờ kết quả từng file."""
+    for index in range(uploads):
+        kind = rng.choice(EXPORT_KINDS)
+        data = workbooks[kind]
+        update_id, since = api.push_document(user_id, f"{kind}_{user_id}_{index}.xlsx", data)
+        pushed_at = time.monotonic()
+        final = api.wait_for_final(user_id, since, timeout)
+        started_at = api.delivered_at(update_id) or pushed_at
+        if final is None:
+            results.append({"kind": kind, "status": "timeout", "latency": None})
+            continue
+        finished_at, text = final
+        results.append({
+            "kind": kind,
+            "status": "error" if text.startswith("❌") else "ok",
+            "latency": finished_at - started_at,
+        })
+
+def summarize(results, wall):
+    """Thống kê p50/p95/p99 và throughput theo từng loại file và tổng."""
+    def stats(items):
+        latencies = sorted(r["latency"] for r in items if r["latency"] is not None)
+        return {
+            "uploads": len(items),
+            "ok": sum(r["status"] == "ok" for r in items),
+            "error": sum(r["status"] == "error" for r in items),
+            "timeout": sum(r["status"] == "timeout" for r in items),
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "p99_s": percentile(latencies, 99),
+            "max_s": latencies[-1] if latencies else None,
+        }
+    summary = {"wall_s": wall, "throughput_per_s": len(results) / wall if wall else None, "all": stats(results)}
+    for kind in EXPORT_KINDS:
+        items = [r for r in results if r["kind"] == kind]
+        if items:
+            summary[kind] = stats(items)
+    return summary
+
+def scrape_retries(metrics_port):
+    """Đọc excel_bot_http_retries_total từ /metrics của bot: {"method/lý do": số lần}."""
+    try:
+        with urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+            text = response.read().decode("utf-8")
+    except (URLError, OSError):
+        return None
+    retries = {}
+    for line in text.splitlines():
+        if line.startswith("excel_bot_http_retries_total{"):
+            labels, value = line[len("excel_bot_http_retries_total{"):].rsplit("} ", 1)
+            pairs = dict(re.findall(r'(\w+)="([^"]*)"', labels))
+            retries[f"{pairs['method']}/{pairs['reason']}"] = int(float(value))
+    return retries
+
+def start_bot(base_url, log_path, webhook=False, metrics_port=0, proxies=()):
+    """Chạy main1.py trong process con, trỏ tới server giả lập (qua proxies nếu có)."""
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": FAKE_TOKEN,
+        "TELEGRAM_BASE_URL": base_url,
+        "ALLOWED_USERS": "",
+        "RESULT_CACHE_MAX_MB": "0",
+        # Không ghi đè file export đã lưu cho báo cáo định kỳ của bot thật bằng file giả lập
+        "AUTO_REPORTS_ENABLED": "0",
+        "BOT_MODE": "polling",
+        "METRICS_HOST": "127.0.0.1",
+        "METRICS_PORT": str(metrics_port),
+        "PROXY_ENABLED": "0",
+        "BACKUP_PROXY_ENABLED": "0",
+        "PROXY_CHECK_INTERVAL": "2",
+    })
+    for prefix, proxy in zip(("PROXY_", "BACKUP_PROXY_"), proxies):
+        env.update(proxy.env(prefix))
+    if webhook:
+        port = _free_port()
+        env.update({
+            "BOT_MODE": "webhook",
+            "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+            "WEBHOOK_LISTEN": "127.0.0.1",
+            "WEBHOOK_PORT": str(port),
+            "WEBHOOK_PATH": "telegram",
+            "WEBHOOK_SECRET_TOKEN": secrets.token_urlsafe(24),
+        })
+    log_file = open(log_path, "w", encoding="utf-8")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main1.py")
+    process = subprocess.Popen([sys.executable, script], env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(script))
+    return process, log_file
+
+def stop_bot(process, timeout=30):
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test bot với Bot API giả lập")
+    parser.add_argument("--users", type=int, default=10, help="Số user đồng thời")
+    parser.add_argument("--uploads", type=int, default=3, help="Số file mỗi user gửi")
+    parser.add_argument("--rows", type=int, default=1000, help="Số dòng mỗi file")
+    parser.add_argument("--latency", type=float, default=0.0, help="Độ trễ mỗi request Bot API (ms)")
+    parser.add_argument("--timeout", type=float, default=300, help="Thời gian chờ tối đa mỗi file (giây)")
+    parser.add_argument("--webhook", action="store_true", help="Chạy bot ở chế độ webhook")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Tỉ lệ request bị làm hỏng (502 hoặc đóng kết nối), 0-1")
+    parser.add_argument("--fail-methods", default="getFile,download,editMessageText",
+                        help="Các method bị làm hỏng, phân cách bằng dấu phẩy (download = tải file)")
+    parser.add_argument("--proxy-latency", default="",
+                        help="Chạy bot qua HTTP proxy giả lập, độ trễ mỗi proxy (ms), vd: 40,10 (tối đa 2)")
+    parser.add_argument("--kill-proxy-after", type=float, default=0,
+                        help="Tắt proxy nhanh nhất sau N giây kể từ lúc bắt đầu gửi file (0 = không)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--bot-log", default="loadtest_bot.log", help="File log của bot")
+    parser.add_argument("--output", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    workbooks = {}
+    for kind in EXPORT_KINDS:
+        with open(ensure_workbook(kind, args.rows, args.data_dir), "rb") as f:
+            workbooks[kind] = f.read()
+
+    fail_methods = [name.strip() for name in args.fail_methods.split(",") if name.strip()]
+    api = FakeBotAPI(latency=args.latency / 1000, fail_rate=args.fail_rate, fail_methods=fail_methods,
+                     seed=args.seed)
+    server, base_url = start_fake_server(api)
+    print(f"Bot API giả lập: {base_url}")
+    proxies = [StandInProxy(latency=float(ms) / 1000) for ms in args.proxy_latency.split(",") if ms.strip()][:2]
+    for proxy in proxies:
+        print(f"Proxy giả lập: {proxy.host}:{proxy.port} (+{proxy.latency * 1000:.0f}ms)")
+    metrics_port = _free_port()
+    process, log_file = start_bot(base_url, args.bot_log, webhook=args.webhook, metrics_port=metrics_port,
+                                  proxies=proxies)
+    retries = None
+    kill_timer = None
+
+    try:
+        # Chờ bot khởi động xong (bắt đầu long polling hoặc đã đăng ký webhook)
+        ready = api.webhook_set if args.webhook else api.polling_started
+        deadline = time.monotonic() + 60
+        while not ready.wait(0.5):
+            if process.poll() is not None or time.monotonic() > deadline:
+                print(f"❌ Bot không khởi động được, xem log: {args.bot_log}")
+                return 1
+        if args.webhook and not wait_for_webhook(api):
+            print(f"❌ Webhook của bot không phản hồi, xem log: {args.bot_log}")
+            return 1
+
+        print(f"Bắt đầu ({'webhook' if args.webhook else 'polling'}): {args.users} user × {args.uploads} file, "
+              f"{args.rows} dòng/file, latency {args.latency:.0f}ms")
+        results = []
+        threads = [
+            threading.Thread(target=run_user, args=(api, 1000 + user, args.uploads, workbooks,
+                                                    random.Random(args.seed * 100003 + user), args.timeout, results))
+            for user in range(args.users)
+        ]
+        started = time.monotonic()
+        if proxies and args.kill_proxy_after:
+            fastest = min(proxies, key=lambda proxy: proxy.latency)
+            kill_timer = threading.Timer(args.kill_proxy_after, fastest.kill)
+            kill_timer.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.monotonic() - started
+        retries = scrape_retries(metrics_port)
+    finally:
+        stop_bot(process)
+        log_file.close()
+        api.close()
+        server.shutdown()
+        server.server_close()
+        if kill_timer is not None:
+            kill_timer.cancel()
+        for proxy in proxies:
+            proxy.kill()
+
+    summary = summarize(results, wall)
+    summary["config"] = vars(args)
+    summary["requests"] = api.request_counts
+    summary["faults"] = api.fault_counts
+    summary["retries"] = retries
+    summary["proxies"] = [{"port": proxy.port, "latency_ms": proxy.latency * 1000, "requests": proxy.counts}
+                          for proxy in proxies]
+    print(f"\nTổng thời gian {wall:.1f}s, throughput {summary['throughput_per_s']:.2f} file/s")
+    print(f"{'loại file':<24}{'số file':>8}{'ok':>6}{'lỗi':>6}{'timeout':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name in ("all", *EXPORT_KINDS):
+        if name not in summary:
+            continue
+        s = summary[name]
+        fmt = lambda value: f"{value:.2f}s" if value is not None else "-"
+        print(f"{name:<24}{s['uploads']:>8}{s['ok']:>6}{s['error']:>6}{s['timeout']:>9}"
+              f"{fmt(s['p50_s']):>9}{fmt(s['p95_s']):>9}{fmt(s['p99_s']):>9}")
+    if api.fault_counts or retries:
+        print(f"Lỗi giả lập: {api.fault_counts}")
+        print(f"Bot gửi lại: {retries}")
+    for proxy in proxies:
+        print(f"Proxy :{proxy.port} (+{proxy.latency * 1000:.0f}ms): {proxy.counts}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"Đã ghi kết quả: {args.output}")
+    return 0 if all(r["status"] == "ok" for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,27 +2,66 @@
 import os
 import sys
 import logging
+import atexit
 import tempfile
 import shutil
 import base64
-from functools import wraps
-from datetime import datetime
+from copy import copy
+from functools import wraps, lru_cache
+from operator import itemgetter
+from datetime import datetime, timedelta
 import re
-import locale
+import unicodedata
+import asyncio
+import time
+import pickle
+import json
+import hashlib
+import heapq
+import marshal
+import cProfile
+import threading
+import secrets
+import random
+import multiprocessing
+import posixpath
+import zipfile
+import importlib.util
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from typing import Callable, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+from xml.etree import ElementTree
 
+import httpx
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
+    CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
     filters
 )
 from openpyxl import load_workbook, Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, NamedStyle
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.utils.datetime import from_excel, from_ISO8601, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+from openpyxl.xml.constants import SHEET_MAIN_NS, REL_NS, PKG_REL_NS, ARC_WORKBOOK
+from openpyxl.cell.cell import MergedCell
+from openpyxl.worksheet.merge import MergedCellRange
+from openpyxl.formula.tokenizer import Tokenizer, Token
 
 # ============================================================================
 # CONFIGURATION (từ config.py)
@@ -37,6 +76,21 @@ load_dotenv(dotenv_path)
 
 # Thông tin của bot
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Địa chỉ Bot API, để trống = api.telegram.org (trỏ sang server giả lập khi load test, xem loadtest.py)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "").rstrip("/")
+
+# Chế độ nhận update: "polling" (mặc định) hoặc "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Webhook: WEBHOOK_URL là địa chỉ công khai (https, thường qua reverse proxy làm TLS),
+# bot lắng nghe HTTP tại WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+# Chỉ cần khi bot tự làm TLS (không có reverse proxy phía trước)
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "")
 EXCEL_TEMPLATE_BASE64 = os.getenv("EXCEL_TEMPLATE_BASE64")
 BANGLUONG = os.getenv("BANGLUONG")  # Dữ liệu bảng lương dạng base64
 
@@ -58,7 +112,157 @@ else:
 NETWORK_TIMEOUT = int(os.getenv("NETWORK_TIMEOUT", "60"))  # seconds
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 RETRY_DELAY = int(os.getenv("RETRY_DELAY", "2"))  # seconds
+RETRY_MAX_DELAY = int(os.getenv("RETRY_MAX_DELAY", "30"))  # seconds, trần của backoff khi thử lại
+# Kết nối tới Bot API: số kết nối giữ keep-alive và timeout riêng từng pha (đọc/ghi dùng NETWORK_TIMEOUT)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_CONNECT_TIMEOUT = int(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))  # seconds
+HTTP_POOL_TIMEOUT = int(os.getenv("HTTP_POOL_TIMEOUT", "5"))  # seconds, chờ kết nối rảnh trong pool
+HTTP_KEEPALIVE_EXPIRY = int(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))  # seconds
+
+# Proxy tới Bot API: PROXY_* (chính) và BACKUP_PROXY_* (dự phòng), mỗi bộ gồm
+# ENABLED, TYPE (http/socks5/socks5h), HOST, PORT, USER, PASS. Bot đo độ trễ từng proxy
+# định kỳ và gửi request qua proxy khỏe có độ trễ thấp nhất
+PROXY_CHECK_INTERVAL = int(os.getenv("PROXY_CHECK_INTERVAL", "30"))  # seconds
+PROXY_MAX_FAILURES = int(os.getenv("PROXY_MAX_FAILURES", "3"))  # lỗi liên tiếp trước khi bỏ qua proxy
+PROXY_TYPES = ("http", "socks5", "socks5h")
+
+def read_proxy_config(prefix):
+    """Đọc cấu hình proxy <prefix>ENABLED/TYPE/HOST/PORT/USER/PASS.
+
+    Trả về (tên hiển thị, URL proxy) hoặc None nếu proxy bị tắt hay cấu hình không hợp lệ.
+    """
+    if os.getenv(f"{prefix}ENABLED", "0").strip().lower() not in ("1", "true", "yes", "on"):
+        return None
+    proxy_type = os.getenv(f"{prefix}TYPE", "http").strip().lower()
+    host = os.getenv(f"{prefix}HOST", "").strip()
+    port = os.getenv(f"{prefix}PORT", "").strip()
+    if not host or not port.isdigit():
+        print(f"❌ LỖI: {prefix}ENABLED=1 nhưng thiếu {prefix}HOST hoặc {prefix}PORT không hợp lệ, bỏ qua proxy này.")
+        return None
+    if proxy_type not in PROXY_TYPES:
+        print(f"CẢNH BÁO: {prefix}TYPE '{proxy_type}' không hợp lệ, dùng http.")
+        proxy_type = "http"
+    if proxy_type.startswith("socks") and importlib.util.find_spec("socksio") is None:
+        print(f"❌ LỖI: {prefix}TYPE={proxy_type} cần gói socksio (pip install \"httpx[socks]\"), bỏ qua proxy này.")
+        return None
+    user = os.getenv(f"{prefix}USER", "")
+    password = os.getenv(f"{prefix}PASS", "")
+    # User/mật khẩu có thể chứa @, :, / nên phải mã hóa trong URL
+    credentials = f"{quote(user, safe='')}:{quote(password, safe='')}@" if user else ""
+    return f"{prefix.rstrip('_').lower()} ({host}:{port})", f"{proxy_type}://{credentials}{host}:{port}"
+
+PROXY_ROUTES = [proxy for proxy in (read_proxy_config("PROXY_"), read_proxy_config("BACKUP_PROXY_")) if proxy]
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "50"))  # MB
+# File nhỏ hơn ngưỡng này được tải và xử lý hoàn toàn trong bộ nhớ, lớn hơn thì ghi ra đĩa
+IN_MEMORY_MAX_FILE_MB = int(os.getenv("IN_MEMORY_MAX_FILE_MB", "20"))  # MB (0 = luôn dùng đĩa)
+# Engine đọc file xlsx: "openpyxl" hoặc "fast" (đọc thẳng XML trong file zip, nhanh và ít bộ nhớ hơn)
+XLSX_READER_ENGINE = os.getenv("XLSX_READER_ENGINE", "openpyxl").strip().lower()
+
+# Cấu hình process pool cho xử lý Excel (0 = dùng tất cả CPU)
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", "0"))
+PROCESS_JOB_TIMEOUT = int(os.getenv("PROCESS_JOB_TIMEOUT", "120"))  # seconds
+
+# Giới hạn xử lý đồng thời và hàng đợi (mỗi user xử lý lần lượt từng file)
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "50"))
+MAX_USER_QUEUED_JOBS = int(os.getenv("MAX_USER_QUEUED_JOBS", "5"))
+
+# Cache kết quả xử lý theo nội dung file (0 = tắt cache); thư mục này cũng giữ file export gửi gần nhất
+# cho báo cáo định kỳ nên mặc định nằm cạnh script (đường dẫn tương đối tính từ thư mục script), không trong /tmp
+RESULT_CACHE_DIR = os.path.join(current_dir, os.getenv("RESULT_CACHE_DIR", "excel_bot_cache"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "20"))  # MB
+
+# Thời gian giữ các trang kết quả để duyệt bằng nút ◀ ▶
+RESULT_PAGE_TTL = int(os.getenv("RESULT_PAGE_TTL", "3600"))  # giây
+
+# Đo hiệu năng: cổng HTTP cho /metrics (0 = tắt, chỉ nghe trên METRICS_HOST)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Lưu cProfile của N job chậm nhất (0 = tắt; khi bật mọi job đều chạy dưới cProfile)
+PROFILE_SLOWEST_JOBS = int(os.getenv("PROFILE_SLOWEST_JOBS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "excel_bot_profiles"))
+
+# KiotViet Public API (lệnh /kiotviet): client_id/secret lấy trong Thiết lập cửa hàng → Thiết lập
+# kết nối API, KIOTVIET_RETAILER là tên gian hàng. KIOTVIET_USERNAME/PASSWORD là tài khoản đăng nhập
+# web, Public API không dùng được
+KIOTVIET_CLIENT_ID = os.getenv("KIOTVIET_CLIENT_ID", "").strip()
+KIOTVIET_CLIENT_SECRET = os.getenv("KIOTVIET_CLIENT_SECRET", "").strip()
+KIOTVIET_RETAILER = os.getenv("KIOTVIET_RETAILER", "").strip()
+KIOTVIET_API_URL = os.getenv("KIOTVIET_API_URL", "https://public.kiotapi.com").rstrip("/")
+KIOTVIET_TOKEN_URL = os.getenv("KIOTVIET_TOKEN_URL", "https://id.kiotviet.vn/connect/token")
+KIOTVIET_BRANCH_ID = os.getenv("KIOTVIET_BRANCH_ID", "").strip()  # để trống = mọi chi nhánh
+# Bản sao dữ liệu đã đồng bộ và checkpoint, mỗi loại dữ liệu một file JSON (đường dẫn tương đối tính từ
+# thư mục script; mất thư mục này thì lần đồng bộ sau phải tải lại toàn bộ)
+KIOTVIET_SYNC_DIR = os.path.join(current_dir, os.getenv("KIOTVIET_SYNC_DIR", "excel_bot_kiotviet"))
+KIOTVIET_PAGE_SIZE = int(os.getenv("KIOTVIET_PAGE_SIZE", "100"))  # bản ghi mỗi trang, API cho tối đa 100
+KIOTVIET_POOL_SIZE = int(os.getenv("KIOTVIET_POOL_SIZE", "8"))  # số kết nối (số trang tải song song)
+KIOTVIET_RETENTION_DAYS = int(os.getenv("KIOTVIET_RETENTION_DAYS", "35"))  # giữ hóa đơn, phiếu thu chi... bao nhiêu ngày
+
+# Báo cáo định kỳ: dựng sẵn báo cáo vào giờ thấp điểm, lưu vào cache kết quả và gửi cho các chat đã /dangky.
+# Đầu vào là dữ liệu đồng bộ từ KiotViet API nếu đã cấu hình (lệnh /kiotviet sau đó lấy ngay từ cache),
+# nếu không thì là file export gửi gần nhất của từng loại (lưu trong RESULT_CACHE_DIR/inputs).
+# REPORT_SCHEDULES: các giờ chạy những báo cáo trong REPORT_COMMANDS (vd: "19:00,23:30");
+# SCHEDULE_DETAIL: giờ riêng cho từng báo cáo, dạng giờ|báo cáo (vd: "19:10|baocaotonghop,06:00|sanpham").
+# Giờ theo múi giờ của server; chạy trước 12:00 thì dựng báo cáo của ngày hôm trước
+AUTO_REPORTS_ENABLED = os.getenv("AUTO_REPORTS_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+REPORT_SCHEDULES_STR = os.getenv("REPORT_SCHEDULES", os.getenv("SCHEDULE_REPORTS", ""))  # SCHEDULE_REPORTS: tên cũ
+REPORT_COMMANDS_STR = os.getenv("REPORT_COMMANDS", "baocaotonghop,sanpham")
+SCHEDULE_DETAIL_STR = os.getenv("SCHEDULE_DETAIL", "")
+# Danh sách chat nhận báo cáo định kỳ (đường dẫn tương đối tính từ thư mục script)
+REPORT_SUBSCRIBERS_PATH = os.path.join(current_dir, os.getenv("REPORT_SUBSCRIBERS_PATH", "report_subscribers.json"))
+# Tên báo cáo trong REPORT_COMMANDS/SCHEDULE_DETAIL -> lệnh con của /kiotviet
+# (hang_ton_fb, hang_nhap_fb là tên trong cấu hình cũ, báo cáo nay được gửi qua Telegram)
+SCHEDULED_REPORT_NAMES = {
+    "baocao": "baocao", "baocaotonghop": "baocao",
+    "sanpham": "sanpham", "hang_ton": "sanpham", "hang_ton_fb": "sanpham",
+    "dathang": "dathang", "hang_nhap": "dathang", "hang_nhap_fb": "dathang",
+}
+
+def parse_report_time(text):
+    """Giờ dạng HH:MM theo múi giờ của server; None nếu không hợp lệ."""
+    try:
+        value = datetime.strptime(text.strip(), "%H:%M")
+    except ValueError:
+        return None
+    return value.time().replace(tzinfo=datetime.now().astimezone().tzinfo)
+
+# Lỗi cấu hình lịch báo cáo: chỉ ghi log một lần khi đăng ký lịch (process chính),
+# không in ra khi import (mỗi worker của process pool đều import lại module)
+REPORT_SCHEDULE_WARNINGS = []
+
+def parse_report_names(names, setting):
+    kinds = []
+    for name in names:
+        kind = SCHEDULED_REPORT_NAMES.get(name.strip().lower())
+        if kind is None:
+            REPORT_SCHEDULE_WARNINGS.append(f"{setting} có báo cáo không hỗ trợ '{name.strip()}' "
+                                            f"(dùng: {', '.join(SCHEDULED_REPORT_NAMES)}), bỏ qua.")
+        elif kind not in kinds:
+            kinds.append(kind)
+    return kinds
+
+# Logging: LOG_LEVEL cho mọi logger, LOG_LEVELS chỉnh riêng từng logger (vd: "excel_bot.rows=ERROR,httpx=INFO";
+# mặc định httpx=WARNING để không ghi một dòng cho mỗi request tới Bot API)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_LEVELS_STR = os.getenv("LOG_LEVELS", "httpx=WARNING")
+LOG_TO_FILE = os.getenv("LOG_TO_FILE", "0").strip().lower() in ("1", "true", "yes", "on")
+LOG_FILE_PATH = os.path.join(current_dir, os.getenv("LOG_FILE_PATH", "bot_logs.log"))  # đường dẫn tương đối tính từ thư mục script
+LOG_FILE_MAX_MB = int(os.getenv("LOG_FILE_MAX_MB", "10"))  # MB, vượt quá thì xoay vòng sang file .1, .2...
+LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", "5"))  # số file cũ được giữ lại
+# Thông báo lặp lại theo từng dòng dữ liệu: chỉ ghi LOG_SAMPLE_BURST lần đầu mỗi LOG_SAMPLE_WINDOW giây
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "5"))
+LOG_SAMPLE_WINDOW = int(os.getenv("LOG_SAMPLE_WINDOW", "60"))  # seconds
+
+def is_log_level(name):
+    return isinstance(logging.getLevelName(name), int)
+
+# User ID được xem /stats
+ADMIN_USER_ID_STR = os.getenv("ADMIN_USER_ID", "").strip()
+try:
+    ADMIN_USER_ID = int(ADMIN_USER_ID_STR) if ADMIN_USER_ID_STR else None
+except ValueError:
+    print(f"LỖI: ADMIN_USER_ID không hợp lệ ({ADMIN_USER_ID_STR}), lệnh /stats sẽ bị tắt.")
+    ADMIN_USER_ID = None
 
 # Kiểm tra các biến môi trường cần thiết
 if not TELEGRAM_TOKEN:
@@ -76,851 +280,3830 @@ if MAX_RETRIES < 1:
     print("CẢNH BÁO: MAX_RETRIES quá thấp, đặt về 3.")
     MAX_RETRIES = 3
 
+if RETRY_DELAY < 0:
+    print("CẢNH BÁO: RETRY_DELAY không hợp lệ, đặt về 2 giây.")
+    RETRY_DELAY = 2
+
+if RETRY_MAX_DELAY < RETRY_DELAY:
+    print(f"CẢNH BÁO: RETRY_MAX_DELAY nhỏ hơn RETRY_DELAY, đặt bằng {RETRY_DELAY} giây.")
+    RETRY_MAX_DELAY = RETRY_DELAY
+
+if HTTP_POOL_SIZE < 1:
+    print("CẢNH BÁO: HTTP_POOL_SIZE quá thấp, đặt về 32.")
+    HTTP_POOL_SIZE = 32
+
+if HTTP_CONNECT_TIMEOUT < 1:
+    print("CẢNH BÁO: HTTP_CONNECT_TIMEOUT quá thấp, đặt về 10 giây.")
+    HTTP_CONNECT_TIMEOUT = 10
+
+if HTTP_POOL_TIMEOUT < 1:
+    print("CẢNH BÁO: HTTP_POOL_TIMEOUT quá thấp, đặt về 5 giây.")
+    HTTP_POOL_TIMEOUT = 5
+
+if HTTP_KEEPALIVE_EXPIRY < 0:
+    print("CẢNH BÁO: HTTP_KEEPALIVE_EXPIRY không hợp lệ, đặt về 30 giây.")
+    HTTP_KEEPALIVE_EXPIRY = 30
+
+if PROXY_CHECK_INTERVAL < 1:
+    print("CẢNH BÁO: PROXY_CHECK_INTERVAL quá thấp, đặt về 30 giây.")
+    PROXY_CHECK_INTERVAL = 30
+
+if PROXY_MAX_FAILURES < 1:
+    print("CẢNH BÁO: PROXY_MAX_FAILURES quá thấp, đặt về 3.")
+    PROXY_MAX_FAILURES = 3
+
 if MAX_FILE_SIZE_MB > 100:
     print("CẢNH BÁO: MAX_FILE_SIZE_MB quá cao, đặt về 50MB.")
     MAX_FILE_SIZE_MB = 50
 
+if IN_MEMORY_MAX_FILE_MB < 0:
+    print("CẢNH BÁO: IN_MEMORY_MAX_FILE_MB không hợp lệ, đặt về 20MB.")
+    IN_MEMORY_MAX_FILE_MB = 20
+
+if XLSX_READER_ENGINE not in ("openpyxl", "fast"):
+    print(f"CẢNH BÁO: XLSX_READER_ENGINE '{XLSX_READER_ENGINE}' không hợp lệ, dùng openpyxl.")
+    XLSX_READER_ENGINE = "openpyxl"
+
+if PROCESS_POOL_WORKERS < 0:
+    print("CẢNH BÁO: PROCESS_POOL_WORKERS không hợp lệ, dùng tất cả CPU.")
+    PROCESS_POOL_WORKERS = 0
+
+if PROCESS_JOB_TIMEOUT < 10:
+    print("CẢNH BÁO: PROCESS_JOB_TIMEOUT quá thấp, đặt về 120 giây.")
+    PROCESS_JOB_TIMEOUT = 120
+
+if MAX_CONCURRENT_JOBS < 1:
+    print("CẢNH BÁO: MAX_CONCURRENT_JOBS quá thấp, đặt về 4.")
+    MAX_CONCURRENT_JOBS = 4
+
+if MAX_QUEUED_JOBS < 1:
+    print("CẢNH BÁO: MAX_QUEUED_JOBS quá thấp, đặt về 50.")
+    MAX_QUEUED_JOBS = 50
+
+if MAX_USER_QUEUED_JOBS < 1:
+    print("CẢNH BÁO: MAX_USER_QUEUED_JOBS quá thấp, đặt về 5.")
+    MAX_USER_QUEUED_JOBS = 5
+
+if RESULT_CACHE_MAX_MB < 0:
+    print("CẢNH BÁO: RESULT_CACHE_MAX_MB không hợp lệ, đặt về 20MB.")
+    RESULT_CACHE_MAX_MB = 20
+
+if RESULT_PAGE_TTL < 60:
+    print("CẢNH BÁO: RESULT_PAGE_TTL quá thấp, đặt về 3600 giây.")
+    RESULT_PAGE_TTL = 3600
+
+if BOT_MODE not in ("polling", "webhook"):
+    print(f"CẢNH BÁO: BOT_MODE '{BOT_MODE}' không hợp lệ, dùng polling.")
+    BOT_MODE = "polling"
+
+if BOT_MODE == "webhook":
+    if not WEBHOOK_URL:
+        print("❌ LỖI: BOT_MODE=webhook nhưng thiếu WEBHOOK_URL, dùng polling.")
+        BOT_MODE = "polling"
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET_TOKEN):
+        # Telegram gửi secret trong header X-Telegram-Bot-Api-Secret-Token, request sai secret bị từ chối
+        print("CẢNH BÁO: WEBHOOK_SECRET_TOKEN trống hoặc không hợp lệ, tạo secret ngẫu nhiên cho lần chạy này.")
+        WEBHOOK_SECRET_TOKEN = secrets.token_urlsafe(32)
+    if bool(WEBHOOK_CERT) != bool(WEBHOOK_KEY):
+        print("CẢNH BÁO: Cần cả WEBHOOK_CERT và WEBHOOK_KEY để bot tự làm TLS, bỏ qua cả hai.")
+        WEBHOOK_CERT = WEBHOOK_KEY = ""
+
+if not 0 <= METRICS_PORT <= 65535:
+    print("CẢNH BÁO: METRICS_PORT không hợp lệ, tắt endpoint /metrics.")
+    METRICS_PORT = 0
+
+KIOTVIET_ENABLED = bool(KIOTVIET_CLIENT_ID)
+if KIOTVIET_ENABLED and not (KIOTVIET_CLIENT_SECRET and KIOTVIET_RETAILER):
+    print("❌ LỖI: KIOTVIET_CLIENT_ID cần kèm KIOTVIET_CLIENT_SECRET và KIOTVIET_RETAILER, tắt lệnh /kiotviet.")
+    KIOTVIET_ENABLED = False
+
+if not 1 <= KIOTVIET_PAGE_SIZE <= 100:
+    print("CẢNH BÁO: KIOTVIET_PAGE_SIZE phải từ 1 đến 100, đặt về 100.")
+    KIOTVIET_PAGE_SIZE = 100
+
+if KIOTVIET_POOL_SIZE < 1:
+    print("CẢNH BÁO: KIOTVIET_POOL_SIZE quá thấp, đặt về 8.")
+    KIOTVIET_POOL_SIZE = 8
+
+if KIOTVIET_RETENTION_DAYS < 1:
+    print("CẢNH BÁO: KIOTVIET_RETENTION_DAYS quá thấp, đặt về 35 ngày.")
+    KIOTVIET_RETENTION_DAYS = 35
+
+if not is_log_level(LOG_LEVEL):
+    print(f"CẢNH BÁO: LOG_LEVEL '{LOG_LEVEL}' không hợp lệ, dùng INFO.")
+    LOG_LEVEL = "INFO"
+
+LOG_LEVELS = {}
+for item in LOG_LEVELS_STR.split(","):
+    if not item.strip():
+        continue
+    name, _, level = item.partition("=")
+    name, level = name.strip(), level.strip().upper()
+    if not name or not is_log_level(level):
+        print(f"CẢNH BÁO: LOG_LEVELS có mục không hợp lệ '{item.strip()}' (cần dạng tên_logger=LEVEL), bỏ qua.")
+        continue
+    LOG_LEVELS[name] = level
+
+if LOG_FILE_MAX_MB < 1:
+    print("CẢNH BÁO: LOG_FILE_MAX_MB quá thấp, đặt về 10MB.")
+    LOG_FILE_MAX_MB = 10
+
+if LOG_FILE_BACKUPS < 0:
+    print("CẢNH BÁO: LOG_FILE_BACKUPS không hợp lệ, đặt về 5.")
+    LOG_FILE_BACKUPS = 5
+
+if LOG_SAMPLE_BURST < 1:
+    print("CẢNH BÁO: LOG_SAMPLE_BURST quá thấp, đặt về 5.")
+    LOG_SAMPLE_BURST = 5
+
+if LOG_SAMPLE_WINDOW < 1:
+    print("CẢNH BÁO: LOG_SAMPLE_WINDOW quá thấp, đặt về 60 giây.")
+    LOG_SAMPLE_WINDOW = 60
+
+# Giờ chạy -> các báo cáo cần dựng
+REPORT_SCHEDULE = {}
+if AUTO_REPORTS_ENABLED:
+    report_kinds = parse_report_names([name for name in REPORT_COMMANDS_STR.split(",") if name.strip()],
+                                      "REPORT_COMMANDS")
+    for text in filter(str.strip, REPORT_SCHEDULES_STR.split(",")):
+        report_time = parse_report_time(text)
+        if report_time is None:
+            REPORT_SCHEDULE_WARNINGS.append(f"REPORT_SCHEDULES có giờ không hợp lệ '{text.strip()}' (cần HH:MM), bỏ qua.")
+            continue
+        REPORT_SCHEDULE.setdefault(report_time, []).extend(report_kinds)
+    for item in filter(str.strip, SCHEDULE_DETAIL_STR.split(",")):
+        text, _, name = item.partition("|")
+        report_time = parse_report_time(text)
+        if report_time is None or not name.strip():
+            REPORT_SCHEDULE_WARNINGS.append(f"SCHEDULE_DETAIL có mục không hợp lệ '{item.strip()}' (cần HH:MM|báo cáo), bỏ qua.")
+            continue
+        REPORT_SCHEDULE.setdefault(report_time, []).extend(parse_report_names([name], "SCHEDULE_DETAIL"))
+    REPORT_SCHEDULE = {report_time: list(dict.fromkeys(kinds)) for report_time, kinds in REPORT_SCHEDULE.items()
+                       if kinds}
+    if not REPORT_SCHEDULE:
+        REPORT_SCHEDULE_WARNINGS.append("AUTO_REPORTS_ENABLED=1 nhưng REPORT_SCHEDULES/SCHEDULE_DETAIL "
+                                        "không có lịch hợp lệ.")
+
+if PROFILE_SLOWEST_JOBS < 0:
+    print("CẢNH BÁO: PROFILE_SLOWEST_JOBS không hợp lệ, tắt cProfile.")
+    PROFILE_SLOWEST_JOBS = 0
+
+# ============================================================================
+# LOGGING (ghi qua hàng đợi, event loop và vòng lặp xử lý không chờ ghi console/file)
+# ============================================================================
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(processName)s - %(levelname)s - %(message)s'
+
+# Tên cố định để LOG_LEVELS áp dụng được cả trong worker (ở đó module được nạp với tên __mp_main__)
+logger = logging.getLogger("excel_bot")
+# Thông báo lặp lại theo từng dòng dữ liệu (giá trị không hợp lệ...), được lấy mẫu
+row_logger = logging.getLogger("excel_bot.rows")
+
+class RepeatedLogSampler(logging.Filter):
+    """Mỗi mẫu thông báo chỉ cho qua burst bản ghi đầu tiên trong mỗi window giây.
+
+    Mẫu là chuỗi format chưa điền tham số nên "Số lượng không hợp lệ ở dòng %s: %s" của mọi
+    dòng tính là một. Bản ghi đầu tiên của cửa sổ mới kèm số thông báo đã bị bỏ qua trước đó.
+    """
+
+    def __init__(self, burst=LOG_SAMPLE_BURST, window=LOG_SAMPLE_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._lock = threading.Lock()
+        self._windows = {}  # mẫu -> [thời điểm bắt đầu cửa sổ, số đã cho qua, số đã bỏ qua]
+
+    def filter(self, record):
+        with self._lock:
+            state = self._windows.get(record.msg)
+            if state is not None and record.created - state[0] < self.window:
+                if state[1] >= self.burst:
+                    state[2] += 1
+                    return False
+                state[1] += 1
+                return True
+            self._windows[record.msg] = [record.created, 1, 0]
+        if state is not None and state[2] and isinstance(record.args, tuple):
+            record.msg = f"{record.msg} (đã bỏ qua %d thông báo tương tự)"
+            record.args = (*record.args, state[2])
+        return True
+
+row_logger.addFilter(RepeatedLogSampler())
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler trong cùng process: đưa nguyên bản ghi vào hàng đợi, việc điền tham số
+    và format traceback do thread của QueueListener làm.
+
+    Tham số log vì vậy không được sửa sau khi gọi logger (thực tế đều là số, chuỗi, bản sao).
+    """
+
+    def prepare(self, record):
+        return record
+
+_log_handlers = []
+_log_listeners = []
+_worker_log_queue = None
+
+def configure_log_levels():
+    """Áp dụng LOG_LEVEL cho root logger và LOG_LEVELS cho từng logger."""
+    logging.getLogger().setLevel(LOG_LEVEL)
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+
+def setup_logging():
+    """Cấu hình logging cho bot: mọi logger ghi vào hàng đợi, thread QueueListener ghi ra
+    console và file xoay vòng (LOG_TO_FILE). Worker process gửi log về qua hàng đợi riêng
+    (xem _init_worker) để chỉ process chính ghi và xoay vòng file.
+    """
+    global _worker_log_queue
+    if _log_listeners:
+        return
+    formatter = logging.Formatter(LOG_FORMAT)
+    _log_handlers.append(logging.StreamHandler())
+    if LOG_TO_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE_PATH), exist_ok=True)
+        _log_handlers.append(RotatingFileHandler(LOG_FILE_PATH, maxBytes=LOG_FILE_MAX_MB * 1024 * 1024,
+                                                 backupCount=LOG_FILE_BACKUPS, encoding='utf-8'))
+    for handler in _log_handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = SimpleQueue()
+    _worker_log_queue = multiprocessing.get_context("spawn").Queue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    configure_log_levels()
+
+    for source in (log_queue, _worker_log_queue):
+        listener = QueueListener(source, *_log_handlers, respect_handler_level=True)
+        listener.start()
+        _log_listeners.append(listener)
+    atexit.register(stop_logging)
+    if LOG_TO_FILE:
+        logger.info("Ghi log vào %s (tối đa %sMB x %s file)", LOG_FILE_PATH, LOG_FILE_MAX_MB, LOG_FILE_BACKUPS + 1)
+
+def stop_logging():
+    """Ghi nốt các bản ghi còn trong hàng đợi và dừng thread ghi log; log sau đó ghi trực tiếp."""
+    global _worker_log_queue
+    if not _log_listeners:
+        return
+    while _log_listeners:
+        _log_listeners.pop().stop()
+    if _worker_log_queue is not None:
+        _worker_log_queue.close()
+        _worker_log_queue = None
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+    for handler in _log_handlers:
+        root.addHandler(handler)
+
 # ============================================================================
 # EXCEL UTILITIES (từ excel_utils.py)
 # ============================================================================
 
-# Thiết lập logging cho excel utilities
-logger = logging.getLogger(__name__)
-
-def apply_cell_style(cell, font=None, alignment=None, border=None, number_format=None, fill=None):
-    """Áp dụng style cho một ô."""
-    if font:
-        cell.font = font
-    if alignment:
-        cell.alignment = alignment
-    if border:
-        cell.border = border
-    if number_format:
-        cell.number_format = number_format
-    if fill:
-        cell.fill = fill
-
-def auto_adjust_column_width(worksheet):
-    """Tự động điều chỉnh độ rộng của các cột."""
-    for column in worksheet.columns:
-        max_length = 0
-        column_letter = get_column_letter(column[0].column)
-        
-        # Xét độ dài của tiêu đề
-        header_cell = worksheet[f"{column_letter}1"]
-        if header_cell.value:
-            max_length = max(max_length, len(str(header_cell.value)))
-        
-        # Xét độ dài của các ô trong cột
-        for cell in column:
-            try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            except:
-                pass
-        
-        # Điều chỉnh độ rộng cột, cộng thêm 2 để đệm
-        worksheet.column_dimensions[column_letter].width = max_length + 2
+def select_columns(row_iter, column_indices):
+    """Duyệt các dòng của row_iter, trả về tuple giá trị theo column_indices.
 
-def process_excel_file(input_file_path, output_file_path):
-    """Xử lý file Excel đơn và tạo ra báo cáo định dạng."""
-    try:
-        # Tạo styles cho định dạng
-        font_style = Font(name="Calibri", size=12)
-        bold_font = Font(name="Calibri", bold=True, size=12)
-        thin_border = Border(
-            left=Side(style='thin'), 
-            right=Side(style='thin'), 
-            top=Side(style='thin'), 
-            bottom=Side(style='thin')
-        )
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Xử lý file Excel đầu vào
-        workbook = load_workbook(filename=input_file_path, data_only=True)
-        sheet = workbook.active
+    Cột có index None hoặc nằm ngoài dòng (ô trống cuối dòng) trả về None.
+    """
+    indices = tuple(column_indices)
+    present = [i for i in indices if i is not None]
+    if not present:
+        for _ in row_iter:
+            yield (None,) * len(indices)
+        return
 
-        # Tìm vị trí các cột (dựa vào header)
-        header = [cell.value for cell in sheet[1]]
-        
-        # Danh sách lưu các cột thiếu
-        missing_columns = []
-        
-        try:
-            customer_col_index = header.index("Khách hàng")
-        except ValueError:
-            missing_columns.append("Khách hàng")
-            
-        try:
-            total_col_index = header.index("Khách cần trả")
-        except ValueError:
-            missing_columns.append("Khách cần trả")
-            
-        try:
-            paid_col_index = header.index("Khách đã trả")
-        except ValueError:
-            missing_columns.append("Khách đã trả")
-        
-        if missing_columns:
-            raise ValueError(f"File danhsachhoadon thiếu cột cần thiết: {', '.join(missing_columns)}")
+    min_length = max(present) + 1
+    fast_getter = itemgetter(*indices) if len(present) == len(indices) else None
+    single = len(indices) == 1
 
-        # Tạo workbook mới cho kết quả
-        output_workbook = Workbook()
-        output_sheet = output_workbook.active
-        output_sheet.append(["STT", "Tên Khách", "Tổng Tiền", "Tiền mặt", "Chuyển Khoản", "Ship Tuấn", "Ship"])
+    for row in row_iter:
+        if fast_getter is not None and len(row) >= min_length:
+            values = fast_getter(row)
+            yield (values,) if single else values
+        else:
+            row_length = len(row)
+            yield tuple(row[i] if i is not None and i < row_length else None for i in indices)
 
-        # Định dạng header
-        for cell in output_sheet[1]:
-            apply_cell_style(cell, font=bold_font, alignment=center_alignment, border=thin_border)
+class StreamingSheetReader:
+    """Đọc sheet đầu tiên của file Excel theo kiểu streaming (read-only, values-only).
 
-        # Xử lý và thêm dữ liệu
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=2), 2):
-            customer = row[customer_col_index].value
-            total = row[total_col_index].value
-            paid = row[paid_col_index].value
+    Không tạo Cell object cho từng ô nên bộ nhớ không tăng theo kích thước file.
+    source có thể là đường dẫn, file-like hoặc bytes (file đã tải vào bộ nhớ).
+    Dùng như context manager:
 
-            # Kiểm tra kiểu dữ liệu
-            if not isinstance(total, (int, float)) or not isinstance(paid, (int, float)):
-                raise ValueError(f"Dữ liệu không hợp lệ ở dòng {row_idx} (cột 'Khách cần trả' và 'Khách đã trả' phải là số).")
+        with StreamingSheetReader(file_path) as reader:
+            col = reader.header.index("Tên hàng")
+            for (name,) in reader.rows([col]):
+                ...
+    """
 
-            cash = paid if paid > 0 else 0
-            transfer = total - cash if cash == 0 else 0
+    def __init__(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        self.workbook = load_workbook(filename=source, read_only=True, data_only=True)
+        self.sheet = self.workbook.active
+        # Một số file export ghi sai kích thước sheet, bỏ qua để đọc hết dữ liệu
+        self.sheet.reset_dimensions()
+        self._row_iter = self.sheet.iter_rows(values_only=True)
+        first_row = next(self._row_iter, None)
+        self.header = list(first_row) if first_row else []
 
-            # Thêm hàng mới vào sheet
-            output_sheet.append([row_idx - 1, customer, total, cash, transfer, None, None])
-            
-            # Căn giữa và định dạng
-            for col_idx, cell in enumerate(output_sheet[row_idx], 1):
-                apply_cell_style(cell, font=font_style, border=thin_border)
-                if col_idx != 2:  # Bỏ qua cột Tên Khách
-                    cell.alignment = Alignment(horizontal='center')
-
-        # Thêm dòng tổng
-        total_row = output_sheet.max_row + 1
-        output_sheet.cell(row=total_row, column=1, value="Tổng")
-        
-        # Tính tổng cho các cột
-        for col_idx in range(3, 8):
-            col_letter = get_column_letter(col_idx)
-            output_sheet.cell(row=total_row, column=col_idx, value=f"=SUM({col_letter}2:{col_letter}{total_row-1})")
-            
-        # Định dạng dòng tổng
-        for col_idx in range(1, output_sheet.max_column + 1):
-            cell = output_sheet.cell(row=total_row, column=col_idx)
-            apply_cell_style(cell, font=bold_font, border=thin_border)
-            if col_idx > 1:  # Căn giữa tất cả trừ ô đầu tiên (STT)
-                cell.alignment = Alignment(horizontal='center')
-
-        # Định dạng số cho các cột tiền tệ
-        for col_letter in ["C", "D", "E", "F", "G"]:
-            for row in range(2, output_sheet.max_row + 1):
-                apply_cell_style(output_sheet[f"{col_letter}{row}"], number_format="#,##0")
-
-        # Điều chỉnh các thuộc tính format
-        auto_adjust_column_width(output_sheet)
-        
-        # Đặt chiều cao hàng
-        for row in output_sheet.iter_rows():
-            output_sheet.row_dimensions[row[0].row].height = 30
+    def rows(self, column_indices):
+        """Duyệt các dòng dữ liệu (từ dòng 2), trả về tuple giá trị theo column_indices.
 
-        # Thêm filter
-        output_sheet.auto_filter.ref = output_sheet.dimensions
+        Cột có index None hoặc nằm ngoài dòng (ô trống cuối dòng) trả về None.
+        """
+        return select_columns(self._row_iter, column_indices)
 
-        # Lưu file
-        output_workbook.save(output_file_path)
-        return output_file_path
+    def __iter__(self):
+        """Duyệt nguyên dạng các dòng còn lại (tuple; dòng bị bỏ qua trong file là [])."""
+        return self._row_iter
 
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý file Excel: {e}")
-        return None
+    def close(self):
+        self.workbook.close()
 
-def process_multiple_invoice_files(input_file_paths, output_file_path):
-    """Xử lý nhiều file hóa đơn và tạo báo cáo tổng hợp."""
-    try:
-        # Mở file Excel mẫu từ base64
-        excel_template_binary = base64.b64decode(EXCEL_TEMPLATE_BASE64)
-        output_workbook = load_workbook(BytesIO(excel_template_binary))
-        output_sheet = output_workbook.active
+    def __enter__(self):
+        return self
 
-        # Điền ngày, tháng, năm hiện tại
-        now = datetime.now()
-        output_sheet.cell(row=1, column=5, value=now.day)      # Ô E1 (ngày)
-        output_sheet.cell(row=1, column=7, value=now.month)    # Ô G1 (tháng)
-        output_sheet.cell(row=1, column=9, value=now.year)     # Ô I1 (năm)
-
-        row_num = 11  # Bắt đầu ghi từ dòng thứ 11
-        totals = {
-            'khach_can_tra': 0,
-            'khach_da_tra': 0,
-            'gia_tri': 0
-        }
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
-        # Lưu thông tin các cột thiếu từ tất cả files
-        missing_columns_info = []
+_SHEET_NS = "{%s}" % SHEET_MAIN_NS
+_PKG_REL_TAG = "{%s}Relationship" % PKG_REL_NS
 
-        for file_path in input_file_paths:
-            file_missing_info = process_single_file(file_path, output_sheet, row_num, totals)
-            if file_missing_info:
-                missing_columns_info.extend(file_missing_info)
-            # Cập nhật row_num sau khi xử lý file
-            if "row_num" in locals():
-                row_num = locals()["row_num"]
+# Kích thước mỗi khối XML (đã giải nén) được quét một lần
+XML_BATCH_BYTES = 256 * 1024
 
-        # Xóa các dòng trống trong phạm vi từ dòng 11 đến dòng 30
-        deleted_count, total_chi_row = remove_empty_rows(output_sheet, 11, 30)
-        logger.info(f"Đã xóa {deleted_count} dòng trống")
+_XML_ROOT_TAG = re.compile(rb"<(?![?!])([\w.:-]+)[^>]*>")
+_XML_ENCODING = re.compile(rb"""^<\?xml[^>]*encoding=["']([\w.-]+)["']""")
+_XML_MARKUP = re.compile(r"<!--.*?-->|<\?.*?\?>|<!\[CDATA\[(.*?)\]\]>", re.S)
+_XML_ENTITY = re.compile(r"&(#x[0-9A-Fa-f]+|#[0-9]+|amp|lt|gt|quot|apos);")
+_XML_ENTITIES = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'"}
+_CELL_ATTRIBUTE = re.compile(r"""(?:^|\s)([rst])\s*=\s*(["'])(.*?)\2""")
+_ROW_NUMBER = re.compile(r"""(?:^|\s)r\s*=\s*["']([^"']*)""")
 
-        # Ghi giá trị tổng hợp
-        update_summary_values(output_sheet, totals, total_chi_row)
+def _xml_entity(match):
+    name = match.group(1)
+    if name[0] == "#":
+        return chr(int(name[2:], 16) if name[1] == "x" else int(name[1:]))
+    return _XML_ENTITIES[name]
+
+def _xml_text(text):
+    """Giải mã text XML thô giống parser: chuẩn hóa xuống dòng rồi thay entity."""
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if "&" in text:
+        text = _XML_ENTITY.sub(_xml_entity, text)
+    return text
+
+def _xml_markup(match):
+    """Bỏ comment/processing instruction, CDATA chuyển thành text đã escape."""
+    cdata = match.group(1)
+    if cdata is None:
+        return ""
+    return cdata.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _cast_number(value):
+    if "." in value or "E" in value or "e" in value:
+        return float(value)
+    return int(value)
+
+class _SheetPatterns(NamedTuple):
+    """Thẻ và regex SpreadsheetML theo prefix namespace của part (thường là rỗng)."""
+    row_open: str
+    row_close: str
+    cell_open: str
+    value_open: str
+    value_close: str
+    inline_open: str
+    cell: re.Pattern
+    value: re.Pattern
+    inline_string: re.Pattern
+    string_item: re.Pattern
+    text: re.Pattern
+    phonetic: re.Pattern
+
+    def text_content(self, content):
+        """Nội dung <si>/<is>: mọi <t> (trực tiếp hoặc trong run <r>), bỏ phiên âm <rPh> (như openpyxl)."""
+        if not content:
+            return ""
+        if "rPh" in content:
+            content = self.phonetic.sub("", content)
+        return _xml_text("".join(self.text.findall(content)))
 
-        # Lưu file
-        output_workbook.save(output_file_path)
+@lru_cache(maxsize=None)
+def _sheet_patterns(prefix):
+    def element(tag):
+        # <tag .../> hoặc <tag ...>nội dung</tag>; nhóm 1: thuộc tính, nhóm 2: nội dung
+        return re.compile(rf"<{prefix}{tag}\b([^>]*?)(?:/>|>(.*?)</{prefix}{tag}>)", re.S)
 
-        # Trả về cả file path và thông tin missing columns
+    def content(tag):
+        return re.compile(rf"<{prefix}{tag}\b[^>]*?(?:/>|>(.*?)</{prefix}{tag}>)", re.S)
+
+    return _SheetPatterns(
+        row_open=f"<{prefix}row",
+        row_close=f"</{prefix}row>",
+        cell_open=f"<{prefix}c",
+        value_open=f"<{prefix}v>",
+        value_close=f"</{prefix}v>",
+        inline_open=f"<{prefix}is",
+        cell=element("c"),
+        value=content("v"),
+        inline_string=content("is"),
+        string_item=content("si"),
+        text=content("t"),
+        phonetic=content("rPh"),
+    )
+
+class FastSheetReader(StreamingSheetReader):
+    """Đọc sheet đang active trực tiếp từ file xlsx (zip + XML), không qua openpyxl.
+
+    Cùng giao diện và cùng giá trị với StreamingSheetReader (values-only: số ép về int/float,
+    ô định dạng ngày trả về datetime, dòng trống ở giữa trả về []), nhưng:
+    - XML của sheet và sharedStrings được quét theo từng khối bằng regex (chạy trong C),
+      không dựng Element/Cell cho từng ô;
+    - rows(column_indices) chỉ chuyển đổi giá trị các cột được hỏi;
+    - sharedStrings chỉ được đọc tới chỉ số lớn nhất đã dùng.
+    File không phải UTF-8 bị từ chối (ValueError), open_sheet_reader sẽ dùng openpyxl.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        self._archive = zipfile.ZipFile(source)
+        try:
+            workbook_path = self._find_part("_rels/.rels", "/officeDocument") or ARC_WORKBOOK
+            sheet_path, date1904 = self._read_workbook(workbook_path)
+            self._epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+            self._date_styles, self._timedelta_styles = self._read_date_styles(
+                self._workbook_rels.get("/styles"))
+            self._shared_strings = []
+            self._shared_iter = self._iter_shared_strings(self._workbook_rels.get("/sharedStrings"))
+            self._column_cache = {}
+            self._patterns = None
+            self._raw_rows = self._iter_raw_rows(sheet_path)
+            self._row_iter = (self._row_values(content) if content is not None else [] for content in self._raw_rows)
+            first_row = next(self._row_iter, None)
+        except Exception:
+            self._archive.close()
+            raise
+        self.header = list(first_row) if first_row else []
+
+    # ---- Cấu trúc package: workbook, quan hệ giữa các part, styles ----
+
+    @staticmethod
+    def _resolve(base_path, target):
+        if target.startswith("/"):
+            return target[1:]
+        return posixpath.normpath(posixpath.join(posixpath.dirname(base_path), target))
+
+    def _read_rels(self, part_path):
+        """Đọc file .rels của part_path: {Id: (Type, đường dẫn part đích)}."""
+        rels_path = posixpath.join(posixpath.dirname(part_path), "_rels", posixpath.basename(part_path) + ".rels")
+        if rels_path not in self._archive.NameToInfo:
+            return {}
+        root = ElementTree.fromstring(self._archive.read(rels_path))
         return {
-            'file_path': output_file_path,
-            'missing_columns_info': missing_columns_info
+            rel.get("Id"): (rel.get("Type", ""), self._resolve(part_path, rel.get("Target", "")))
+            for rel in root.iter(_PKG_REL_TAG)
         }
 
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý nhiều file: {e}")
+    def _find_part(self, rels_path, type_suffix):
+        root = ElementTree.fromstring(self._archive.read(rels_path))
+        for rel in root.iter(_PKG_REL_TAG):
+            if rel.get("Type", "").endswith(type_suffix):
+                return self._resolve("", rel.get("Target", ""))
         return None
 
-def process_single_file(file_path, output_sheet, row_num, totals):
-    """Xử lý một file đơn trong quá trình tổng hợp nhiều file."""
-    try:
-        workbook = load_workbook(filename=file_path, data_only=True)
-        sheet = workbook.active
-        header = [cell.value for cell in sheet[1]]
-        
-        missing_info = []
-        
-        # Detect file type dựa vào tên file thay vì header để track missing columns
-        file_name = os.path.basename(file_path).lower()
-        
-        if file_name.startswith("danhsachhoadon_"):
-            # File hóa đơn - luôn gọi process_hoa_don_file để track missing columns
-            missing_info = process_hoa_don_file(sheet, header, totals)
-        elif file_name.startswith("soquy_"):
-            # File sổ quỹ - luôn gọi process_thu_chi_file để track missing columns
-            new_row_num, soquy_missing_info = process_thu_chi_file(sheet, header, output_sheet, row_num, totals)
-            # Cập nhật row_num cho lần sử dụng tiếp theo
-            locals()["row_num"] = new_row_num
-            missing_info = soquy_missing_info
-        else:
-            # Fallback: detect bằng header như trước đây
-            if "Khách hàng" in header and "Khách cần trả" in header and "Khách đã trả" in header:
-                missing_info = process_hoa_don_file(sheet, header, totals)
-            elif "Mã phiếu" in header and "Loại thu chi" in header and "Giá trị" in header:
-                new_row_num, soquy_missing_info = process_thu_chi_file(sheet, header, output_sheet, row_num, totals)
-                # Cập nhật row_num cho lần sử dụng tiếp theo
-                locals()["row_num"] = new_row_num
-                missing_info = soquy_missing_info
-            else:
-                logger.warning(f"Bỏ qua file {file_path} do không xác định được loại file.")
-            
-        return missing_info
-        
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý file {file_path}: {e}")
-        return []
+    def _read_workbook(self, workbook_path):
+        """Trả về (đường dẫn sheet đang active, workbook dùng hệ ngày 1904 hay không)."""
+        rels = self._read_rels(workbook_path)
+        # Part dùng chung (styles, sharedStrings) tra theo hậu tố của Type
+        self._workbook_rels = {"/" + rel_type.rsplit("/", 1)[-1]: target for rel_type, target in rels.values()}
 
-def process_hoa_don_file(sheet, header, totals):
-    """Xử lý dữ liệu từ file hóa đơn."""
-    try:
-        # Danh sách lưu các cột thiếu
-        missing_columns = []
-        
-        # Kiểm tra các cột bắt buộc
-        try:
-            customer_col_index = header.index("Khách hàng")
-        except ValueError:
-            missing_columns.append("Khách hàng")
-            
-        try:
-            total_col_index = header.index("Khách cần trả")
-        except ValueError:
-            missing_columns.append("Khách cần trả")
-            
-        try:
-            paid_col_index = header.index("Khách đã trả")
-        except ValueError:
-            missing_columns.append("Khách đã trả")
-        
-        # Nếu thiếu cột bắt buộc, không thể xử lý nhưng vẫn trả về missing info
-        if missing_columns:
-            missing_info = [f"File danhsachhoadon thiếu cột: {', '.join(missing_columns)}"]
-            return missing_info
-        
-        # Xử lý dữ liệu nếu có đủ cột
-        for row in sheet.iter_rows(min_row=2):
-            total_value = row[total_col_index].value
-            paid_value = row[paid_col_index].value
-            
-            totals['khach_can_tra'] += float(total_value) if total_value is not None else 0
-            totals['khach_da_tra'] += float(paid_value) if paid_value is not None else 0
-            
-        return []  # Không có missing columns
-        
-    except ValueError as e:
-        logger.error(f"Lỗi định dạng trong file hóa đơn: {e}")
-        return []
+        root = ElementTree.fromstring(self._archive.read(workbook_path))
+        workbook_pr = root.find(_SHEET_NS + "workbookPr")
+        date1904 = workbook_pr is not None and workbook_pr.get("date1904", "").lower() in ("1", "true")
 
-def process_thu_chi_file(sheet, header, output_sheet, row_num, totals):
-    """Xử lý dữ liệu từ file thu chi."""
-    try:
-        # Tìm các cột bắt buộc
-        column_indices = {
-            'ma_phieu': header.index("Mã phiếu"),
-            'loai_thu_chi': header.index("Loại thu chi"),
-            'nguoi_nop_nhan': header.index("Người nộp/nhận"),
-            'gia_tri': header.index("Giá trị")
-        }
-        
-        # Danh sách lưu các cột thiếu
-        missing_columns = []
-        
-        # Tìm cột "Ghi chú" (optional)
-        try:
-            column_indices['ghi_chu'] = header.index("Ghi chú")
-            logger.info("Đã tìm thấy cột 'Ghi chú' trong file soquy")
-        except ValueError:
-            column_indices['ghi_chu'] = None
-            missing_columns.append("Ghi chú")
-            logger.info("Không tìm thấy cột 'Ghi chú' trong file soquy - sẽ bỏ qua cột này")
-        
-        for row in sheet.iter_rows(min_row=2):
-            ma_phieu = row[column_indices['ma_phieu']].value
-            if ma_phieu is not None:
-                # Ghi dữ liệu vào sheet đầu ra
-                output_sheet.cell(row=row_num, column=2, value=ma_phieu)  # Mã phiếu
-                output_sheet.cell(row=row_num, column=3, value=row[column_indices['loai_thu_chi']].value)  # Nội dung
-                output_sheet.cell(row=row_num, column=5, value=row[column_indices['nguoi_nop_nhan']].value)  # Người nộp
-                
-                # Ghi cột "Ghi chú" nếu có, nếu không thì để trống
-                if column_indices['ghi_chu'] is not None:
-                    output_sheet.cell(row=row_num, column=7, value=row[column_indices['ghi_chu']].value)  # Ghi chú
-                else:
-                    output_sheet.cell(row=row_num, column=7, value="")  # Ghi chú trống
-                
-                output_sheet.cell(row=row_num, column=9, value=row[column_indices['gia_tri']].value)  # Số tiền
-                
-                row_num += 1
-            
-            gia_tri = row[column_indices['gia_tri']].value
-            if gia_tri is not None:
-                totals['gia_tri'] += abs(float(gia_tri))
-        
-        # Tạo thông báo về cột thiếu nếu có
-        missing_info = []
-        if missing_columns:
-            missing_info.append(f"File soquy thiếu cột: {', '.join(missing_columns)}")
-                
-        return row_num, missing_info
-    except ValueError as e:
-        logger.error(f"Lỗi định dạng trong file thu chi: {e}")
-        return row_num, []
+        view = root.find(f"{_SHEET_NS}bookViews/{_SHEET_NS}workbookView")
+        active_tab = int(view.get("activeTab", 0)) if view is not None else 0
+        sheets = root.findall(f"{_SHEET_NS}sheets/{_SHEET_NS}sheet")
+        if not sheets:
+            raise ValueError("File Excel không có sheet nào")
+        sheet = sheets[active_tab] if 0 <= active_tab < len(sheets) else sheets[0]
+        return rels[sheet.get("{%s}id" % REL_NS)][1], date1904
 
-def remove_empty_rows(sheet, start_row, end_row):
-    """Xóa các dòng trống trong phạm vi từ start_row đến dòng trước 'Tổng chi:'.
+    def _read_date_styles(self, styles_path):
+        """Tập style id (cellXfs) có định dạng ngày và định dạng khoảng thời gian."""
+        date_styles, timedelta_styles = set(), set()
+        if not styles_path or styles_path not in self._archive.NameToInfo:
+            return date_styles, timedelta_styles
+        root = ElementTree.fromstring(self._archive.read(styles_path))
+        custom_formats = {
+            int(fmt.get("numFmtId")): fmt.get("formatCode")
+            for fmt in root.iterfind(f"{_SHEET_NS}numFmts/{_SHEET_NS}numFmt")
+        }
+        cell_xfs = root.find(_SHEET_NS + "cellXfs")
+        for style_id, xf in enumerate(cell_xfs if cell_xfs is not None else ()):
+            num_fmt_id = int(xf.get("numFmtId", 0))
+            number_format = custom_formats.get(num_fmt_id) or builtin_format_code(num_fmt_id)
+            if is_date_format(number_format):
+                date_styles.add(str(style_id))
+                if is_timedelta_format(number_format):
+                    timedelta_styles.add(str(style_id))
+        return date_styles, timedelta_styles
 
-    Returns:
-        tuple: (số dòng đã xóa, vị trí dòng 'Tổng chi:' sau khi xóa)
-    """
-    # Tìm dòng "Tổng chi:" trước để không xóa các dòng template
-    # Kiểm tra nhiều cột vì sau khi merge/unmerge text có thể nằm ở C, D, hoặc E
-    total_chi_row_before = None
-    for row_idx in range(start_row, sheet.max_row + 1):
-        # Kiểm tra cột C, D, E để tìm "Tổng chi:"
-        found = False
-        for col_idx in [3, 4, 5]:  # Cột C, D, E
-            cell_value = sheet.cell(row=row_idx, column=col_idx).value
-            if cell_value and "Tổng chi" in str(cell_value):
-                total_chi_row_before = row_idx
-                logger.info(f"Tìm thấy dòng 'Tổng chi:' tại dòng {total_chi_row_before} cột {col_idx} (trước khi xóa)")
-                found = True
-                break
-        if found:
-            break
+    # ---- Đọc XML theo khối ----
 
-    # Nếu tìm thấy "Tổng chi:", chỉ xóa từ start_row đến trước dòng đó
-    if total_chi_row_before:
-        end_row = total_chi_row_before - 1
-        logger.info(f"Sẽ xóa dòng trống từ {start_row} đến {end_row}")
+    def _iter_xml_batches(self, part_path, container, item):
+        """Sinh (patterns, khối text) chứa trọn vẹn các phần tử <item> bên trong <container>.
 
-    # Duyệt từ dưới lên trên để không bị lỗi index khi xóa
-    rows_to_delete = []
+        Dữ liệu được giải nén từng XML_BATCH_BYTES và cắt ngay sau thẻ đóng </item> cuối cùng,
+        nên không bao giờ giữ cả part trong bộ nhớ.
+        """
+        with self._archive.open(part_path) as source:
+            buffer = b""
+            container_tag = re.compile(rb"<([\w.-]+:)?%s\b[^>]*?(/?)>" % container)
+            while True:
+                chunk = source.read(XML_BATCH_BYTES)
+                buffer += chunk
+                match = container_tag.search(buffer)
+                if match or not chunk:
+                    break
 
-    for row_idx in range(start_row, end_row + 1):
-        # Kiểm tra xem dòng có dữ liệu không (kiểm tra các cột B, C, E, G, I)
-        has_data = False
-        for col_idx in [2, 3, 5, 7, 9]:  # Cột B, C, E, G, I
-            cell_value = sheet.cell(row=row_idx, column=col_idx).value
-            if cell_value is not None and str(cell_value).strip() != "":
-                has_data = True
-                break
+            declared = _XML_ENCODING.match(buffer.lstrip(b"\xef\xbb\xbf"))
+            if buffer[:2] in (b"\xff\xfe", b"\xfe\xff") or \
+                    (declared and declared.group(1).lower() not in (b"utf-8", b"utf8")):
+                raise ValueError(f"{part_path} không dùng mã hóa UTF-8")
+            if not match or match.group(2):  # không có hoặc container rỗng (<sheetData/>)
+                return
 
-        if not has_data:
-            rows_to_delete.append(row_idx)
+            prefix = (match.group(1) or b"").decode("ascii")
+            patterns = _sheet_patterns(prefix)
+            item_end = b"</%s%s>" % (match.group(1) or b"", item)
+            container_end = b"</%s%s>" % (match.group(1) or b"", container)
 
-    # Xóa các dòng từ dưới lên trên
-    deleted_count = 0
-    for row_idx in reversed(rows_to_delete):
-        sheet.delete_rows(row_idx, 1)
-        deleted_count += 1
-        logger.info(f"Đã xóa dòng trống: {row_idx}")
+            buffer = buffer[match.end():]
+            finished = False
+            while not finished:
+                chunk = source.read(XML_BATCH_BYTES)
+                if chunk:
+                    buffer += chunk
+                    cut = buffer.rfind(item_end)
+                    if cut < 0 or len(buffer) < XML_BATCH_BYTES:
+                        continue
+                    cut += len(item_end)
+                    batch, buffer = buffer[:cut], buffer[cut:]
+                else:
+                    # Hết file: phần còn lại trước thẻ đóng container (có thể là các item tự đóng)
+                    end = buffer.find(container_end)
+                    batch = buffer[:end] if end >= 0 else buffer
+                    finished = True
+                text = batch.decode("utf-8")
+                if "<!" in text or "<?" in text:
+                    text = _XML_MARKUP.sub(_xml_markup, text)
+                yield patterns, text
 
-    # Tính vị trí mới của dòng "Tổng chi:" sau khi xóa
-    total_chi_row_after = None
-    if total_chi_row_before:
-        total_chi_row_after = total_chi_row_before - deleted_count
-        logger.info(f"Vị trí dòng 'Tổng chi:' sau khi xóa: {total_chi_row_after}")
+    def _iter_shared_strings(self, strings_path):
+        if not strings_path or strings_path not in self._archive.NameToInfo:
+            return
+        for patterns, batch in self._iter_xml_batches(strings_path, b"sst", b"si"):
+            for content in patterns.string_item.findall(batch):
+                yield patterns.text_content(content).replace("x005F_", "")
 
-    return deleted_count, total_chi_row_after
+    def _shared_string(self, index):
+        strings = self._shared_strings
+        while index >= len(strings):
+            text = next(self._shared_iter, None)
+            if text is None:
+                raise IndexError(f"Shared string {index} không tồn tại")
+            strings.append(text)
+        return strings[index]
 
-def update_summary_values(sheet, totals, total_chi_row=None):
-    """Cập nhật các giá trị tổng hợp vào file báo cáo.
+    # ---- Dòng và ô ----
 
-    Args:
-        sheet: Excel worksheet
-        totals: Dictionary chứa các tổng
-        total_chi_row: Vị trí dòng 'Tổng chi:' (sau khi xóa dòng trống)
-    """
-    sheet.cell(row=3, column=3, value=totals['khach_can_tra'])  # Doanh thu
-    sheet.cell(row=4, column=3, value=totals['khach_da_tra'])  # Tiền mặt
-    sheet.cell(row=5, column=3, value=totals['khach_can_tra'] - totals['khach_da_tra'])  # Chuyển khoản
+    def _iter_raw_rows(self, sheet_path):
+        """Sinh nội dung thô (phần XML giữa <row> và </row>) từng dòng theo thứ tự như openpyxl read-only.
 
-    if total_chi_row:
-        # Cập nhật công thức tổng chi tại cột I
-        sheet.cell(row=total_chi_row, column=9, value=f"=SUM(I11:I{total_chi_row-1})*-1")
-        logger.info(f"Đã cập nhật công thức I{total_chi_row} = SUM(I11:I{total_chi_row-1})*-1")
+        Dòng bị bỏ qua trong file sinh None (openpyxl trả về []), dòng có số thứ tự
+        nhỏ hơn dòng đã đọc (trùng/lùi) bị bỏ qua.
+        """
+        counter = 1
+        for patterns, batch in self._iter_xml_batches(sheet_path, b"sheetData", b"row"):
+            self._patterns = patterns
+            row_open, tag_length = patterns.row_open, len(patterns.row_open)
+            # Mỗi đoạn kết thúc bởi </row>: có thể có vài <row .../> tự đóng rồi mới tới dòng có ô
+            for piece in batch.split(patterns.row_close):
+                start = piece.find(row_open)
+                while start >= 0:
+                    end = piece.find(">", start)
+                    row_attributes = piece[start + tag_length:end]
+                    self_closing = row_attributes.endswith("/")
+                    content = "" if self_closing else piece[end + 1:]
 
-        # Cập nhật C7 (Phiếu chi) tham chiếu đến I(dòng Tổng chi)
-        sheet.cell(row=7, column=3, value=f"=I{total_chi_row}")
-        logger.info(f"Đã cập nhật C7 = I{total_chi_row}")
+                    row_attr = _ROW_NUMBER.search(row_attributes)
+                    row_number = int(float(row_attr.group(1))) if row_attr else counter
+                    while counter < row_number:
+                        counter += 1
+                        yield None
+                    if counter <= row_number:
+                        counter += 1
+                        yield content
 
-        # Unmerge các cells cũ trước (nếu có) để tránh conflict
-        try:
-            # Thử unmerge từng vùng có thể bị merge
-            for start_col in range(3, 9):  # C đến H
-                for end_col in range(start_col, 9):
-                    try:
-                        sheet.unmerge_cells(start_row=total_chi_row, start_column=start_col,
-                                          end_row=total_chi_row, end_column=end_col)
-                    except:
-                        pass
-        except:
-            pass
+                    start = piece.find(row_open, end) if self_closing else -1
 
-        # Merge cells cho dòng "Tổng chi:" từ C đến H (CDEFGH)
-        sheet.merge_cells(start_row=total_chi_row, start_column=3, end_row=total_chi_row, end_column=8)
-        logger.info(f"Đã merge cells C{total_chi_row}:H{total_chi_row} cho 'Tổng chi:'")
-    else:
-        # Fallback: không tìm thấy "Tổng chi:"
-        logger.warning("Không tìm thấy dòng 'Tổng chi:', sử dụng giá trị mặc định")
-        sheet.cell(row=7, column=3, value=f"=I31")
-        sheet.cell(row=31, column=9, value=f"=SUM(I11:I30)*-1")
+    def _split_cells(self, content):
+        """Tách nội dung dòng thành các đoạn XML của từng ô (bỏ "<c" ở đầu)."""
+        if not content:
+            return []
+        patterns = self._patterns
+        if patterns.inline_open in content:
+            # Rich text trong inline string có thẻ như <color>, không tách theo "<c" được
+            return [match.group(0)[len(patterns.cell_open):] for match in patterns.cell.finditer(content)]
+        return content.split(patterns.cell_open)[1:]
 
-    # Tồn quỹ = Tiền mặt - Phiếu chi
-    sheet.cell(row=8, column=3, value="=C4-C7")
+    @staticmethod
+    def _cell_parts(cell):
+        """(thuộc tính, nội dung) của một đoạn ô; ô tự đóng <c .../> có nội dung None."""
+        end = cell.find(">")
+        attributes = {name: value for name, _, value in _CELL_ATTRIBUTE.findall(cell, 0, end)}
+        return attributes, (None if cell[end - 1] == "/" else cell[end + 1:])
 
-    # Tìm dòng "Số tiền bàn giao:" để cập nhật tồn quỹ
-    # Dòng này thường nằm sau dòng "Tổng chi:" 2 dòng (sau khi xóa có thể là 1-2 dòng)
-    search_start = total_chi_row + 1 if total_chi_row else 11
+    def _column(self, coordinate):
+        letters = coordinate.rstrip("0123456789")
+        column = self._column_cache.get(letters)
+        if column is None:
+            column = self._column_cache[letters] = column_index_from_string(letters)
+        return column
 
-    found_ban_giao = False
-    for row_idx in range(search_start, min(search_start + 10, sheet.max_row + 1)):
-        # Kiểm tra nhiều cột vì merge cells: A, B, C, D, E
-        for col_idx in [1, 2, 3, 4, 5]:  # Cột A, B, C, D, E
-            cell_value = sheet.cell(row=row_idx, column=col_idx).value
+    def _cell_columns(self, cells):
+        """Danh sách (cột, thuộc tính, nội dung) của một dòng; ô không có tọa độ lấy cột kế tiếp."""
+        columns = []
+        column = 0
+        for cell in cells:
+            attributes, content = self._cell_parts(cell)
+            coordinate = attributes.get("r")
+            column = self._column(coordinate) if coordinate else column + 1
+            columns.append((column, attributes, content))
+        return columns
 
-            # Tìm "Số tiền bàn giao:" (có dấu)
-            if cell_value and "Số tiền bàn giao" in str(cell_value):
-                # Ghi giá trị =C8 vào cột C
-                sheet.cell(row=row_idx, column=3, value=f"=C8")
+    def _cell_value(self, attributes, content):
+        if not content:
+            return None
+        data_type = attributes.get("t", "n")
+        patterns = self._patterns
+        if data_type == "inlineStr":
+            match = patterns.inline_string.search(content)
+            return patterns.text_content(match.group(1)) if match else None
 
-                # Unmerge các cells cũ trước (nếu có) để tránh conflict
+        start = content.find(patterns.value_open)
+        if start >= 0:
+            start += len(patterns.value_open)
+            value = content[start:content.find(patterns.value_close, start)]
+        else:
+            # <v> có thuộc tính hoặc tự đóng
+            match = patterns.value.search(content)
+            value = match.group(1) if match else None
+        if not value:
+            return None
+        if data_type == "n":
+            value = _cast_number(value)
+            style_id = attributes.get("s")
+            if style_id in self._date_styles:
                 try:
-                    # Thử unmerge từng vùng có thể bị merge
-                    for start_col in range(3, 10):  # C đến I
-                        for end_col in range(start_col, 10):
-                            try:
-                                sheet.unmerge_cells(start_row=row_idx, start_column=start_col,
-                                                  end_row=row_idx, end_column=end_col)
-                            except:
-                                pass
-                except:
-                    pass
-
-                # Merge cells cho ô giá trị từ C đến I (CDEFGHI)
-                # Cột B (text "Số tiền bàn giao:") không merge
-                sheet.merge_cells(start_row=row_idx, start_column=3, end_row=row_idx, end_column=9)
-                logger.info(f"Đã cập nhật dòng {row_idx} 'Số tiền bàn giao:' = C8 và merge C{row_idx}:I{row_idx}")
-
-                found_ban_giao = True
-                break
-        if found_ban_giao:
-            break
+                    return from_excel(value, self._epoch, timedelta=style_id in self._timedelta_styles)
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return value
+        if data_type == "s":
+            return self._shared_string(int(value))
+        if data_type == "b":
+            return bool(int(value))
+        if data_type == "d":
+            return from_ISO8601(value)
+        return _xml_text(value)  # "str" (kết quả công thức dạng chuỗi), "e" (lỗi như #DIV/0!)
 
-    if not found_ban_giao:
-        logger.warning(f"Không tìm thấy dòng 'Số tiền bàn giao:' sau dòng Tổng chi")
+    def _row_values(self, content):
+        columns = self._cell_columns(self._split_cells(content))
+        if not columns:
+            return ()
+        values = [None] * columns[-1][0]
+        for column, attributes, cell_content in columns:
+            values[column - 1] = self._cell_value(attributes, cell_content)
+        return tuple(values)
 
-def process_product_file(input_file_path):
-    """Xử lý file sản phẩm và trả về danh sách sản phẩm theo nhóm."""
+    def rows(self, column_indices):
+        """Như StreamingSheetReader.rows, nhưng chỉ chuyển đổi các ô thuộc column_indices."""
+        indices = tuple(column_indices)
+        empty = (None,) * len(indices)
+        cell_value, cell_parts = self._cell_value, self._cell_parts
+        for content in self._raw_rows:
+            cells = self._split_cells(content)
+            if not cells:
+                yield empty
+                continue
+
+            # Dòng liền (ô cuối ở cột len(cells), file export thường như vậy): lấy ô theo vị trí
+            width = len(cells)
+            coordinate = cell_parts(cells[-1])[0].get("r")
+            if coordinate and self._column(coordinate) == width:
+                yield tuple(cell_value(*cell_parts(cells[i])) if i is not None and i < width else None
+                            for i in indices)
+                continue
+
+            columns = self._cell_columns(cells)
+            width = columns[-1][0]
+            by_column = {column: (attributes, cell_content) for column, attributes, cell_content in columns}
+            values = []
+            for i in indices:
+                cell = by_column.get(i + 1) if i is not None and i < width else None
+                values.append(cell_value(*cell) if cell is not None else None)
+            yield tuple(values)
+
+    def close(self):
+        self._raw_rows.close()
+        self._shared_iter.close()
+        self._archive.close()
+
+class RecordReader:
+    """Dữ liệu dạng bảng không đến từ file Excel (vd: KiotViet API), cùng giao diện với StreamingSheetReader
+    (header, rows(column_indices), duyệt từng dòng, context manager).
+
+    Picklable nên truyền thẳng được cho các hàm process_* chạy trong process pool thay cho
+    đường dẫn/bytes của file (open_sheet_reader trả về nguyên reader).
+    """
+
+    def __init__(self, header, rows):
+        self.header = list(header)
+        self.records = list(rows)
+        self._row_iter = iter(self.records)
+
+    def rows(self, column_indices):
+        """Duyệt các bản ghi còn lại, trả về tuple giá trị theo column_indices (như StreamingSheetReader.rows)."""
+        return select_columns(self._row_iter, column_indices)
+
+    def __iter__(self):
+        return self._row_iter
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+# Engine đọc file Excel: "openpyxl" (mặc định) hoặc "fast" (FastSheetReader)
+SHEET_READER_ENGINES = {
+    "openpyxl": StreamingSheetReader,
+    "fast": FastSheetReader,
+}
+
+def open_sheet_reader(source, engine=None):
+    """Mở sheet reader theo engine (None = XLSX_READER_ENGINE).
+
+    Nếu engine "fast" không đọc được cấu trúc file, tự chuyển sang openpyxl.
+    source đã là reader (RecordReader) thì được trả về nguyên.
+    """
+    if isinstance(source, (RecordReader, StreamingSheetReader)):
+        # Dữ liệu đã ở dạng reader (vd: RecordReader từ KiotViet API)
+        return source
+    engine = engine or XLSX_READER_ENGINE
+    reader_class = SHEET_READER_ENGINES.get(engine)
+    if reader_class is None:
+        raise ValueError(f"Engine đọc Excel không hợp lệ: {engine}")
+    if reader_class is StreamingSheetReader:
+        return reader_class(source)
     try:
-        workbook = load_workbook(filename=input_file_path, data_only=True)
-        sheet = workbook.active
-        
-        result = extract_product_data(sheet)
-        return format_product_data(result)
-        
+        return reader_class(source)
+    except (KeyError, IndexError, ValueError, ElementTree.ParseError) as e:
+        logger.warning("Engine '%s' không đọc được file (%s), chuyển sang openpyxl", engine, e)
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return StreamingSheetReader(source)
+
+class ColumnSpec(NamedTuple):
+    """Khai báo một cột trong file export."""
+    key: str                          # Khóa dùng trong code
+    name: str                         # Tên cột chuẩn (dùng trong thông báo thiếu cột)
+    required: bool = True
+    aliases: Tuple[str, ...] = ()     # Các tên khác của cột
+    fuzzy: bool = False               # Cho phép khớp khi tên cột chứa name/alias
+
+class HeaderMapping(NamedTuple):
+    """Kết quả nhận diện header: vị trí từng cột và các cột thiếu."""
+    indices: dict                     # key -> index cột (None nếu không có)
+    missing_required: Tuple[str, ...]
+    missing_optional: Tuple[str, ...]
+
+    def columns(self, keys):
+        """Danh sách index cột theo thứ tự keys (dùng cho StreamingSheetReader.rows)."""
+        return [self.indices[key] for key in keys]
+
+def normalize_header(value):
+    """Chuẩn hóa tên cột để so khớp: NFC, bỏ khoảng trắng thừa, chữ thường."""
+    if value is None:
+        return ""
+    return " ".join(unicodedata.normalize("NFC", str(value)).split()).lower()
+
+# Bảng chữ cái tiếng Việt (kèm f, j, w, z cho tên nước ngoài) theo thứ tự sắp xếp
+_VI_ALPHABET = "aăâbcdđeêfghijklmnoôơpqrstuưvwxyz"
+# Chữ cái -> ký tự trọng số (vùng private use, luôn đứng sau chữ số và dấu câu)
+_VI_LETTER_WEIGHTS = {ord(letter): chr(0xE000 + idx) for idx, letter in enumerate(_VI_ALPHABET)}
+# Thanh điệu theo thứ tự từ điển: ngang < huyền < hỏi < ngã < sắc < nặng
+_VI_TONE_MARKS = "\u0300\u0309\u0303\u0301\u0323"
+_VI_TONE_WEIGHTS = {ord(mark): chr(idx) for idx, mark in enumerate(_VI_TONE_MARKS, 1)}
+_VI_STRIP_TONES = {ord(mark): None for mark in _VI_TONE_MARKS}
+_VI_NON_TONE_PATTERN = re.compile(f"[^{_VI_TONE_MARKS}]")
+
+@lru_cache(maxsize=65536)
+def _vietnamese_word_key(word):
+    """(chữ cái, thanh điệu) của một từ; tên sản phẩm dùng lại rất nhiều từ giống nhau."""
+    decomposed = unicodedata.normalize("NFD", word.lower())
+    # Bỏ thanh điệu rồi ghép lại để giữ ă, â, ê, ô, ơ, ư là chữ cái riêng
+    letters = unicodedata.normalize("NFC", decomposed.translate(_VI_STRIP_TONES))
+    # Mỗi ký tự gốc -> "\0", thanh điệu -> trọng số ngay sau ký tự mang dấu
+    tones = _VI_NON_TONE_PATTERN.sub("\0", decomposed).translate(_VI_TONE_WEIGHTS)
+    return letters.translate(_VI_LETTER_WEIGHTS), tones
+
+@lru_cache(maxsize=65536)
+def vietnamese_sort_key(text):
+    """Khóa sắp xếp theo thứ tự tiếng Việt, không phụ thuộc locale của hệ thống.
+
+    So sánh lần lượt: chữ cái (a < ă < â < b ... d < đ ...), rồi thanh điệu,
+    rồi chuỗi gốc (phân biệt hoa thường) để thứ tự luôn xác định.
+    Khóa được cache theo từng chuỗi (và từng từ) nên mỗi tên chỉ tính một lần.
+    """
+    word_keys = [_vietnamese_word_key(word) for word in text.split(" ")]
+    primary = " ".join([letters for letters, _ in word_keys])
+    tones = "\0".join([word_tones for _, word_tones in word_keys])
+    return primary, tones, text
+
+class HeaderSchema:
+    """Schema cột của một loại file export, biên dịch sẵn thành bảng tra đã chuẩn hóa.
+
+    Header được nhận diện trong một lượt duyệt: khớp chính xác (sau chuẩn hóa) được
+    ưu tiên, sau đó mới đến khớp chứa chuỗi với các cột fuzzy. Kết quả được cache theo
+    chữ ký header nên các file export cùng layout không phải nhận diện lại.
+    """
+
+    CACHE_SIZE = 32
+
+    def __init__(self, file_label, columns):
+        self.file_label = file_label
+        self.columns = tuple(columns)
+        self._exact = {}
+        self._fuzzy = []
+        for spec in self.columns:
+            for alias in (spec.name,) + spec.aliases:
+                self._exact.setdefault(normalize_header(alias), spec.key)
+                if spec.fuzzy:
+                    self._fuzzy.append((normalize_header(alias), spec.key))
+        self._cache = {}
+
+    def resolve(self, header):
+        """Trả về HeaderMapping cho header (list giá trị dòng đầu)."""
+        signature = tuple(header)
+        mapping = self._cache.get(signature)
+        if mapping is None:
+            mapping = self._resolve(signature)
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[signature] = mapping
+        return mapping
+
+    def _resolve(self, header):
+        exact = {}
+        fuzzy = {}
+        for col_idx, value in enumerate(header):
+            name = normalize_header(value)
+            if not name:
+                continue
+            key = self._exact.get(name)
+            if key is not None:
+                exact.setdefault(key, col_idx)
+                continue
+            for pattern, key in self._fuzzy:
+                if pattern in name:
+                    fuzzy.setdefault(key, col_idx)
+
+        indices = {}
+        missing_required = []
+        missing_optional = []
+        for spec in self.columns:
+            col_idx = exact.get(spec.key, fuzzy.get(spec.key))
+            indices[spec.key] = col_idx
+            if col_idx is None:
+                (missing_required if spec.required else missing_optional).append(spec.name)
+            elif spec.key not in exact:
+                logger.debug("Đã tìm thấy cột %s (tìm mờ) tại vị trí %s: %s",
+                            spec.name, col_idx, header[col_idx])
+
+        logger.debug("Đã nhận diện header file %s: %s", self.file_label,
+                    {key: idx for key, idx in indices.items() if idx is not None})
+        return HeaderMapping(indices, tuple(missing_required), tuple(missing_optional))
+
+# Schema các file export từ KiotViet
+INVOICE_SCHEMA = HeaderSchema("danhsachhoadon", [
+    ColumnSpec("customer", "Khách hàng"),
+    ColumnSpec("total", "Khách cần trả"),
+    ColumnSpec("paid", "Khách đã trả"),
+])
+
+SOQUY_SCHEMA = HeaderSchema("soquy", [
+    ColumnSpec("ma_phieu", "Mã phiếu"),
+    ColumnSpec("loai_thu_chi", "Loại thu chi"),
+    ColumnSpec("nguoi_nop_nhan", "Người nộp/nhận"),
+    ColumnSpec("gia_tri", "Giá trị"),
+    ColumnSpec("ghi_chu", "Ghi chú", required=False),
+])
+
+PRODUCT_SCHEMA = HeaderSchema("danhsachsanpham", [
+    ColumnSpec("group", "Nhóm hàng(3 Cấp)", aliases=("Nhóm hàng (3 Cấp)",)),
+    ColumnSpec("name", "Tên hàng"),
+    ColumnSpec("stock", "Tồn kho"),
+    ColumnSpec("unit_cost", "Giá vốn", required=False, fuzzy=True),
+])
+
+PURCHASE_ORDER_SCHEMA = HeaderSchema("danhsachchitietdathang", [
+    ColumnSpec("supplier", "Tên nhà cung cấp", fuzzy=True),
+    ColumnSpec("name", "Tên hàng", fuzzy=True),
+    ColumnSpec("quantity", "Số lượng", fuzzy=True),
+    ColumnSpec("unit_price", "Giá nhập", required=False, fuzzy=True),
+])
+
+class StreamingReportWriter:
+    """Ghi báo cáo Excel ở chế độ write-only với named styles dùng chung.
+
+    Mỗi dòng được giữ dưới dạng tuple giá trị + tên style (không tạo Cell object),
+    độ rộng cột được tính dần khi append; dòng tổng dùng công thức SUM. Khi save,
+    named styles được đăng ký một lần và các dòng được ghi thẳng ra file trong một lượt.
+    """
+
+    def __init__(self, named_styles, row_height=None):
+        self.named_styles = named_styles
+        self.row_height = row_height
+        self.column_widths = []
+        self._rows = []
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    def append(self, values, styles=None):
+        """Thêm một dòng; styles là tuple tên named style cho từng cột (None = không style)."""
+        values = tuple(values)
+        widths = self.column_widths
+        if len(widths) < len(values):
+            widths.extend([0] * (len(values) - len(widths)))
+
+        for col_idx, value in enumerate(values):
+            if value:
+                length = len(str(value))
+                if length > widths[col_idx]:
+                    widths[col_idx] = length
+
+        self._rows.append((values, styles))
+
+    def append_total_row(self, label, sum_columns, styles=None):
+        """Thêm dòng tổng với công thức SUM cho các cột sum_columns (index từ 1)."""
+        total_row = self.row_count + 1
+        values = [label] + [None] * (len(self.column_widths) - 1)
+        for col_idx in sum_columns:
+            col_letter = get_column_letter(col_idx)
+            values[col_idx - 1] = f"=SUM({col_letter}2:{col_letter}{total_row - 1})"
+        self.append(values, styles)
+
+    def save(self, output_file_path, auto_filter=True):
+        """Ghi toàn bộ các dòng ra file (hoặc file-like) ở chế độ write-only."""
+        workbook = Workbook(write_only=True)
+        for style in self.named_styles:
+            workbook.add_named_style(style)
+        sheet = workbook.create_sheet()
+
+        # Độ rộng cột phải được đặt trước khi ghi dòng đầu tiên
+        for col_idx, width in enumerate(self.column_widths, 1):
+            sheet.column_dimensions[get_column_letter(col_idx)].width = width + 2
+
+        for row_idx, (values, styles) in enumerate(self._rows, 1):
+            if styles is None:
+                row = values
+            else:
+                row = []
+                for value, style in zip(values, styles):
+                    if style is None:
+                        row.append(value)
+                        continue
+                    cell = WriteOnlyCell(sheet, value=value)
+                    cell.style = style
+                    row.append(cell)
+
+            if self.row_height is not None:
+                sheet.row_dimensions[row_idx].height = self.row_height
+            sheet.append(row)
+            # Dòng đã được ghi ra stream, không cần giữ dimension trong bộ nhớ
+            sheet.row_dimensions.pop(row_idx, None)
+
+        if auto_filter and self._rows:
+            last_col = get_column_letter(max(len(self.column_widths), 1))
+            sheet.auto_filter.ref = f"A1:{last_col}{len(self._rows)}"
+
+        workbook.save(output_file_path)
+        return output_file_path
+
+def save_report_output(save, output_file_path):
+    """Lưu báo cáo bằng hàm save(target).
+
+    Nếu output_file_path là None, báo cáo được ghi vào bộ nhớ và trả về dạng bytes
+    (picklable, trả được từ worker process); ngược lại trả về output_file_path.
+    """
+    if output_file_path is not None:
+        save(output_file_path)
+        return output_file_path
+    buffer = BytesIO()
+    save(buffer)
+    return buffer.getvalue()
+
+def report_result(output, missing_columns_info):
+    """Tạo dict kết quả báo cáo từ giá trị trả về của save_report_output."""
+    return {
+        'file_path': output if isinstance(output, str) else None,
+        'file_data': output if isinstance(output, bytes) else None,
+        'missing_columns_info': missing_columns_info
+    }
+
+def open_report_document(result):
+    """Mở file kết quả để gửi lên Telegram (BytesIO nếu nằm trong bộ nhớ), None nếu không có."""
+    if not result:
+        return None
+    if result.get('file_data') is not None:
+        return BytesIO(result['file_data'])
+    if result.get('file_path'):
+        return open(result['file_path'], 'rb')
+    return None
+
+def _invoice_report_styles():
+    """Tạo các named style cho báo cáo danh sách hóa đơn (đăng ký một lần mỗi workbook)."""
+    font_style = Font(name="Calibri", size=12)
+    bold_font = Font(name="Calibri", bold=True, size=12)
+    thin_border = Border(
+        left=Side(style='thin'), 
+        right=Side(style='thin'), 
+        top=Side(style='thin'), 
+        bottom=Side(style='thin')
+    )
+    center = Alignment(horizontal='center')
+
+    return [
+        NamedStyle(name="hd_header", font=bold_font, border=thin_border,
+                   alignment=Alignment(horizontal='center', vertical='center')),
+        NamedStyle(name="hd_text", font=font_style, border=thin_border),
+        NamedStyle(name="hd_center", font=font_style, border=thin_border, alignment=center),
+        NamedStyle(name="hd_number", font=font_style, border=thin_border, alignment=center,
+                   number_format="#,##0"),
+        NamedStyle(name="hd_total_label", font=bold_font, border=thin_border),
+        NamedStyle(name="hd_total_center", font=bold_font, border=thin_border, alignment=center),
+        NamedStyle(name="hd_total_number", font=bold_font, border=thin_border, alignment=center,
+                   number_format="#,##0"),
+    ]
+
+# Style cho từng cột: STT, Tên Khách, Tổng Tiền, Tiền mặt, Chuyển Khoản, Ship Tuấn, Ship
+INVOICE_HEADER_STYLES = ("hd_header",) * 7
+INVOICE_ROW_STYLES = ("hd_center", "hd_text") + ("hd_number",) * 5
+INVOICE_TOTAL_STYLES = ("hd_total_label", "hd_total_center") + ("hd_total_number",) * 5
+
+def process_excel_file(input_file_path, output_file_path, engine=None):
+    """Xử lý file Excel đơn và tạo ra báo cáo định dạng.
+
+    input_file_path có thể là đường dẫn hoặc bytes; nếu output_file_path là None,
+    báo cáo được trả về dạng bytes thay vì ghi ra đĩa. engine: xem open_sheet_reader.
+    """
+    try:
+        timer = StageTimer()
+
+        # Xử lý file Excel đầu vào (đọc streaming)
+        reader = open_sheet_reader(input_file_path, engine)
+
+        # Tìm vị trí các cột (dựa vào header)
+        mapping = INVOICE_SCHEMA.resolve(reader.header)
+        if mapping.missing_required:
+            reader.close()
+            raise ValueError(f"File danhsachhoadon thiếu cột cần thiết: {', '.join(mapping.missing_required)}")
+        timer.lap("load")
+
+        # Báo cáo kết quả ghi theo kiểu streaming, mọi dòng cao 30
+        writer = StreamingReportWriter(_invoice_report_styles(), row_height=30)
+        writer.append(["STT", "Tên Khách", "Tổng Tiền", "Tiền mặt", "Chuyển Khoản", "Ship Tuấn", "Ship"],
+                      INVOICE_HEADER_STYLES)
+
+        # Xử lý và thêm dữ liệu
+        with reader:
+            input_rows = reader.rows(mapping.columns(["customer", "total", "paid"]))
+            for row_idx, (customer, total, paid) in enumerate(input_rows, 2):
+                # Kiểm tra kiểu dữ liệu
+                if not isinstance(total, (int, float)) or not isinstance(paid, (int, float)):
+                    raise ValueError(f"Dữ liệu không hợp lệ ở dòng {row_idx} (cột 'Khách cần trả' và 'Khách đã trả' phải là số).")
+
+                cash = paid if paid > 0 else 0
+                transfer = total - cash if cash == 0 else 0
+
+                # Thêm hàng mới (căn giữa tất cả trừ cột Tên Khách, định dạng số cho cột tiền)
+                writer.append([row_idx - 1, customer, total, cash, transfer, None, None], INVOICE_ROW_STYLES)
+
+        # Thêm dòng tổng (SUM cho các cột C-G)
+        writer.append_total_row("Tổng", range(3, 8), styles=INVOICE_TOTAL_STYLES)
+        timer.lap("aggregate")
+
+        # Lưu file (kèm filter)
+        output = save_report_output(writer.save, output_file_path)
+        timer.lap("save")
+        return output
+
     except Exception as e:
-        logger.error(f"Lỗi khi xử lý file sản phẩm: {e}")
+        logger.error("Lỗi khi xử lý file Excel: %s", e)
         return None
 
-def extract_product_data(sheet):
-    """Trích xuất dữ liệu sản phẩm từ sheet."""
-    # Tìm vị trí các cột
-    header = [cell.value for cell in sheet[1]]
-    group_col_index = header.index("Nhóm hàng(3 Cấp)")
-    product_name_col_index = header.index("Tên hàng")
-    stock_col_index = header.index("Tồn kho")
-    
-    # Lọc dữ liệu - hiển thị tất cả các nhóm, không chỉ nhóm cụ thể
-    filtered_data = {}
-    
-    for row in sheet.iter_rows(min_row=2):
-        group = row[group_col_index].value
-        product_name = row[product_name_col_index].value
-        stock = row[stock_col_index].value
-        
-        if stock != 0:  # Hiển thị cả sản phẩm có tồn kho âm và dương, bỏ qua chỉ = 0
-            if group not in filtered_data:
-                filtered_data[group] = []
-            filtered_data[group].append(f"- {product_name}: {stock}")
-    
-    # Sắp xếp sản phẩm theo alphabet tiếng Việt
-    for group in filtered_data:
-        filtered_data[group] = sorted(filtered_data[group], key=locale.strxfrm)
-    
-    sorted_groups = sorted(filtered_data.keys(), key=locale.strxfrm)
-    
+# Báo cáo thu chi: dữ liệu sổ quỹ ghi từ dòng 11 của template
+TEMPLATE_DATA_START_ROW = 11
+
+# Nhãn trong template -> khóa của ô giá trị nằm ngay bên phải nhãn
+TEMPLATE_SUMMARY_LABELS = {
+    "Ngày": "ngay",
+    "Tháng": "thang",
+    "Năm": "nam",
+    "Doanh Thu": "doanh_thu",
+    "Tiền mặt:": "tien_mat",
+    "Chuyển Khoản:": "chuyen_khoan",
+    "Phiếu chi:": "phieu_chi",
+    "Tồn cuối": "ton_cuoi",
+}
+
+# Vị trí mặc định của các ô tổng hợp (dùng khi template không có nhãn tương ứng)
+DEFAULT_SUMMARY_CELLS = {
+    "ngay": "E1",
+    "thang": "G1",
+    "nam": "I1",
+    "doanh_thu": "C3",
+    "tien_mat": "C4",
+    "chuyen_khoan": "C5",
+    "phieu_chi": "C7",
+    "ton_cuoi": "C8",
+}
+
+class ReportTemplate(NamedTuple):
+    """Template báo cáo thu chi đã parse sẵn (bất biến, dùng chung cho mọi request)."""
+    source: str                 # Giá trị EXCEL_TEMPLATE_BASE64 đã dùng để tạo template
+    snapshot: bytes             # Workbook đã parse, lưu dạng pickle để clone nhanh
+    total_chi_row: Optional[int]
+    ban_giao_row: Optional[int]
+    merged_ranges: Tuple[str, ...]
+    summary_cells: Tuple[Tuple[str, str], ...]
+
+    def cell(self, key):
+        """Trả về tọa độ ô tổng hợp theo khóa (vd: 'doanh_thu' -> 'C3')."""
+        return dict(self.summary_cells).get(key, DEFAULT_SUMMARY_CELLS[key])
+
+    def clone(self):
+        """Tạo workbook mới từ template (rẻ hơn nhiều so với decode + load_workbook)."""
+        workbook = pickle.loads(self.snapshot)
+        # pickle bỏ mất default_factory (bound method) của row/column_dimensions
+        for sheet in workbook.worksheets:
+            sheet.row_dimensions.default_factory = sheet._add_row
+            sheet.column_dimensions.default_factory = sheet._add_column
+        return workbook
+
+_report_template = None
+
+def _build_report_template(source):
+    """Decode và parse template, tính trước các dòng mốc, vùng merge và ô tổng hợp."""
+    workbook = load_workbook(BytesIO(base64.b64decode(source)))
+    sheet = workbook.active
+
+    merged_ranges = tuple(str(merged) for merged in sheet.merged_cells.ranges)
+    merged_by_cell = {}
+    for merged in sheet.merged_cells.ranges:
+        merged_by_cell[(merged.min_row, merged.min_col)] = merged
+
+    total_chi_row = None
+    ban_giao_row = None
+    summary_cells = dict(DEFAULT_SUMMARY_CELLS)
+    for row in sheet.iter_rows():
+        for cell in row:
+            if not isinstance(cell.value, str):
+                continue
+            text = cell.value.strip()
+            if total_chi_row is None and row[0].row >= TEMPLATE_DATA_START_ROW and "Tổng chi" in text:
+                total_chi_row = cell.row
+            elif ban_giao_row is None and "Số tiền bàn giao" in text:
+                ban_giao_row = cell.row
+            elif text in TEMPLATE_SUMMARY_LABELS:
+                # Ô giá trị nằm bên phải nhãn (hoặc bên phải vùng merge chứa nhãn)
+                merged = merged_by_cell.get((cell.row, cell.column))
+                value_col = (merged.max_col if merged else cell.column) + 1
+                summary_cells[TEMPLATE_SUMMARY_LABELS[text]] = f"{get_column_letter(value_col)}{cell.row}"
+
+    return ReportTemplate(
+        source=source,
+        snapshot=pickle.dumps(workbook, protocol=pickle.HIGHEST_PROTOCOL),
+        total_chi_row=total_chi_row,
+        ban_giao_row=ban_giao_row,
+        merged_ranges=merged_ranges,
+        summary_cells=tuple(summary_cells.items()),
+    )
+
+def get_report_template():
+    """Trả về template báo cáo đã cache; parse lại khi EXCEL_TEMPLATE_BASE64 thay đổi."""
+    global _report_template
+    source = os.getenv("EXCEL_TEMPLATE_BASE64") or EXCEL_TEMPLATE_BASE64
+    if not source:
+        raise ValueError("EXCEL_TEMPLATE_BASE64 không được cấu hình")
+
+    if _report_template is None or _report_template.source != source:
+        _report_template = _build_report_template(source)
+        logger.info("Đã nạp template báo cáo (Tổng chi: dòng %s, Số tiền bàn giao: dòng %s)",
+                    _report_template.total_chi_row, _report_template.ban_giao_row)
+    return _report_template
+
+def _empty_report_totals():
     return {
-        'filtered_data': filtered_data,
-        'sorted_groups': sorted_groups
+        'khach_can_tra': 0,
+        'khach_da_tra': 0,
+        'gia_tri': 0
     }
 
-def format_product_data(data):
-    """Định dạng dữ liệu sản phẩm thành chuỗi kết quả."""
-    filtered_data = data['filtered_data']
-    sorted_groups = data['sorted_groups']
-    
-    output_string = "Danh sách sản phẩm có hàng tồn khác 0 (bao gồm cả tồn kho âm) :\n\n"
-    for group in sorted_groups:
-        if filtered_data[group]:  # Chỉ hiển thị nhóm có sản phẩm
-            output_string += f"Nhóm: {group}\n"
-            for product in filtered_data[group]:
-                output_string += f"{product}\n"
-            output_string += "\n"
-    
-    return output_string
+def process_multiple_invoice_files(input_file_paths, output_file_path, file_names=None, engine=None):
+    """Xử lý nhiều file hóa đơn/sổ quỹ và tạo báo cáo tổng hợp, tuần tự trong process hiện tại.
 
-def process_excel_file_updated(file_path):
-    """Xử lý file Excel và trả về dữ liệu định dạng có cấu trúc."""
+    Cùng map (process_single_file: mỗi file thành một phần kết quả độc lập) và reduce
+    (render_combined_report: gộp các phần theo đúng thứ tự file đầu vào vào template)
+    với combine_report_files, chỉ không chạy qua process pool (dùng cho benchmark, kiểm tra).
+
+    input_file_paths có thể chứa bytes (file trong bộ nhớ), khi đó cần truyền
+    file_names tương ứng để nhận diện loại file.
+    """
+    file_names = list(file_names) if file_names is not None else [None] * len(input_file_paths)
+    parts = [process_single_file(source, name, engine) for source, name in zip(input_file_paths, file_names)]
+    return render_combined_report(parts, output_file_path)
+
+def render_combined_report(parts, output_file_path):
+    """Gộp các phần kết quả (theo thứ tự) vào template và lưu báo cáo tổng hợp.
+
+    Nếu output_file_path là None, báo cáo trả về trong 'file_data' (bytes).
+    """
     try:
-        workbook = load_workbook(filename=file_path)
-        sheet = workbook.active
-        
-        # Tìm vị trí các cột
-        header = [cell.value for cell in sheet[1]]
-        
-        # Danh sách lưu các cột thiếu
-        missing_columns = []
-        
-        # Kiểm tra các cột bắt buộc
-        try:
-            group_col_index = header.index("Nhóm hàng(3 Cấp)")
-        except ValueError:
-            missing_columns.append("Nhóm hàng(3 Cấp)")
-            return f"Lỗi: File danhsachsanpham thiếu cột bắt buộc 'Nhóm hàng(3 Cấp)'"
+        # Clone template đã parse sẵn
+        timer = StageTimer()
+        template = get_report_template()
+        output_workbook = template.clone()
+        output_sheet = output_workbook.active
+        timer.lap("template")
+
+        # Điền ngày, tháng, năm hiện tại
+        now = datetime.now()
+        output_sheet[template.cell("ngay")] = now.day       # Ô E1 (ngày)
+        output_sheet[template.cell("thang")] = now.month    # Ô G1 (tháng)
+        output_sheet[template.cell("nam")] = now.year       # Ô I1 (năm)
+
+        # Reduce: cộng dồn tổng và nối các dòng sổ quỹ theo thứ tự file
+        totals = _empty_report_totals()
+        soquy_rows = []
+        missing_columns_info = []
+        for part in parts:
+            for key, value in part['totals'].items():
+                totals[key] += value
+            soquy_rows.extend(part['rows'])
+            missing_columns_info.extend(part['missing_columns_info'])
+
+        # Template chỉ có sẵn một số dòng trước "Tổng chi:", chèn thêm nếu cần
+        total_chi_row = template.total_chi_row
+        if total_chi_row:
+            capacity = total_chi_row - TEMPLATE_DATA_START_ROW
+            extra_rows = len(soquy_rows) - capacity
+            if extra_rows > 0:
+                _insert_row_block(output_sheet, total_chi_row, extra_rows, style_row=total_chi_row - 1)
+                total_chi_row += extra_rows
+                logger.debug("Đã chèn thêm %s dòng cho dữ liệu sổ quỹ", extra_rows)
+
+        # Ghi dữ liệu sổ quỹ liền nhau từ dòng 11
+        write_soquy_rows(output_sheet, soquy_rows, TEMPLATE_DATA_START_ROW)
+
+        # Xóa các dòng trống từ dòng 11 đến trước dòng "Tổng chi:" (vị trí đã biết từ template)
+        end_row = total_chi_row - 1 if total_chi_row else 30
+        deleted_count, total_chi_row = remove_empty_rows(
+            output_sheet, TEMPLATE_DATA_START_ROW, end_row, total_chi_row=total_chi_row
+        )
+        logger.debug("Đã xóa %s dòng trống", deleted_count)
+
+        # Ghi giá trị tổng hợp
+        update_summary_values(output_sheet, totals, total_chi_row, summary_cells=dict(template.summary_cells))
+        timer.lap("render")
+
+        # Lưu file (hoặc giữ trong bộ nhớ nếu output_file_path là None)
+        output = save_report_output(output_workbook.save, output_file_path)
+        timer.lap("save")
+
+        # Trả về file kết quả và thông tin missing columns
+        return report_result(output, missing_columns_info)
+
+    except Exception as e:
+        logger.error("Lỗi khi xử lý nhiều file: %s", e)
+        return None
+
+def write_soquy_rows(output_sheet, rows, start_row):
+    """Ghi các dòng sổ quỹ (mã phiếu, nội dung, người nộp, ghi chú, số tiền) từ start_row."""
+    for row_num, (ma_phieu, loai_thu_chi, nguoi_nop_nhan, ghi_chu, gia_tri) in enumerate(rows, start_row):
+        output_sheet.cell(row=row_num, column=2, value=ma_phieu)  # Mã phiếu
+        output_sheet.cell(row=row_num, column=3, value=loai_thu_chi)  # Nội dung
+        output_sheet.cell(row=row_num, column=5, value=nguoi_nop_nhan)  # Người nộp
+        output_sheet.cell(row=row_num, column=7, value=ghi_chu)  # Ghi chú
+        output_sheet.cell(row=row_num, column=9, value=gia_tri)  # Số tiền
+
+def process_single_file(file_path, file_name=None, engine=None):
+    """Đọc một file trong quá trình tổng hợp nhiều file thành một phần kết quả độc lập.
+
+    Hàm chạy được trong worker process (tham số và kết quả đều picklable).
+    file_path có thể là bytes (file trong bộ nhớ), khi đó cần truyền file_name.
+
+    Returns:
+        dict: {'file_name', 'totals', 'rows' (các dòng sổ quỹ), 'missing_columns_info'}
+    """
+    if not file_name:
+        file_name = os.path.basename(file_path) if isinstance(file_path, str) else ""
+    part = {
+        'file_name': file_name,
+        'totals': _empty_report_totals(),
+        'rows': [],
+        'missing_columns_info': []
+    }
+    try:
+        timer = StageTimer()
+        with open_sheet_reader(file_path, engine) as reader:
+            header = reader.header
+            timer.lap("load")
             
-        try:
-            product_name_col_index = header.index("Tên hàng")
-        except ValueError:
-            missing_columns.append("Tên hàng")
-            return f"Lỗi: File danhsachsanpham thiếu cột bắt buộc 'Tên hàng'"
+            # Detect file type dựa vào tên file thay vì header để track missing columns
+            name_lower = file_name.lower()
             
-        try:
-            stock_col_index = header.index("Tồn kho")
-        except ValueError:
-            missing_columns.append("Tồn kho")
-            return f"Lỗi: File danhsachsanpham thiếu cột bắt buộc 'Tồn kho'"
+            if name_lower.startswith("danhsachhoadon_"):
+                # File hóa đơn - luôn gọi process_hoa_don_file để track missing columns
+                part['missing_columns_info'] = process_hoa_don_file(reader, header, part['totals'])
+            elif name_lower.startswith("soquy_"):
+                # File sổ quỹ - luôn gọi process_thu_chi_file để track missing columns
+                part['missing_columns_info'] = process_thu_chi_file(reader, header, part['rows'], part['totals'])
+            else:
+                # Fallback: detect bằng header như trước đây
+                if not INVOICE_SCHEMA.resolve(header).missing_required:
+                    part['missing_columns_info'] = process_hoa_don_file(reader, header, part['totals'])
+                elif not SOQUY_SCHEMA.resolve(header).missing_required:
+                    part['missing_columns_info'] = process_thu_chi_file(reader, header, part['rows'], part['totals'])
+                else:
+                    logger.warning("Bỏ qua file %s do không xác định được loại file.", file_name)
+        timer.lap("aggregate")
         
-        # Tìm cột "Giá vốn" (optional)
-        unit_cost_col_index = None
-        try:
-            unit_cost_col_index = header.index("Giá vốn")
-            logger.info(f"Đã tìm thấy cột Giá vốn tại vị trí {unit_cost_col_index}")
-        except ValueError:
-            # Thử tìm các biến thể khác của cột giá vốn
-            for i, col_name in enumerate(header):
-                if col_name and isinstance(col_name, str) and 'giá vốn' in col_name.lower():
-                    unit_cost_col_index = i
-                    logger.info(f"Đã tìm thấy cột giá vốn (tìm mờ) tại vị trí {unit_cost_col_index}: {col_name}")
-                    break
-            
-            if unit_cost_col_index is None:
-                missing_columns.append("Giá vốn")
-                logger.warning("Không tìm thấy cột 'Giá vốn' - sẽ bỏ qua tính tổng tiền tồn kho")
+    except Exception as e:
+        logger.error("Lỗi khi xử lý file %s: %s", file_name, e)
+    return part
+
+def process_hoa_don_file(reader, header, totals):
+    """Xử lý dữ liệu từ file hóa đơn (reader: StreamingSheetReader)."""
+    try:
+        # Kiểm tra các cột bắt buộc
+        mapping = INVOICE_SCHEMA.resolve(header)
         
-        # Dữ liệu đầu ra
-        all_products = []
+        # Nếu thiếu cột bắt buộc, không thể xử lý nhưng vẫn trả về missing info
+        if mapping.missing_required:
+            missing_info = [f"File danhsachhoadon thiếu cột: {', '.join(mapping.missing_required)}"]
+            return missing_info
         
-        # Danh sách các nhóm bị loại trừ
-        excluded_groups = ["Nước rửa chén"]
+        # Xử lý dữ liệu nếu có đủ cột
+        for total_value, paid_value in reader.rows(mapping.columns(["total", "paid"])):
+            totals['khach_can_tra'] += float(total_value) if total_value is not None else 0
+            totals['khach_da_tra'] += float(paid_value) if paid_value is not None else 0
+            
+        return []  # Không có missing columns
         
-        # Tìm tất cả các nhóm hàng trong file, ngoại trừ các nhóm bị loại trừ
-        all_groups = set()
-        for row in sheet.iter_rows(min_row=2):
-            group = row[group_col_index].value
-            if group and group not in excluded_groups:
-                all_groups.add(group)
+    except ValueError as e:
+        logger.error("Lỗi định dạng trong file hóa đơn: %s", e)
+        return []
+
+def process_thu_chi_file(reader, header, output_rows, totals):
+    """Xử lý dữ liệu từ file thu chi (reader: StreamingSheetReader).
+
+    Các dòng có mã phiếu được thêm vào output_rows dưới dạng tuple
+    (mã phiếu, nội dung, người nộp/nhận, ghi chú, số tiền).
+    """
+    try:
+        # Tìm các cột (báo đủ tất cả các cột bắt buộc bị thiếu)
+        mapping = SOQUY_SCHEMA.resolve(header)
+        if mapping.missing_required:
+            logger.error("File soquy thiếu cột bắt buộc: %s", ', '.join(mapping.missing_required))
+            return [f"File soquy thiếu cột: {', '.join(mapping.missing_required + mapping.missing_optional)}"]
         
-        # Tạo dict lưu trữ sản phẩm theo nhóm
-        filtered_data = {group: [] for group in all_groups}
+        # Danh sách lưu các cột thiếu
+        missing_columns = list(mapping.missing_optional)
         
-        # Dictionary để lưu thông tin giá vốn × tồn kho cho từng sản phẩm
-        product_cost_info = {}
+        # Cột "Ghi chú" (optional)
+        has_ghi_chu = mapping.indices['ghi_chu'] is not None
+        if has_ghi_chu:
+            logger.info("Đã tìm thấy cột 'Ghi chú' trong file soquy")
+        else:
+            logger.info("Không tìm thấy cột 'Ghi chú' trong file soquy - sẽ bỏ qua cột này")
         
-        # Xử lý dữ liệu
-        for row in sheet.iter_rows(min_row=2):
-            group = row[group_col_index].value
-            product_name = row[product_name_col_index].value
-            stock = row[stock_col_index].value
+        rows = reader.rows(mapping.columns(["ma_phieu", "loai_thu_chi", "nguoi_nop_nhan", "ghi_chu", "gia_tri"]))
+        for ma_phieu, loai_thu_chi, nguoi_nop_nhan, ghi_chu, gia_tri in rows:
+            if ma_phieu is not None:
+                # Ghi chú để trống nếu file không có cột "Ghi chú"
+                if not has_ghi_chu:
+                    ghi_chu = ""
+                output_rows.append((ma_phieu, loai_thu_chi, nguoi_nop_nhan, ghi_chu, gia_tri))
             
-            if stock != 0:  # Hiển thị cả sản phẩm có tồn kho âm và dương, bỏ qua chỉ = 0
-                all_products.append(f"- {product_name}: {stock}")
-                
-                # Tính tổng tiền tồn kho = Giá vốn × Tồn kho
-                total_cost = 0
-                if unit_cost_col_index is not None:
-                    unit_cost_value = row[unit_cost_col_index].value
-                    if unit_cost_value is not None:
-                        try:
-                            unit_cost = float(unit_cost_value)
-                            total_cost = unit_cost * float(stock)
-                        except (ValueError, TypeError):
-                            logger.warning(f"Giá vốn hoặc tồn kho không hợp lệ cho sản phẩm '{product_name}': giá vốn={unit_cost_value}, tồn kho={stock}")
-                            total_cost = 0
-                
-                # Lưu thông tin cost cho sản phẩm này
-                product_cost_info[product_name] = {
-                    "stock": float(stock),
-                    "total_cost": total_cost
-                }
-                
-                if group and group not in excluded_groups:
-                    filtered_data[group].append(f"- {product_name}: {stock}")
-        
-        # Sắp xếp dữ liệu
-        all_products.sort(key=locale.strxfrm)
-        for group in filtered_data:
-            filtered_data[group].sort(key=locale.strxfrm)
-        
-        sorted_groups = sorted(filtered_data.keys(), key=locale.strxfrm)
+            if gia_tri is not None:
+                totals['gia_tri'] += abs(float(gia_tri))
         
         # Tạo thông báo về cột thiếu nếu có
         missing_info = []
         if missing_columns:
-            missing_info.append(f"File danhsachsanpham thiếu cột: {', '.join(missing_columns)}")
-        
-        return {
-            "all_products": all_products,
-            "grouped_products": filtered_data,
-            "sorted_groups": sorted_groups,
-            "product_cost_info": product_cost_info,
-            "missing_columns_info": missing_info
-        }
-        
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý file Excel cập nhật: {e}")
-        return f"Lỗi khi xử lý file Excel: {e}"
-
-def process_invoice_file(input_file_path, output_file_path):
-    """Xử lý file hóa đơn đơn với tracking missing columns."""
-    try:
-        result_path = process_excel_file(input_file_path, output_file_path)
-        if result_path:
-            # Thành công - không có missing columns
-            return {
-                'file_path': result_path,
-                'missing_columns_info': []
-            }
-        else:
-            return None
+            missing_info.append(f"File soquy thiếu cột: {', '.join(missing_columns)}")
+                
+        return missing_info
     except ValueError as e:
-        # Check nếu là lỗi missing columns
-        error_msg = str(e)
-        if "thiếu cột cần thiết" in error_msg:
-            # Extract missing columns info từ error message
-            return {
-                'file_path': None,
-                'missing_columns_info': [error_msg]
-            }
+        logger.error("Lỗi định dạng trong file thu chi: %s", e)
+        return []
+
+# Cột dùng để xác định một dòng dữ liệu sổ quỹ có trống hay không (B, C, E, G, I)
+SOQUY_DATA_COLUMNS = (2, 3, 5, 7, 9)
+
+_CELL_REF_PATTERN = re.compile(r"^(?P<prefix>.*!)?(?P<col>\$?[A-Za-z]{1,3})?(?P<abs>\$?)(?P<row>\d+)$")
+
+def _remap_formula_rows(formula, remap):
+    """Đổi số dòng trong các tham chiếu ô của công thức.
+
+    Args:
+        formula: Công thức dạng "=..."
+        remap: Hàm remap(row, is_range_end) trả về số dòng mới
+    """
+    tokenizer = Tokenizer(formula)
+    changed = False
+    for token in tokenizer.items:
+        if token.type != Token.OPERAND or token.subtype != Token.RANGE:
+            continue
+        parts = token.value.split(":")
+        new_parts = []
+        for part_idx, part in enumerate(parts):
+            match = _CELL_REF_PATTERN.match(part)
+            if match is None:
+                new_parts.append(part)
+                continue
+            row = int(match.group("row"))
+            is_range_end = len(parts) > 1 and part_idx == len(parts) - 1
+            new_row = remap(row, is_range_end)
+            if new_row != row:
+                changed = True
+            new_parts.append(f"{match.group('prefix') or ''}{match.group('col') or ''}{match.group('abs')}{new_row}")
+        token.value = ":".join(new_parts)
+    return tokenizer.render() if changed else formula
+
+def _delete_row_block(sheet, first_row, count):
+    """Xóa `count` dòng liên tiếp từ first_row trong một lần dịch chuyển.
+
+    Khác với sheet.delete_rows, hàm này còn dời vùng merge, chiều cao dòng và
+    tham chiếu trong công thức nằm phía dưới khối bị xóa.
+    """
+    if count <= 0:
+        return
+    last_row = first_row + count - 1
+
+    def remap(row, is_range_end):
+        if row > last_row:
+            return row - count
+        if row >= first_row:
+            # Tham chiếu vào khối bị xóa: co về mép khối
+            return first_row - 1 if is_range_end else first_row
+        return row
+
+    # Xóa hết ô trong khối trước để sheet.delete_rows không để lại ô cũ
+    # ở những cột mà dòng được dời lên không có dữ liệu
+    for row_idx, col_idx in [key for key in sheet._cells if first_row <= key[0] <= last_row]:
+        del sheet._cells[row_idx, col_idx]
+    sheet.delete_rows(first_row, count)
+
+    # Dời / thu nhỏ / bỏ các vùng merge bị ảnh hưởng
+    affected = [merged for merged in sheet.merged_cells.ranges if merged.max_row >= first_row]
+    for merged in affected:
+        sheet.merged_cells.remove(merged)
+    for merged in affected:
+        if merged.min_row > last_row:
+            merged.shift(row_shift=-count)
+        elif merged.min_row >= first_row and merged.max_row <= last_row:
+            continue  # Vùng merge nằm trọn trong khối bị xóa
         else:
+            merged.min_row = remap(merged.min_row, False)
+            merged.max_row = remap(merged.max_row, True)
+        # Thêm thẳng vào tập ranges: merged_cells.add() so với mọi vùng đang có (O(n) mỗi lần)
+        sheet.merged_cells.ranges.add(merged)
+
+    # Dời chiều cao dòng
+    dimensions = sorted(sheet.row_dimensions.items())
+    for row_idx, _ in dimensions:
+        if row_idx >= first_row:
+            del sheet.row_dimensions[row_idx]
+    for row_idx, dimension in dimensions:
+        if row_idx > last_row:
+            dimension.index = row_idx - count
+            sheet.row_dimensions[row_idx - count] = dimension
+
+    # Cập nhật tham chiếu trong các công thức
+    for cell in sheet._cells.values():
+        if cell.data_type == "f" and isinstance(cell.value, str):
+            cell.value = _remap_formula_rows(cell.value, remap)
+
+def _add_row_merges(sheet, rows, column_spans):
+    """Merge các khoảng cột column_spans [(min_col, max_col)] trên từng dòng trong rows.
+
+    Như sheet.merge_cells() nhưng thêm thẳng vào merged_cells.ranges: merge_cells() kiểm tra
+    vùng mới với mọi vùng merge đang có nên chèn hàng nghìn dòng mất thời gian bình phương.
+    Các dòng trong rows phải chưa có vùng merge nào.
+    """
+    spans = [(get_column_letter(min_col), get_column_letter(max_col)) for min_col, max_col in column_spans]
+    for row_idx in rows:
+        for min_letter, max_letter in spans:
+            merged = MergedCellRange(sheet, f"{min_letter}{row_idx}:{max_letter}{row_idx}")
+            sheet.merged_cells.ranges.add(merged)
+            sheet._clean_merge_range(merged)
+
+def _insert_row_block(sheet, before_row, count, style_row=None):
+    """Chèn `count` dòng trống trước before_row trong một lần dịch chuyển.
+
+    Vùng merge, chiều cao dòng và tham chiếu công thức phía dưới được dời theo.
+    Nếu có style_row (nằm phía trên before_row), các dòng mới sao chép style,
+    các vùng merge một dòng và chiều cao của dòng đó.
+    """
+    if count <= 0:
+        return
+
+    def remap(row, is_range_end):
+        return row + count if row >= before_row else row
+
+    sheet.insert_rows(before_row, count)
+
+    # Dời các vùng merge phía dưới, kéo dài vùng merge vắt qua điểm chèn
+    affected = [merged for merged in sheet.merged_cells.ranges if merged.max_row >= before_row]
+    for merged in affected:
+        sheet.merged_cells.remove(merged)
+    for merged in affected:
+        if merged.min_row >= before_row:
+            merged.shift(row_shift=count)
+        else:
+            merged.max_row += count
+        sheet.merged_cells.ranges.add(merged)
+
+    # Dời chiều cao dòng
+    dimensions = sorted(sheet.row_dimensions.items())
+    for row_idx, _ in dimensions:
+        if row_idx >= before_row:
+            del sheet.row_dimensions[row_idx]
+    for row_idx, dimension in dimensions:
+        if row_idx >= before_row:
+            dimension.index = row_idx + count
+            sheet.row_dimensions[row_idx + count] = dimension
+
+    # Cập nhật tham chiếu trong các công thức
+    for cell in sheet._cells.values():
+        if cell.data_type == "f" and isinstance(cell.value, str):
+            cell.value = _remap_formula_rows(cell.value, remap)
+
+    if style_row is None:
+        return
+
+    row_merges = [merged for merged in sheet.merged_cells.ranges
+                  if merged.min_row == merged.max_row == style_row]
+    style_height = sheet.row_dimensions[style_row].height if style_row in sheet.row_dimensions else None
+    max_col = sheet.max_column
+    _add_row_merges(sheet, range(before_row, before_row + count),
+                    [(merged.min_col, merged.max_col) for merged in row_merges])
+    for row_idx in range(before_row, before_row + count):
+        for col_idx in range(1, max_col + 1):
+            source = sheet.cell(row=style_row, column=col_idx)
+            if source.has_style:
+                sheet.cell(row=row_idx, column=col_idx)._style = copy(source._style)
+        if style_height is not None:
+            sheet.row_dimensions[row_idx].height = style_height
+
+def compact_rows(sheet, start_row, end_row, data_columns=SOQUY_DATA_COLUMNS):
+    """Dồn các dòng có dữ liệu trong [start_row, end_row] lên trên và xóa phần trống.
+
+    Các dòng có dữ liệu giữ nguyên thứ tự; toàn bộ dòng trống dư ra được xóa
+    trong một lần (_delete_row_block) thay vì xóa từng dòng.
+
+    Returns:
+        int: Số dòng đã xóa
+    """
+    filled_rows = []
+    for row_idx in range(start_row, end_row + 1):
+        # Kiểm tra xem dòng có dữ liệu không (mặc định các cột B, C, E, G, I)
+        for col_idx in data_columns:
+            cell_value = sheet.cell(row=row_idx, column=col_idx).value
+            if cell_value is not None and str(cell_value).strip() != "":
+                filled_rows.append(row_idx)
+                break
+
+    # Chỉ cần chép giá trị khi có dòng trống xen giữa (style các dòng của khối giống nhau)
+    max_col = sheet.max_column
+    for target_row, source_row in enumerate(filled_rows, start_row):
+        if target_row == source_row:
+            continue
+        for col_idx in range(1, max_col + 1):
+            source = sheet.cell(row=source_row, column=col_idx)
+            if isinstance(source, MergedCell):
+                continue
+            sheet.cell(row=target_row, column=col_idx).value = source.value
+            source.value = None
+
+    deleted_count = (end_row - start_row + 1) - len(filled_rows)
+    _delete_row_block(sheet, start_row + len(filled_rows), deleted_count)
+    return deleted_count
+
+class SheetLayoutIndex:
+    """Chỉ mục vùng merge và nhãn văn bản của một sheet, xây một lần cho mỗi sheet.
+
+    Trả lời "vùng merge nào giao với dòng R, cột A..B" và "nhãn X nằm ở dòng nào"
+    mà không phải quét lại sheet hay thử unmerge từng cặp cột.
+    """
+
+    def __init__(self, sheet, label_columns=(1, 2, 3, 4, 5)):
+        self.sheet = sheet
+        self._merges_by_row = {}
+        for merged in sheet.merged_cells.ranges:
+            self._add_merge(merged)
+
+        # Nhãn văn bản ở các cột label_columns (mặc định A-E): [(row, col, text)]
+        self._labels = []
+        min_col, max_col = min(label_columns), max(label_columns)
+        for row_idx, row in enumerate(sheet.iter_rows(min_col=min_col, max_col=max_col, values_only=True), 1):
+            for col_idx, value in enumerate(row, min_col):
+                if isinstance(value, str) and value.strip() and col_idx in label_columns:
+                    self._labels.append((row_idx, col_idx, value))
+
+    def _add_merge(self, merged):
+        for row_idx in range(merged.min_row, merged.max_row + 1):
+            self._merges_by_row.setdefault(row_idx, []).append(merged)
+
+    def _remove_merge(self, merged):
+        for row_idx in range(merged.min_row, merged.max_row + 1):
+            self._merges_by_row[row_idx].remove(merged)
+
+    def intersecting(self, row, min_col, max_col):
+        """Các vùng merge giao với dòng row trong khoảng cột [min_col, max_col]."""
+        return [merged for merged in self._merges_by_row.get(row, ())
+                if merged.min_col <= max_col and merged.max_col >= min_col]
+
+    def remerge(self, row, min_col, max_col):
+        """Đảm bảo dòng row được merge đúng một vùng [min_col, max_col].
+
+        Returns:
+            bool: True nếu sheet có thay đổi
+        """
+        existing = self.intersecting(row, min_col, max_col)
+        if (len(existing) == 1 and existing[0].min_row == existing[0].max_row == row
+                and existing[0].min_col == min_col and existing[0].max_col == max_col):
+            return False
+
+        for merged in existing:
+            self._remove_merge(merged)
+            self.sheet.unmerge_cells(merged.coord)
+
+        self.sheet.merge_cells(start_row=row, start_column=min_col, end_row=row, end_column=max_col)
+        for merged in self.sheet.merged_cells.ranges:
+            if merged.min_row == row and merged.min_col == min_col and merged.max_col == max_col:
+                self._add_merge(merged)
+                break
+        return True
+
+    def find_row(self, text, start_row=1, end_row=None, columns=None):
+        """Dòng đầu tiên (>= start_row) có ô chứa text, hoặc None."""
+        for row_idx, col_idx, value in self._labels:
+            if row_idx < start_row or (end_row is not None and row_idx > end_row):
+                continue
+            if columns is not None and col_idx not in columns:
+                continue
+            if text in value:
+                return row_idx
+        return None
+
+def remove_empty_rows(sheet, start_row, end_row, total_chi_row=None):
+    """Xóa các dòng trống trong phạm vi từ start_row đến dòng trước 'Tổng chi:'.
+
+    Args:
+        total_chi_row: Vị trí dòng 'Tổng chi:' nếu đã biết trước (bỏ qua bước tìm kiếm)
+
+    Returns:
+        tuple: (số dòng đã xóa, vị trí dòng 'Tổng chi:' sau khi xóa)
+    """
+    # Tìm dòng "Tổng chi:" trước để không xóa các dòng template
+    # Kiểm tra nhiều cột vì sau khi merge/unmerge text có thể nằm ở C, D, hoặc E
+    total_chi_row_before = total_chi_row
+    if total_chi_row_before is None:
+        # Kiểm tra cột C, D, E để tìm "Tổng chi:"
+        total_chi_row_before = SheetLayoutIndex(sheet).find_row("Tổng chi", start_row, columns=(3, 4, 5))
+        if total_chi_row_before:
+            logger.debug("Tìm thấy dòng 'Tổng chi:' tại dòng %s (trước khi xóa)", total_chi_row_before)
+
+    # Nếu tìm thấy "Tổng chi:", chỉ xóa từ start_row đến trước dòng đó
+    if total_chi_row_before:
+        end_row = total_chi_row_before - 1
+        logger.debug("Sẽ xóa dòng trống từ %s đến %s", start_row, end_row)
+
+    # Dồn các dòng có dữ liệu lên trên và xóa phần trống trong một lượt
+    deleted_count = compact_rows(sheet, start_row, end_row)
+    logger.debug("Đã xóa %s dòng trống trong khoảng %s-%s", deleted_count, start_row, end_row)
+
+    # Tính vị trí mới của dòng "Tổng chi:" sau khi xóa
+    total_chi_row_after = None
+    if total_chi_row_before:
+        total_chi_row_after = total_chi_row_before - deleted_count
+        logger.debug("Vị trí dòng 'Tổng chi:' sau khi xóa: %s", total_chi_row_after)
+
+    return deleted_count, total_chi_row_after
+
+def update_summary_values(sheet, totals, total_chi_row=None, summary_cells=None, layout=None):
+    """Cập nhật các giá trị tổng hợp vào file báo cáo.
+
+    Args:
+        sheet: Excel worksheet
+        totals: Dictionary chứa các tổng
+        total_chi_row: Vị trí dòng 'Tổng chi:' (sau khi xóa dòng trống)
+        summary_cells: Tọa độ các ô tổng hợp (mặc định DEFAULT_SUMMARY_CELLS)
+        layout: SheetLayoutIndex của sheet (tự xây nếu không truyền vào)
+    """
+    cells = dict(DEFAULT_SUMMARY_CELLS)
+    if summary_cells:
+        cells.update(summary_cells)
+    layout = layout or SheetLayoutIndex(sheet)
+
+    sheet[cells['doanh_thu']] = totals['khach_can_tra']  # Doanh thu
+    sheet[cells['tien_mat']] = totals['khach_da_tra']  # Tiền mặt
+    sheet[cells['chuyen_khoan']] = totals['khach_can_tra'] - totals['khach_da_tra']  # Chuyển khoản
+
+    if total_chi_row:
+        # Cập nhật công thức tổng chi tại cột I
+        sheet.cell(row=total_chi_row, column=9, value=f"=SUM(I11:I{total_chi_row-1})*-1")
+        logger.debug("Đã cập nhật công thức I%s = SUM(I11:I%s)*-1", total_chi_row, total_chi_row-1)
+
+        # Cập nhật C7 (Phiếu chi) tham chiếu đến I(dòng Tổng chi)
+        sheet[cells['phieu_chi']] = f"=I{total_chi_row}"
+        logger.debug("Đã cập nhật %s = I%s", cells['phieu_chi'], total_chi_row)
+
+        # Merge cells cho dòng "Tổng chi:" từ C đến H (CDEFGH), unmerge đúng các vùng cũ bị giao
+        if layout.remerge(total_chi_row, 3, 8):
+            logger.debug("Đã merge cells C%s:H%s cho 'Tổng chi:'", total_chi_row, total_chi_row)
+    else:
+        # Fallback: không tìm thấy "Tổng chi:"
+        logger.warning("Không tìm thấy dòng 'Tổng chi:', sử dụng giá trị mặc định")
+        sheet[cells['phieu_chi']] = "=I31"
+        sheet.cell(row=31, column=9, value=f"=SUM(I11:I30)*-1")
+
+    # Tồn quỹ = Tiền mặt - Phiếu chi
+    sheet[cells['ton_cuoi']] = f"={cells['tien_mat']}-{cells['phieu_chi']}"
+
+    # Tìm dòng "Số tiền bàn giao:" để cập nhật tồn quỹ
+    # Dòng này thường nằm sau dòng "Tổng chi:" 2 dòng (sau khi xóa có thể là 1-2 dòng)
+    search_start = total_chi_row + 1 if total_chi_row else 11
+
+    # Kiểm tra nhiều cột vì merge cells: A, B, C, D, E
+    ban_giao_row = layout.find_row("Số tiền bàn giao", search_start, search_start + 9)
+    found_ban_giao = ban_giao_row is not None
+    if found_ban_giao:
+        # Ghi giá trị =C8 vào cột C
+        sheet.cell(row=ban_giao_row, column=3, value=f"={cells['ton_cuoi']}")
+
+        # Merge cells cho ô giá trị từ C đến I (CDEFGHI)
+        # Cột B (text "Số tiền bàn giao:") không merge
+        layout.remerge(ban_giao_row, 3, 9)
+        logger.debug("Đã cập nhật dòng %d 'Số tiền bàn giao:' = C8 và merge C%d:I%d",
+                    ban_giao_row, ban_giao_row, ban_giao_row)
+
+    if not found_ban_giao:
+        logger.warning("Không tìm thấy dòng 'Số tiền bàn giao:' sau dòng Tổng chi")
+
+def process_product_file(input_file_path, engine=None):
+    """Xử lý file sản phẩm và trả về danh sách sản phẩm theo nhóm."""
+    try:
+        with open_sheet_reader(input_file_path, engine) as reader:
+            result = extract_product_data(reader)
+        return format_product_data(result)
+        
+    except Exception as e:
+        logger.error("Lỗi khi xử lý file sản phẩm: %s", e)
+        return None
+
+def extract_product_data(reader):
+    """Trích xuất dữ liệu sản phẩm từ sheet (reader: StreamingSheetReader)."""
+    # Tìm vị trí các cột
+    mapping = PRODUCT_SCHEMA.resolve(reader.header)
+    if mapping.missing_required:
+        raise ValueError(f"File danhsachsanpham thiếu cột: {', '.join(mapping.missing_required)}")
+    
+    # Lọc dữ liệu - hiển thị tất cả các nhóm, không chỉ nhóm cụ thể
+    filtered_data = {}
+    
+    for group, product_name, stock in reader.rows(mapping.columns(["group", "name", "stock"])):
+        if stock != 0:  # Hiển thị cả sản phẩm có tồn kho âm và dương, bỏ qua chỉ = 0
+            filtered_data.setdefault(group, []).append((str(product_name), stock))
+    
+    # Sắp xếp sản phẩm theo tên (alphabet tiếng Việt) rồi mới định dạng dòng
+    for group, products in filtered_data.items():
+        products.sort(key=lambda product: vietnamese_sort_key(product[0]))
+        filtered_data[group] = [f"- {product_name}: {stock}" for product_name, stock in products]
+    
+    sorted_groups = sorted(filtered_data.keys(), key=lambda group: vietnamese_sort_key(str(group)))
+    
+    return {
+        'filtered_data': filtered_data,
+        'sorted_groups': sorted_groups
+    }
+
+def format_product_data(data):
+    """Định dạng dữ liệu sản phẩm thành chuỗi kết quả."""
+    filtered_data = data['filtered_data']
+    sorted_groups = data['sorted_groups']
+    
+    lines = ["Danh sách sản phẩm có hàng tồn khác 0 (bao gồm cả tồn kho âm) :", ""]
+    for group in sorted_groups:
+        if filtered_data[group]:  # Chỉ hiển thị nhóm có sản phẩm
+            lines.append(f"Nhóm: {group}")
+            lines.extend(filtered_data[group])
+            lines.append("")
+    
+    return "\n".join(lines) + "\n"
+
+def process_excel_file_updated(file_path, engine=None):
+    """Xử lý file Excel và trả về dữ liệu định dạng có cấu trúc."""
+    try:
+        timer = StageTimer()
+        with open_sheet_reader(file_path, engine) as reader:
+            # Tìm vị trí các cột (kiểm tra tất cả các cột bắt buộc)
+            mapping = PRODUCT_SCHEMA.resolve(reader.header)
+            if mapping.missing_required:
+                missing_names = ", ".join(f"'{name}'" for name in mapping.missing_required)
+                return f"Lỗi: File danhsachsanpham thiếu cột bắt buộc {missing_names}"
+            timer.lap("load")
+
+            # Danh sách lưu các cột thiếu (optional)
+            missing_columns = list(mapping.missing_optional)
+
+            # Cột "Giá vốn" (optional, cho phép tìm mờ)
+            unit_cost_col_index = mapping.indices["unit_cost"]
+            if unit_cost_col_index is None:
+                logger.warning("Không tìm thấy cột 'Giá vốn' - sẽ bỏ qua tính tổng tiền tồn kho")
+
+            # Sản phẩm có tồn kho khác 0: (tên, tồn kho, nhóm hoặc None nếu nhóm bị loại trừ)
+            stocked_products = []
+
+            # Danh sách các nhóm bị loại trừ
+            excluded_groups = ["Nước rửa chén"]
+
+            # Dict lưu trữ sản phẩm theo nhóm (tất cả các nhóm trong file, ngoại trừ các nhóm bị loại trừ)
+            filtered_data = {}
+
+            # Dictionary để lưu thông tin giá vốn × tồn kho cho từng sản phẩm
+            product_cost_info = {}
+
+            # Xử lý dữ liệu trong một lượt đọc
+            rows = reader.rows(mapping.columns(["group", "name", "stock", "unit_cost"]))
+            for group, product_name, stock, unit_cost_value in rows:
+                product_group = None
+                if group and group not in excluded_groups:
+                    filtered_data.setdefault(group, [])
+                    product_group = group
+
+                if stock != 0:  # Hiển thị cả sản phẩm có tồn kho âm và dương, bỏ qua chỉ = 0
+                    stocked_products.append((str(product_name), stock, product_group))
+
+                    # Tính tổng tiền tồn kho = Giá vốn × Tồn kho
+                    total_cost = 0
+                    if unit_cost_col_index is not None:
+                        if unit_cost_value is not None:
+                            try:
+                                unit_cost = float(unit_cost_value)
+                                total_cost = unit_cost * float(stock)
+                            except (ValueError, TypeError):
+                                row_logger.warning("Giá vốn hoặc tồn kho không hợp lệ cho sản phẩm '%s': giá vốn=%s, tồn kho=%s",
+                                                   product_name, unit_cost_value, stock)
+                                total_cost = 0
+
+                    # Lưu thông tin cost cho sản phẩm này
+                    product_cost_info[product_name] = {
+                        "stock": float(stock),
+                        "total_cost": total_cost
+                    }
+            timer.lap("aggregate")
+
+            # Sắp xếp một lần theo tên sản phẩm, các nhóm được điền theo đúng thứ tự đã sắp xếp
+            stocked_products.sort(key=lambda product: vietnamese_sort_key(product[0]))
+            all_products = []
+            for product_name, stock, product_group in stocked_products:
+                line = f"- {product_name}: {stock}"
+                all_products.append(line)
+                if product_group is not None:
+                    filtered_data[product_group].append(line)
+
+            sorted_groups = sorted(filtered_data.keys(), key=lambda group: vietnamese_sort_key(str(group)))
+            timer.lap("sort")
+
+            # Tạo thông báo về cột thiếu nếu có
+            missing_info = []
+            if missing_columns:
+                missing_info.append(f"File danhsachsanpham thiếu cột: {', '.join(missing_columns)}")
+
+            return {
+                "all_products": all_products,
+                "grouped_products": filtered_data,
+                "sorted_groups": sorted_groups,
+                "product_cost_info": product_cost_info,
+                "missing_columns_info": missing_info
+            }
+
+    except Exception as e:
+        logger.error("Lỗi khi xử lý file Excel cập nhật: %s", e)
+        return f"Lỗi khi xử lý file Excel: {e}"
+
+def process_invoice_file(input_file_path, output_file_path, engine=None):
+    """Xử lý file hóa đơn đơn với tracking missing columns."""
+    try:
+        output = process_excel_file(input_file_path, output_file_path, engine)
+        if output:
+            # Thành công - không có missing columns
+            return report_result(output, [])
+        else:
+            return None
+    except ValueError as e:
+        # Check nếu là lỗi missing columns
+        error_msg = str(e)
+        if "thiếu cột cần thiết" in error_msg:
+            # Extract missing columns info từ error message
+            return report_result(None, [error_msg])
+        else:
+            return None
+    except Exception as e:
+        logger.error("Lỗi khi xử lý file hóa đơn: %s", e)
+        return None
+
+def process_purchase_order_detail_file(file_path, engine=None):
+    """Xử lý file Excel chi tiết đơn mua hàng từ KiotViet."""
+    try:
+        timer = StageTimer()
+        with open_sheet_reader(file_path, engine) as reader:
+            # Tìm các cột quan trọng (khớp chính xác, không phân biệt hoa thường, rồi tìm mờ)
+            logger.debug("Các cột tìm thấy trong file: %s", reader.header)
+            mapping = PURCHASE_ORDER_SCHEMA.resolve(reader.header)
+
+            if mapping.missing_required:
+                logger.error("Không tìm thấy một hoặc nhiều cột cần thiết trong file đơn mua hàng")
+                logger.error("Các cột thiếu: %s", ', '.join(mapping.missing_required))
+                return f"Lỗi: Không tìm thấy các cột cần thiết trong file. Cần có 'Tên nhà cung cấp', 'Tên hàng', 'Số lượng'."
+            timer.lap("load")
+
+            # Chú ý: cột "Giá nhập" là optional, nếu không có thì sẽ skip tính tổng tiền
+            unit_price_col_index = mapping.indices["unit_price"]
+            if unit_price_col_index is None:
+                logger.warning("Không tìm thấy cột 'Giá nhập' - sẽ bỏ qua tính tổng tiền")
+
+            # Dictionary lưu trữ dữ liệu theo nhà cung cấp
+            suppliers_data = {}
+
+            # Duyệt qua các dòng từ dòng thứ 2 (dữ liệu)
+            rows = reader.rows(mapping.columns(["supplier", "name", "quantity", "unit_price"]))
+            for row_idx, (supplier, product_name, quantity, unit_price_value) in enumerate(rows, start=2):
+                # Bỏ qua dòng nếu thiếu thông tin
+                if not supplier or not product_name or quantity is None:
+                    continue
+
+                # Chuyển đổi số lượng sang số
+                try:
+                    quantity_num = float(quantity)
+                    if quantity_num <= 0:
+                        continue
+                except (ValueError, TypeError):
+                    row_logger.warning("Số lượng không hợp lệ ở dòng %s: %s", row_idx, quantity)
+                    continue
+
+                # Lấy giá nhập và tính tổng tiền = giá nhập × số lượng
+                total_price = 0
+                if unit_price_col_index is not None:
+                    if unit_price_value is not None:
+                        try:
+                            unit_price = float(unit_price_value)
+                            total_price = unit_price * quantity_num
+                        except (ValueError, TypeError):
+                            row_logger.warning("Giá nhập không hợp lệ ở dòng %s: %s", row_idx, unit_price_value)
+                            total_price = 0
+
+                # Khởi tạo dictionary cho nhà cung cấp nếu chưa có
+                if supplier not in suppliers_data:
+                    suppliers_data[supplier] = {}
+
+                # Cộng dồn số lượng và tổng tiền cho sản phẩm
+                if product_name in suppliers_data[supplier]:
+                    suppliers_data[supplier][product_name]["quantity"] += quantity_num
+                    suppliers_data[supplier][product_name]["total_price"] += total_price
+                else:
+                    suppliers_data[supplier][product_name] = {
+                        "quantity": quantity_num,
+                        "total_price": total_price
+                    }
+        timer.lap("aggregate")
+
+        # Sắp xếp kết quả theo tên nhà cung cấp (theo bảng chữ cái tiếng Việt)
+        sorted_suppliers = sorted(suppliers_data.keys(), key=lambda supplier: vietnamese_sort_key(str(supplier)))
+        sorted_result = {supplier: suppliers_data[supplier] for supplier in sorted_suppliers}
+        
+        # Với mỗi nhà cung cấp, sắp xếp sản phẩm theo tên
+        for supplier in sorted_result:
+            sorted_products = {k: v for k, v in sorted(sorted_result[supplier].items(), key=lambda item: vietnamese_sort_key(str(item[0])))}
+            sorted_result[supplier] = sorted_products
+        timer.lap("sort")
+        
+        return sorted_result
+    
+    except Exception as e:
+        logger.error("Lỗi khi xử lý file đơn mua hàng: %s", e)
+        return f"Lỗi khi xử lý file đơn mua hàng: {e}"
+
+# ============================================================================
+# METRICS (thời gian từng giai đoạn, kích thước file, endpoint /metrics, cProfile)
+# ============================================================================
+
+# Bucket thời gian (giây) và kích thước file (byte)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = tuple(kb * 1024 for kb in (1, 10, 100, 500, 1024, 5 * 1024, 10 * 1024, 20 * 1024, 50 * 1024))
+
+# Loại file KiotViet (tiền tố tên file) dùng làm nhãn export_type
+EXPORT_FILE_PREFIXES = ("danhsachhoadon_", "soquy_", "danhsachsanpham_", "danhsachchitietdathang_")
+
+_metrics_lock = threading.Lock()
+
+def _format_labels(pairs):
+    """Định dạng nhãn Prometheus: a="x",b="y"."""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+class Histogram:
+    """Histogram kiểu Prometheus (bucket tích lũy), mỗi bộ giá trị nhãn một series."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}   # giá trị nhãn -> [số lượng theo bucket, tổng, số lần, lớn nhất]
+
+    def observe(self, value, *label_values):
+        with _metrics_lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0, 0.0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+            series[3] = max(series[3], value)
+
+    def summary(self):
+        """Trả về {giá trị nhãn: (số lần, tổng, lớn nhất)}."""
+        with _metrics_lock:
+            return {labels: (count, total, peak) for labels, (_, total, count, peak) in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with _metrics_lock:
+            for label_values, (bucket_counts, total, count, _) in sorted(self._series.items()):
+                labels = list(zip(self.label_names, label_values))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{{{_format_labels(labels + [('le', bound)])}}} {cumulative}")
+                lines.append(f"{self.name}_bucket{{{_format_labels(labels + [('le', '+Inf')])}}} {count}")
+                lines.append(f"{self.name}_sum{{{_format_labels(labels)}}} {total}")
+                lines.append(f"{self.name}_count{{{_format_labels(labels)}}} {count}")
+        return lines
+
+class Counter:
+    """Counter kiểu Prometheus theo bộ giá trị nhãn."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with _metrics_lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def summary(self):
+        with _metrics_lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with _metrics_lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{{{_format_labels(zip(self.label_names, label_values))}}} {value}")
+        return lines
+
+STAGE_SECONDS = Histogram("excel_bot_stage_seconds", "Thời gian từng giai đoạn xử lý file",
+                          ("export_type", "stage"), STAGE_BUCKETS)
+FILE_BYTES = Histogram("excel_bot_file_bytes", "Kích thước file nhận vào (in) và gửi ra (out)",
+                       ("export_type", "direction"), SIZE_BUCKETS)
+FILES_TOTAL = Counter("excel_bot_files_total", "Số file nhận được theo kết quả",
+                      ("export_type", "outcome"))
+JOBS_TOTAL = Counter("excel_bot_jobs_total", "Số job chạy trong process pool theo trạng thái",
+                     ("export_type", "job", "status"))
+HTTP_REQUEST_SECONDS = Histogram("excel_bot_http_request_seconds", "Thời gian mỗi lần gọi Bot API theo kết quả",
+                                 ("method", "outcome"), STAGE_BUCKETS)
+HTTP_RETRIES = Counter("excel_bot_http_retries_total", "Số lần gửi lại request Bot API theo lý do",
+                       ("method", "reason"))
+PROXY_PROBE_SECONDS = Histogram("excel_bot_proxy_probe_seconds", "Thời gian kiểm tra proxy (getMe) theo kết quả",
+                                ("proxy", "outcome"), STAGE_BUCKETS)
+PROXY_REQUESTS = Counter("excel_bot_proxy_requests_total", "Số request Bot API qua từng proxy theo kết quả",
+                         ("proxy", "outcome"))
+KIOTVIET_RECORDS = Counter("excel_bot_kiotviet_records_total", "Số bản ghi đồng bộ từ KiotViet API",
+                           ("entity", "action"))
+REPORTS_TOTAL = Counter("excel_bot_reports_total", "Số báo cáo dựng sẵn theo nguồn (lệnh/lịch) và kết quả",
+                        ("report", "trigger", "outcome"))
+
+def get_export_type(file_name):
+    """Trả về loại file theo tiền tố tên (vd: 'soquy'), 'khac' nếu không nhận diện được."""
+    name_lower = (file_name or "").lower()
+    for prefix in EXPORT_FILE_PREFIXES:
+        if name_lower.startswith(prefix):
+            return prefix.rstrip("_")
+    return "khac"
+
+def source_size(source):
+    """Kích thước file nguồn (bytes hoặc đường dẫn)."""
+    return os.path.getsize(source) if isinstance(source, str) else len(source)
+
+def report_output_size(result):
+    """Kích thước file kết quả từ dict của report_result (0 nếu không có)."""
+    if result and result.get('file_data') is not None:
+        return len(result['file_data'])
+    if result and result.get('file_path') and os.path.exists(result['file_path']):
+        return os.path.getsize(result['file_path'])
+    return 0
+
+# Các giai đoạn của job đang chạy trong worker process (None khi không chạy qua run_processing_job)
+_job_stage_records = None
+
+class StageTimer:
+    """Đo các giai đoạn nối tiếp nhau: lap(tên) ghi thời gian kể từ lần lap trước.
+
+    Có export_type (trong handler): ghi thẳng vào STAGE_SECONDS. Không có (trong các
+    hàm process_*): ghi vào job đang chạy, run_processing_job gửi về process chính.
+    """
+
+    def __init__(self, export_type=None):
+        self.export_type = export_type
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        if self.export_type is not None:
+            STAGE_SECONDS.observe(elapsed, self.export_type, stage)
+        elif _job_stage_records is not None:
+            _job_stage_records.append((stage, elapsed))
+        return elapsed
+
+def _run_instrumented(func, args, profile=False):
+    """Chạy func trong worker, trả về (kết quả, các giai đoạn đã đo, cProfile stats dạng marshal)."""
+    global _job_stage_records
+    _job_stage_records = stages = []
+    profiler = cProfile.Profile() if profile else None
+    try:
+        result = profiler.runcall(func, *args) if profiler else func(*args)
+    finally:
+        _job_stage_records = None
+    profile_data = None
+    if profiler:
+        profiler.create_stats()
+        # Cùng định dạng với Profile.dump_stats, đọc lại bằng pstats.Stats(đường dẫn)
+        profile_data = marshal.dumps(profiler.stats)
+    return result, stages, profile_data
+
+class SlowJobProfiles:
+    """Giữ file cProfile (.prof) của limit job chậm nhất trong directory."""
+
+    def __init__(self, limit, directory):
+        self.limit = limit
+        self.directory = directory
+        self._heap = []     # (giây, đường dẫn), job nhanh nhất ở đầu
+
+    def offer(self, seconds, export_type, job_name, profile_data):
+        """Lưu profile nếu job thuộc nhóm chậm nhất, xóa profile bị đẩy ra."""
+        if self.limit <= 0 or not profile_data:
+            return None
+        if len(self._heap) >= self.limit and seconds <= self._heap[0][0]:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{export_type}_{job_name}_{seconds:.2f}s.prof"
+            )
+            with open(path, 'wb') as f:
+                f.write(profile_data)
+        except OSError as e:
+            logger.warning("Không thể lưu cProfile của job %s: %s", job_name, e)
+            return None
+        heapq.heappush(self._heap, (seconds, path))
+        if len(self._heap) > self.limit:
+            _, evicted_path = heapq.heappop(self._heap)
+            try:
+                os.remove(evicted_path)
+            except OSError:
+                pass
+        logger.info("Đã lưu cProfile job chậm (%.2fs): %s", seconds, path)
+        return path
+
+    def slowest(self):
+        """Danh sách (giây, đường dẫn) từ chậm nhất."""
+        return sorted(self._heap, reverse=True)
+
+slow_job_profiles = SlowJobProfiles(PROFILE_SLOWEST_JOBS, PROFILE_DIR)
+
+def render_metrics():
+    """Toàn bộ metrics ở định dạng text của Prometheus."""
+    lines = []
+    for metric in (STAGE_SECONDS, FILE_BYTES, FILES_TOTAL, JOBS_TOTAL, HTTP_REQUEST_SECONDS, HTTP_RETRIES,
+                   PROXY_PROBE_SECONDS, PROXY_REQUESTS, KIOTVIET_RECORDS, REPORTS_TOTAL):
+        lines.extend(metric.render())
+    if proxy_pool is not None:
+        lines.append("# HELP excel_bot_proxy_healthy Proxy đang khỏe (1) hay bị bỏ qua (0)")
+        lines.append("# TYPE excel_bot_proxy_healthy gauge")
+        for route in proxy_pool.routes:
+            lines.append(f"excel_bot_proxy_healthy{{{_format_labels([('proxy', route.name)])}}} {int(route.healthy)}")
+    lines.append("# HELP excel_bot_jobs_running Số job đang chạy")
+    lines.append("# TYPE excel_bot_jobs_running gauge")
+    lines.append(f"excel_bot_jobs_running {job_scheduler.running}")
+    lines.append("# HELP excel_bot_jobs_queued Số job đang chờ trong hàng đợi")
+    lines.append("# TYPE excel_bot_jobs_queued gauge")
+    lines.append(f"excel_bot_jobs_queued {job_scheduler.queued}")
+    return "\n".join(lines) + "\n"
+
+def render_stats_blocks():
+    """Các khối tin nhắn cho lệnh /stats (số file, thời gian từng giai đoạn, job chậm)."""
+    blocks = [[
+        "📊 Thống kê xử lý",
+        f"Hàng đợi: {job_scheduler.running} đang chạy, {job_scheduler.queued} đang chờ",
+        "",
+    ]]
+    stages = STAGE_SECONDS.summary()
+    sizes = FILE_BYTES.summary()
+    outcomes = FILES_TOTAL.summary()
+    export_types = sorted({labels[0] for labels in list(stages) + list(sizes) + list(outcomes)})
+    for export_type in export_types:
+        counts = ", ".join(f"{outcome}: {count}" for (kind, outcome), count in outcomes.items() if kind == export_type)
+        lines = [f"📁 {export_type}" + (f" ({counts})" if counts else "")]
+        for (kind, stage), (count, total, peak) in stages.items():
+            if kind == export_type:
+                lines.append(f"• {stage}: {count} lần, TB {total / count:.2f}s, max {peak:.2f}s")
+        for (kind, direction), (count, total, peak) in sizes.items():
+            if kind == export_type:
+                lines.append(f"• file {direction}: {count} file, TB {total / count / 1024:.0f}KB, max {peak / 1024:.0f}KB")
+        lines.append("")
+        blocks.append(lines)
+    if len(blocks) == 1:
+        blocks.append(["Chưa có file nào được xử lý."])
+    requests = HTTP_REQUEST_SECONDS.summary()
+    if requests:
+        retries = HTTP_RETRIES.summary()
+        lines = ["🌐 Bot API"]
+        for method in sorted({labels[0] for labels in requests}):
+            count = sum(n for (name, _), (n, _, _) in requests.items() if name == method)
+            total = sum(t for (name, _), (_, t, _) in requests.items() if name == method)
+            peak = max(p for (name, _), (_, _, p) in requests.items() if name == method)
+            failed = sum(n for (name, outcome), (n, _, _) in requests.items() if name == method and outcome != "ok")
+            retried = sum(n for (name, _), n in retries.items() if name == method)
+            lines.append(f"• {method}: {count} lần, TB {total / count:.2f}s, max {peak:.2f}s, "
+                         f"lỗi {failed}, thử lại {retried}")
+        lines.append("")
+        blocks.append(lines)
+    if proxy_pool is not None:
+        lines = ["🔀 Proxy"]
+        for route in proxy_pool.routes:
+            status = "✅" if route.healthy else "❌"
+            latency = f"{route.latency * 1000:.0f}ms" if route.latency is not None else "-"
+            active = " (đang dùng)" if route is proxy_pool.current else ""
+            lines.append(f"• {status} {route.name}{active}: độ trễ {latency}, lỗi {route.error_rate:.0%}")
+        lines.append("")
+        blocks.append(lines)
+    reports = REPORTS_TOTAL.summary()
+    if reports:
+        lines = ["🗓 Báo cáo dựng sẵn"]
+        for (report, trigger, outcome), count in sorted(reports.items()):
+            lines.append(f"• {report} ({trigger}): {outcome} {count}")
+        lines.append("")
+        blocks.append(lines)
+    profiles = slow_job_profiles.slowest()
+    if profiles:
+        blocks.append(["🐢 Job chậm nhất (cProfile):",
+                       *(f"• {seconds:.2f}s: {path}" for seconds, path in profiles)])
+    return blocks
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Trả về metrics tại GET /metrics."""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Không ghi log cho mỗi lần scrape
+        pass
+
+_metrics_server = None
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Chạy HTTP server cho /metrics trong thread nền (không làm gì nếu port = 0)."""
+    global _metrics_server
+    if not port or _metrics_server is not None:
+        return
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as e:
+        logger.error("Không thể mở cổng metrics %s:%s: %s", host, port, e)
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    _metrics_server = server
+    logger.info("Metrics: http://%s:%s/metrics", host, port)
+
+def stop_metrics_server():
+    """Dừng HTTP server của /metrics."""
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
+
+# ============================================================================
+# PROCESS POOL (chạy xử lý Excel ngoài event loop)
+# ============================================================================
+
+class ProcessingJobError(Exception):
+    """Lỗi khi chạy job xử lý trong process pool (timeout, worker bị crash...)."""
+
+_process_pool = None
+_pool_jobs = {}          # pool -> số job đang chạy trên pool
+_retired_pools = set()   # Pool có job quá thời gian: không nhận job mới, dừng hẳn khi hết job
+
+def _init_worker(log_queue=None):
+    """Khởi tạo worker process: cấu hình logging và nạp sẵn template báo cáo.
+
+    log_queue: hàng đợi của setup_logging, bản ghi được format trong worker rồi gửi về process chính.
+    """
+    if log_queue is not None:
+        logging.getLogger().addHandler(QueueHandler(log_queue))
+    else:
+        logging.basicConfig(format=LOG_FORMAT)
+    configure_log_levels()
+    try:
+        get_report_template()
+    except Exception as e:
+        logger.error("Worker không thể nạp template báo cáo: %s", e)
+
+def get_process_pool():
+    """Trả về process pool dùng chung, tạo mới nếu chưa có hoặc đã bị hỏng."""
+    global _process_pool
+    if _process_pool is None:
+        max_workers = PROCESS_POOL_WORKERS or os.cpu_count() or 1
+        # Dùng "spawn" để worker không kế thừa event loop và các thread của bot
+        _process_pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(_worker_log_queue,)
+        )
+        logger.info("Đã khởi tạo process pool với %s worker", max_workers)
+    return _process_pool
+
+def shutdown_process_pool(wait=True):
+    """Dừng process pool (gọi khi bot tắt)."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait, cancel_futures=True)
+        _process_pool = None
+        logger.info("Đã dừng process pool")
+
+def kill_retired_process_pools():
+    """Kill các pool còn worker chạy job quá thời gian (gọi khi bot tắt, tránh chờ các worker đó)."""
+    for pool in list(_retired_pools):
+        _kill_process_pool(pool)
+
+def _kill_process_pool(pool):
+    """Kill các worker của pool (kể cả worker đang chạy job) và bỏ pool."""
+    _retired_pools.discard(pool)
+    _pool_jobs.pop(pool, None)
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.kill()
+    logger.warning("Đã dừng %s worker của process pool có job quá thời gian", len(processes))
+
+def _retire_process_pool(pool):
+    """Ngừng giao job cho pool có job quá thời gian: job mới chạy trên pool mới.
+
+    Worker vẫn đang chạy job quá thời gian nên pool chỉ bị kill khi các job khác
+    trên pool đã xong, tránh làm hỏng job của user khác.
+    """
+    global _process_pool
+    if _process_pool is pool:
+        _process_pool = None
+    _retired_pools.add(pool)
+
+def _release_pool_job(pool):
+    _pool_jobs[pool] = _pool_jobs.get(pool, 1) - 1
+    if _pool_jobs[pool] <= 0:
+        del _pool_jobs[pool]
+        if pool in _retired_pools:
+            _kill_process_pool(pool)
+
+async def run_processing_job(func, *args, timeout=None, export_type=None):
+    """Chạy một hàm xử lý (process_*) trong process pool mà không chặn event loop.
+
+    Thời gian từng giai đoạn (StageTimer trong hàm xử lý) và tổng thời gian job
+    được ghi vào STAGE_SECONDS theo export_type.
+
+    Args:
+        func: Hàm cấp module (picklable) cần chạy
+        *args: Tham số picklable truyền cho hàm
+        timeout: Thời gian tối đa (giây), mặc định PROCESS_JOB_TIMEOUT
+        export_type: Nhãn loại file cho metrics (mặc định là tên hàm)
+
+    Raises:
+        ProcessingJobError: Job quá thời gian, worker bị crash hoặc dữ liệu không picklable
+    """
+    global _process_pool
+    timeout = timeout or PROCESS_JOB_TIMEOUT
+    job_name = getattr(func, "__name__", repr(func))
+    export_type = export_type or job_name
+    # Kiểm tra trước khi gửi: hàm/tham số không picklable (lambda, hàm lồng, file handle...).
+    # Lỗi AttributeError/TypeError của chính hàm xử lý trong worker được trả về nguyên vẹn.
+    try:
+        pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        JOBS_TOTAL.inc(export_type, job_name, "error")
+        logger.error("Không thể gửi job %s sang worker: %s", job_name, e)
+        raise ProcessingJobError(f"Dữ liệu job không hợp lệ: {e}")
+    pool = get_process_pool()
+    _pool_jobs[pool] = _pool_jobs.get(pool, 0) + 1
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    status = "error"
+
+    try:
+        result, stages, profile_data = await asyncio.wait_for(
+            loop.run_in_executor(pool, _run_instrumented, func, args, PROFILE_SLOWEST_JOBS > 0),
+            timeout
+        )
+        status = "ok"
+    except asyncio.TimeoutError:
+        status = "timeout"
+        logger.error("Job %s vượt quá %s giây", job_name, timeout)
+        # wait_for chỉ bỏ future, worker vẫn chạy tiếp và giữ slot của pool
+        _retire_process_pool(pool)
+        raise ProcessingJobError(f"Xử lý quá thời gian cho phép ({timeout} giây)")
+    except BrokenProcessPool as e:
+        # Worker chết đột ngột (hết bộ nhớ, bị kill...) - tạo lại pool cho các job sau
+        status = "crashed"
+        logger.error("Worker bị crash khi chạy %s: %s", job_name, e)
+        if _process_pool is pool:
+            shutdown_process_pool(wait=False)
+        raise ProcessingJobError("Tiến trình xử lý bị dừng đột ngột, vui lòng thử lại")
+    finally:
+        JOBS_TOTAL.inc(export_type, job_name, status)
+        _release_pool_job(pool)
+
+    elapsed = time.perf_counter() - started
+    for stage, seconds in stages:
+        STAGE_SECONDS.observe(seconds, export_type, stage)
+    STAGE_SECONDS.observe(elapsed, export_type, "process")
+    slow_job_profiles.offer(elapsed, export_type, job_name, profile_data)
+    return result
+
+async def combine_report_files(file_paths, output_file_path, file_names=None):
+    """Tổng hợp nhiều file hóa đơn/sổ quỹ theo kiểu map-reduce trên process pool.
+
+    Mỗi file được đọc song song trong một worker; kết quả được gộp theo đúng
+    thứ tự file_paths nên báo cáo luôn giống nhau với cùng đầu vào.
+    file_paths có thể chứa bytes (kèm file_names), output_file_path None = trả về bytes.
+    """
+    file_names = list(file_names) if file_names is not None else [None] * len(file_paths)
+    parts = await asyncio.gather(*(
+        run_processing_job(process_single_file, source, name, export_type=get_export_type(name))
+        for source, name in zip(file_paths, file_names)
+    ))
+    return await run_processing_job(render_combined_report, list(parts), output_file_path, export_type="tonghop")
+
+# ============================================================================
+# JOB SCHEDULER (thứ tự theo user, giới hạn đồng thời, hàng đợi có giới hạn)
+# ============================================================================
+
+class QueueFullError(Exception):
+    """Hàng đợi xử lý đã đầy (của user hoặc toàn bot)."""
+
+class JobScheduler:
+    """Điều phối các job xử lý file giữa các user.
+
+    - Mỗi user có hàng đợi FIFO riêng và chỉ chạy một job tại một thời điểm,
+      nên trạng thái trong user_data (file hóa đơn/sổ quỹ đang chờ) không bị tranh chấp.
+    - Tổng số job chạy đồng thời không vượt quá max_concurrent.
+    - Khi có slot trống, các user đang chờ được phục vụ lần lượt (round-robin),
+      user gửi nhiều file không chặn các user khác.
+    - Hàng đợi có giới hạn theo user và toàn bot; vượt giới hạn thì từ chối ngay.
+    """
+
+    def __init__(self, max_concurrent, max_queued, max_user_queued):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_user_queued = max_user_queued
+        self.running = 0
+        self.queued = 0
+        self._pending = {}        # user_id -> deque các future chờ đến lượt
+        self._active = set()      # user_id đang có job chạy
+        self._ready = deque()     # user_id có job chờ và không có job đang chạy (round-robin)
+
+    def _position(self, user_id):
+        """Ước lượng vị trí của job vừa thêm của user trong thứ tự chạy."""
+        own_ahead = len(self._pending[user_id]) - 1
+        others_ahead = sum(min(len(pending), own_ahead + 1)
+                           for other_id, pending in self._pending.items() if other_id != user_id)
+        return own_ahead + others_ahead + 1
+
+    def _dispatch(self):
+        """Cho các job đến lượt bắt đầu chạy khi còn slot trống."""
+        while self.running < self.max_concurrent and self._ready:
+            user_id = self._ready.popleft()
+            waiter = self._pending[user_id].popleft()
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+            self.queued -= 1
+            self.running += 1
+            self._active.add(user_id)
+            waiter.set_result(None)
+
+    def _finish(self, user_id):
+        self.running -= 1
+        self._active.discard(user_id)
+        # User còn job chờ thì xếp xuống cuối vòng, nhường lượt cho user khác
+        if user_id in self._pending:
+            self._ready.append(user_id)
+        self._dispatch()
+
+    async def run(self, user_id, job, on_queued=None):
+        """Chạy job() (coroutine function) theo thứ tự của user_id.
+
+        Args:
+            on_queued: Coroutine function nhận vị trí trong hàng đợi, gọi khi job phải chờ
+
+        Raises:
+            QueueFullError: Hàng đợi của user hoặc của bot đã đầy
+        """
+        pending = self._pending.get(user_id)
+        if pending is not None and len(pending) >= self.max_user_queued:
+            raise QueueFullError(f"Bạn đang có {len(pending)} file chờ xử lý")
+        if self.queued >= self.max_queued:
+            raise QueueFullError("Bot đang có quá nhiều file chờ xử lý")
+
+        waiter = asyncio.get_running_loop().create_future()
+        if pending is None:
+            pending = self._pending[user_id] = deque()
+            if user_id not in self._active:
+                self._ready.append(user_id)
+        pending.append(waiter)
+        self.queued += 1
+        self._dispatch()
+
+        if not waiter.done():
+            try:
+                if on_queued is not None:
+                    try:
+                        await on_queued(self._position(user_id))
+                    except Exception as e:
+                        # Không báo được vị trí (RetryAfter, TimedOut, Forbidden...) thì vẫn giữ chỗ trong hàng đợi
+                        logger.warning("Không báo được vị trí hàng đợi cho user %s: %s", user_id, e)
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    # Đã được cấp slot ngay trước khi bị hủy
+                    self._finish(user_id)
+                else:
+                    self._cancel_waiter(user_id, waiter)
+                raise
+
+        try:
+            return await job()
+        finally:
+            self._finish(user_id)
+
+    def _cancel_waiter(self, user_id, waiter):
+        pending = self._pending.get(user_id)
+        if pending is None or waiter not in pending:
+            return
+        pending.remove(waiter)
+        self.queued -= 1
+        if not pending:
+            del self._pending[user_id]
+            if user_id in self._ready:
+                self._ready.remove(user_id)
+
+job_scheduler = JobScheduler(MAX_CONCURRENT_JOBS, MAX_QUEUED_JOBS, MAX_USER_QUEUED_JOBS)
+
+# ============================================================================
+# RESULT CACHE (kết quả của file đã xử lý trước đó)
+# ============================================================================
+
+# Tăng khi thay đổi cách xử lý/render để bỏ qua các entry cũ trên đĩa
+RESULT_CACHE_VERSION = 2
+
+# Loại file có kết quả chỉ phụ thuộc nội dung file
+CACHEABLE_FILE_PREFIXES = ("danhsachhoadon_", "danhsachsanpham_", "danhsachchitietdathang_")
+
+class ResultCache:
+    """Cache 2 tầng cho kết quả xử lý file.
+
+    Tầng 1: file_unique_id của Telegram -> trả lời ngay, không cần tải file.
+    Tầng 2: SHA-256 nội dung file -> đã tải nhưng không cần xử lý lại.
+
+    Mỗi entry (các tin nhắn đã render hoặc file_id của file kết quả) được lưu thành
+    một file JSON trong cache_dir. Khi tổng dung lượng vượt max_bytes, entry lâu
+    không dùng nhất bị xóa trước (LRU, thứ tự truy cập lưu bằng mtime của file).
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> entry, entry ít dùng nhất ở đầu
+        self._sizes = {}
+        self._unique_ids = {}          # (kind, file_unique_id) -> key
+        self._loaded = False
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def _key(kind, content_hash):
+        return f"{kind}_{content_hash}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _ensure_loaded(self):
+        """Nạp các entry đã lưu trên đĩa (lần đầu dùng cache)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        stored = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+                stat = os.stat(path)
+            except (OSError, ValueError) as e:
+                logger.warning("Bỏ qua entry cache lỗi %s: %s", name, e)
+                continue
+            if entry.get('version') != RESULT_CACHE_VERSION:
+                self._delete_file(name[:-len(".json")])
+                continue
+            stored.append((stat.st_mtime, name[:-len(".json")], entry, stat.st_size))
+
+        for _, key, entry, size in sorted(stored, key=itemgetter(0)):
+            self._add(key, entry, size)
+        self._evict()
+        logger.info("Đã nạp %s kết quả từ cache (%.0fKB)", len(self._entries), self.total_bytes / 1024)
+
+    def _add(self, key, entry, size):
+        self._entries[key] = entry
+        self._sizes[key] = size
+        self.total_bytes += size
+        for file_unique_id in entry.get('file_unique_ids', []):
+            self._unique_ids[(entry['kind'], file_unique_id)] = key
+
+    def _remove(self, key, delete_file=True):
+        entry = self._entries.pop(key)
+        self.total_bytes -= self._sizes.pop(key)
+        for file_unique_id in entry.get('file_unique_ids', []):
+            if self._unique_ids.get((entry['kind'], file_unique_id)) == key:
+                del self._unique_ids[(entry['kind'], file_unique_id)]
+        if delete_file:
+            self._delete_file(key)
+        return entry
+
+    def _delete_file(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Xóa các entry ít dùng nhất cho đến khi không vượt quá dung lượng cho phép."""
+        while self._entries and self.total_bytes > self.max_bytes:
+            key = next(iter(self._entries))
+            self._remove(key)
+            logger.info("Đã xóa entry cache %s (vượt quá %.0fMB)", key, self.max_bytes / (1024 * 1024))
+
+    def get(self, kind, content_hash=None, file_unique_id=None):
+        """Tìm kết quả theo file_unique_id (tầng 1) hoặc SHA-256 (tầng 2), None nếu không có."""
+        if not self.enabled:
+            return None
+        self._ensure_loaded()
+        if file_unique_id is not None:
+            key = self._unique_ids.get((kind, file_unique_id))
+        else:
+            key = self._key(kind, content_hash)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        self._entries.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return entry
+
+    def put(self, kind, content_hash, file_unique_id=None, **payload):
+        """Lưu kết quả (messages, file_id, caption...) cho file có nội dung content_hash."""
+        if not self.enabled:
+            return
+        self._ensure_loaded()
+        key = self._key(kind, content_hash)
+        old_entry = self._entries.get(key)
+        file_unique_ids = list(old_entry.get('file_unique_ids', [])) if old_entry else []
+        if file_unique_id and file_unique_id not in file_unique_ids:
+            file_unique_ids.append(file_unique_id)
+        self._store(key, {
+            'version': RESULT_CACHE_VERSION,
+            'kind': kind,
+            'sha256': content_hash,
+            'file_unique_ids': file_unique_ids,
+            **payload
+        })
+
+    def link_unique_id(self, kind, content_hash, file_unique_id):
+        """Gắn thêm file_unique_id cho kết quả đã có (file gửi lại với cùng nội dung)."""
+        key = self._key(kind, content_hash)
+        entry = self._entries.get(key)
+        if entry is None or not file_unique_id or file_unique_id in entry.get('file_unique_ids', []):
+            return
+        self._store(key, {**entry, 'file_unique_ids': entry.get('file_unique_ids', []) + [file_unique_id]})
+
+    def _store(self, key, entry):
+        """Ghi entry ra đĩa (ghi file tạm rồi đổi tên) và cập nhật chỉ mục trong bộ nhớ."""
+        if key in self._entries:
+            self._remove(key, delete_file=False)
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = self._path(key) + ".tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            # Không ghi được ra đĩa thì vẫn giữ trong bộ nhớ
+            logger.warning("Không thể ghi cache %s: %s", key, e)
+
+        self._add(key, entry, len(data))
+        self._evict()
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+class StoredExport(NamedTuple):
+    """File export đã lưu của StoredExports."""
+    path: str
+    content_hash: str
+    saved_at: datetime
+
+class StoredExports:
+    """File export gửi gần nhất của từng loại, làm đầu vào cho báo cáo định kỳ khi không dùng KiotViet API.
+
+    Mỗi loại giữ một file trong store_dir, đặt tên theo SHA-256 nội dung ({loại}_{sha256}.xlsx)
+    nên tên file vẫn nhận diện được loại và gửi lại cùng nội dung không phải ghi lại.
+    Gửi file mới cùng loại thì file cũ bị xóa.
+    """
+
+    KINDS = ("danhsachhoadon", "soquy", "danhsachsanpham", "danhsachchitietdathang")
+
+    def __init__(self, store_dir, enabled=True):
+        self.store_dir = store_dir
+        self.enabled = enabled
+
+    @classmethod
+    def kind_of(cls, file_name):
+        name_lower = file_name.lower()
+        return next((kind for kind in cls.KINDS if name_lower.startswith(f"{kind}_")), None)
+
+    def _stored(self, kind):
+        try:
+            names = os.listdir(self.store_dir)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.store_dir, name) for name in names
+                if name.startswith(f"{kind}_") and name.endswith(".xlsx")]
+
+    def save(self, file_name, content_hash, source):
+        """Lưu file vừa gửi (bytes hoặc đường dẫn) làm file mới nhất của loại tương ứng."""
+        kind = self.kind_of(file_name)
+        if kind is None:
+            return
+        path = os.path.join(self.store_dir, f"{kind}_{content_hash}.xlsx")
+        try:
+            os.makedirs(self.store_dir, exist_ok=True)
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                temp_path = f"{path}.tmp"
+                if isinstance(source, str):
+                    shutil.copyfile(source, temp_path)
+                else:
+                    with open(temp_path, 'wb') as f:
+                        f.write(source)
+                os.replace(temp_path, path)
+            for old_path in self._stored(kind):
+                if old_path != path:
+                    os.remove(old_path)
+        except OSError as e:
+            logger.warning("Không lưu được file %s cho báo cáo định kỳ: %s", file_name, e)
+
+    def latest(self, kind):
+        """File đã lưu mới nhất của loại kind, None nếu chưa có."""
+        stored = []
+        for path in self._stored(kind):
+            try:
+                stored.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        if not stored:
+            return None
+        mtime, path = max(stored)
+        content_hash = os.path.basename(path)[len(kind) + 1:-len(".xlsx")]
+        return StoredExport(path, content_hash, datetime.fromtimestamp(mtime))
+
+# Chỉ cần lưu file khi báo cáo định kỳ không lấy dữ liệu từ KiotViet API
+stored_exports = StoredExports(os.path.join(RESULT_CACHE_DIR, "inputs"),
+                               enabled=bool(REPORT_SCHEDULE) and not KIOTVIET_ENABLED)
+
+def get_cache_kind(file_name, user_data):
+    """Trả về loại file nếu kết quả xử lý cache được, None nếu không."""
+    if not result_cache.enabled:
+        return None
+    name_lower = file_name.lower()
+    for prefix in CACHEABLE_FILE_PREFIXES:
+        if name_lower.startswith(prefix):
+            # Hóa đơn khi đang có sổ quỹ chờ sẽ được tổng hợp (phụ thuộc các file khác) → không cache
+            if prefix == "danhsachhoadon_" and user_data.get('soquy_files'):
+                return None
+            return prefix.rstrip("_")
+    return None
+
+def hash_source(source):
+    """Tính SHA-256 của file (bytes hoặc đường dẫn)."""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+async def reply_cached_result(message, entry):
+    """Gửi lại kết quả đã cache (file theo file_id, không upload lại; hoặc các tin nhắn).
+
+    Entry chưa có file_id mà có nội dung file (file_data, base64) thì upload file đó.
+
+    Returns:
+        Tin nhắn chứa file vừa upload (để lưu file_id), None nếu không upload
+    """
+    uploaded = None
+    if entry.get('file_id'):
+        await message.reply_document(document=entry['file_id'], caption=entry.get('caption'))
+    elif entry.get('file_data'):
+        uploaded = await message.reply_document(document=base64.b64decode(entry['file_data']),
+                                                filename=entry.get('file_name'), caption=entry.get('caption'))
+    if entry.get('messages'):
+        await send_result_pages(message, entry['messages'], entry.get('groups', ()))
+    return uploaded
+
+class PayrollDocument(NamedTuple):
+    """File bảng lương đã decode từ BANGLUONG (giữ trong bộ nhớ)."""
+    source: str          # Giá trị BANGLUONG đã dùng để decode
+    data: bytes
+    content_hash: str    # SHA-256 của data, dùng làm khóa cho file_id đã upload
+
+_payroll_document = None
+_payroll_file_ids = {}   # content_hash -> file_id trên Telegram
+
+def get_payroll_document():
+    """Trả về file bảng lương đã decode (decode lại khi BANGLUONG thay đổi), None nếu chưa cấu hình.
+
+    Raises:
+        binascii.Error: BANGLUONG không phải base64 hợp lệ
+    """
+    global _payroll_document
+    source = os.getenv("BANGLUONG") or BANGLUONG
+    if not source:
+        return None
+    if _payroll_document is None or _payroll_document.source != source:
+        data = base64.b64decode(source)
+        _payroll_document = PayrollDocument(source, data, hashlib.sha256(data).hexdigest())
+        logger.info("Đã nạp file bảng lương (%s bytes)", len(data))
+    return _payroll_document
+
+def get_payroll_file_id(content_hash):
+    """file_id của bảng lương đã upload với đúng nội dung content_hash (None nếu chưa upload)."""
+    file_id = _payroll_file_ids.get(content_hash)
+    if file_id is None:
+        entry = result_cache.get("bangluong", content_hash=content_hash)
+        if entry is not None:
+            file_id = _payroll_file_ids[content_hash] = entry.get('file_id')
+    return file_id
+
+def set_payroll_file_id(content_hash, file_id):
+    """Lưu (hoặc xóa, nếu file_id là None) file_id của bảng lương."""
+    if file_id is None:
+        _payroll_file_ids.pop(content_hash, None)
+        return
+    _payroll_file_ids[content_hash] = file_id
+    result_cache.put("bangluong", content_hash, file_id=file_id)
+
+# ============================================================================
+# HTTP TRANSPORT (connection pool tới Bot API, gửi lại khi lỗi mạng tạm thời)
+# ============================================================================
+
+# Method gọi lại nhiều lần vẫn cho cùng kết quả; tải file (GET /file/bot...) cũng vậy
+IDEMPOTENT_API_PREFIXES = ("get", "edit")
+IDEMPOTENT_API_METHODS = frozenset({"setWebhook", "deleteWebhook", "setMyCommands", "deleteMyCommands"})
+# Lỗi tạm thời phía server/proxy
+RETRYABLE_HTTP_STATUSES = frozenset({500, 502, 503, 504})
+# Lỗi chắc chắn xảy ra trước khi request được gửi đi (gửi lại không thể bị trùng)
+_NOT_SENT_REASONS = ("connect", "pool_timeout")
+
+def api_method_name(url):
+    """Tên method Bot API từ URL (…/bot<token>/sendMessage), 'download' với URL tải file."""
+    if "/file/bot" in url:
+        return "download"
+    return url.rsplit("/", 1)[-1].split("?", 1)[0] or "unknown"
+
+def is_idempotent_api_method(api_method):
+    return api_method == "download" or api_method.startswith(IDEMPOTENT_API_PREFIXES) \
+        or api_method in IDEMPOTENT_API_METHODS
+
+def _transport_error_reason(error):
+    """Phân loại lỗi mạng do HTTPXRequest ném ra (lỗi httpx gốc nằm trong __cause__)."""
+    cause = error.__cause__
+    if isinstance(cause, httpx.PoolTimeout):
+        return "pool_timeout"
+    if isinstance(cause, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return "connect"
+    if isinstance(cause, (httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError)):
+        return "disconnected"
+    if isinstance(error, TimedOut):
+        return "timeout"
+    return "network"
+
+def retry_backoff(attempt, base=RETRY_DELAY, cap=RETRY_MAX_DELAY):
+    """Thời gian chờ trước lần gửi lại thứ attempt: lũy thừa từ base (tối đa cap),
+    nửa cố định, nửa ngẫu nhiên để các request lỗi cùng lúc không gửi lại dồn một lượt."""
+    ceiling = min(cap, base * 2 ** (attempt - 1))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+def _http_request_kwargs(pool_size, proxy=None):
+    """Tham số HTTPXRequest: pool keep-alive pool_size kết nối, timeout theo cấu hình network."""
+    return {
+        "connection_pool_size": pool_size,
+        "read_timeout": NETWORK_TIMEOUT,
+        "write_timeout": NETWORK_TIMEOUT,
+        "media_write_timeout": NETWORK_TIMEOUT,
+        "connect_timeout": HTTP_CONNECT_TIMEOUT,
+        "pool_timeout": HTTP_POOL_TIMEOUT,
+        "proxy": proxy,
+        "httpx_kwargs": {"limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )},
+    }
+
+class ProxyRoute:
+    """Một proxy tới Bot API: client HTTP riêng, độ trễ và tỉ lệ lỗi gần đây."""
+
+    def __init__(self, name, proxy_url, request):
+        self.name = name
+        self.proxy_url = proxy_url
+        self.request = request
+        self.latencies = deque(maxlen=5)     # giây, từ các lần kiểm tra thành công
+        self.outcomes = deque(maxlen=20)     # True = thành công
+        self.consecutive_failures = 0
+
+    def record(self, ok, unreachable=False):
+        """Ghi kết quả một request; không kết nối được tới proxy thì bỏ qua proxy ngay."""
+        self.outcomes.append(ok)
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures = PROXY_MAX_FAILURES if unreachable else self.consecutive_failures + 1
+        PROXY_REQUESTS.inc(self.name, "ok" if ok else "error")
+
+    @property
+    def healthy(self):
+        return self.consecutive_failures < PROXY_MAX_FAILURES
+
+    @property
+    def latency(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else None
+
+    @property
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    @property
+    def score(self):
+        """Càng nhỏ càng tốt: độ trễ trung bình, phạt theo tỉ lệ lỗi (chưa đo = xếp sau)."""
+        latency = self.latency
+        if latency is None:
+            return float("inf")
+        return latency / max(0.1, 1 - self.error_rate)
+
+class ProxyPool:
+    """Các proxy tới Bot API: kiểm tra định kỳ bằng getMe, chọn proxy khỏe nhanh nhất cho mỗi request.
+
+    Proxy lỗi PROXY_MAX_FAILURES lần liên tiếp (hoặc không kết nối được) bị bỏ qua cho đến
+    khi lần kiểm tra sau thành công; nếu mọi proxy đều lỗi vẫn dùng proxy tốt nhất còn lại.
+    """
+
+    def __init__(self, routes, probe_url, check_interval=PROXY_CHECK_INTERVAL):
+        self.routes = routes
+        self.probe_url = probe_url
+        self.check_interval = check_interval
+        self.current = None
+        self._task = None
+
+    @classmethod
+    def from_config(cls, proxies=PROXY_ROUTES, pool_size=HTTP_POOL_SIZE):
+        """Tạo pool từ PROXY_ROUTES, None nếu không bật proxy nào."""
+        if not proxies or not TELEGRAM_TOKEN:
+            return None
+        routes = [ProxyRoute(name, url, HTTPXRequest(**_http_request_kwargs(pool_size, proxy=url))) for name, url in proxies]
+        base_url = f"{TELEGRAM_BASE_URL or 'https://api.telegram.org'}/bot"
+        return cls(routes, f"{base_url}{TELEGRAM_TOKEN}/getMe")
+
+    def select(self, exclude=()):
+        """Proxy cho lần gửi tiếp theo, tránh các proxy đã lỗi trong cùng request (exclude)."""
+        candidates = [route for route in self.routes if route not in exclude] or self.routes
+        route = min([route for route in candidates if route.healthy] or candidates, key=lambda r: r.score)
+        if route is not self.current and not exclude:
+            if self.current is not None:
+                logger.warning("Chuyển proxy: %s -> %s", self.current.name, route.name)
+            self.current = route
+        return route
+
+    async def probe(self, route):
+        """Gọi getMe qua proxy, ghi độ trễ; HTTP < 500 nghĩa là proxy tới được Bot API."""
+        started = time.monotonic()
+        unreachable = False
+        try:
+            code, _ = await route.request.do_request(
+                self.probe_url, "POST", read_timeout=HTTP_CONNECT_TIMEOUT, write_timeout=HTTP_CONNECT_TIMEOUT,
+                connect_timeout=HTTP_CONNECT_TIMEOUT, pool_timeout=HTTP_POOL_TIMEOUT,
+            )
+            ok = code < 500
+        except NetworkError as e:
+            ok = False
+            unreachable = _transport_error_reason(e) == "connect"
+            if route.healthy:
+                logger.warning("Proxy %s không phản hồi: %s: %s", route.name, type(e).__name__, e)
+        elapsed = time.monotonic() - started
+        PROXY_PROBE_SECONDS.observe(elapsed, route.name, "ok" if ok else "error")
+        if ok:
+            route.latencies.append(elapsed)
+            if not route.healthy:
+                logger.info("Proxy %s hoạt động trở lại (%.0fms)", route.name, elapsed * 1000)
+        route.record(ok, unreachable=unreachable)
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.gather(*(self.probe(route) for route in self.routes))
+            self.select()
+            await asyncio.sleep(self.check_interval)
+
+    async def start(self):
+        if self._task is None:
+            for route in self.routes:
+                await route.request.initialize()
+            self._task = asyncio.create_task(self._check_loop())
+            logger.info("Proxy: %s", ', '.join(route.name for route in self.routes))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            for route in self.routes:
+                await route.request.shutdown()
+
+proxy_pool = ProxyPool.from_config()
+
+class RetryingHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest gửi lại request gặp lỗi mạng tạm thời, chờ theo backoff lũy thừa có jitter.
+
+    - Request chưa được gửi đi (không kết nối được, hết kết nối rảnh trong pool): gửi lại với mọi method.
+    - Lỗi không rõ server đã nhận hay chưa (timeout khi đọc, mất kết nối giữa chừng, HTTP 5xx):
+      chỉ gửi lại method idempotent (get*, edit*, tải file...), tránh gửi trùng tin nhắn/file.
+    - HTTP 429 không xử lý ở đây: PTB ném RetryAfter cho send_message_chunks.
+    Có proxy_pool thì mỗi lần gửi đi qua proxy tốt nhất, lần gửi lại tránh proxy vừa lỗi;
+    proxy cắt kết nối giữa chừng thì request được gửi lại qua proxy khác với mọi method.
+    Mỗi lần gọi được ghi vào HTTP_REQUEST_SECONDS, mỗi lần gửi lại vào HTTP_RETRIES.
+    """
+
+    def __init__(self, *args, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY,
+                 max_retry_delay=RETRY_MAX_DELAY, proxy_pool=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.proxy_pool = proxy_pool
+
+    async def initialize(self):
+        await super().initialize()
+        if self.proxy_pool is not None:
+            await self.proxy_pool.start()
+
+    async def shutdown(self):
+        if self.proxy_pool is not None:
+            await self.proxy_pool.stop()
+        await super().shutdown()
+
+    async def _send(self, route, url, method, request_data, timeouts):
+        if route is None:
+            return await super().do_request(url, method, request_data, **timeouts)
+        return await route.request.do_request(url, method, request_data, **timeouts)
+
+    def retry_backoff(self, attempt):
+        return retry_backoff(attempt, self.retry_delay, self.max_retry_delay)
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = api_method_name(url)
+        idempotent = method == "GET" or is_idempotent_api_method(api_method)
+        attempt = 0
+        failed_routes = set()
+        while True:
+            route = self.proxy_pool.select(exclude=failed_routes) if self.proxy_pool is not None else None
+            started = time.monotonic()
+            try:
+                code, payload = await self._send(route, url, method, request_data, timeouts)
+            except NetworkError as e:
+                reason = _transport_error_reason(e)
+                HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, api_method, reason)
+                if route is not None:
+                    route.record(False, unreachable=reason == "connect")
+                    failed_routes.add(route)
+                # Proxy cắt kết nối giữa chừng: gửi lại qua proxy khác với mọi method,
+                # chấp nhận rủi ro hiếm gặp là gửi trùng thay vì mất file/tin nhắn kết quả
+                proxy_failover = route is not None and reason == "disconnected" and len(self.proxy_pool.routes) > 1
+                if attempt >= self.max_retries or not (idempotent or reason in _NOT_SENT_REASONS or proxy_failover):
+                    raise
+                detail = f"{type(e).__name__}: {e}"
+            else:
+                outcome = "ok" if 200 <= code < 300 else f"http_{code}"
+                HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, api_method, outcome)
+                if route is not None:
+                    route.record(code not in RETRYABLE_HTTP_STATUSES)
+                    if code in RETRYABLE_HTTP_STATUSES:
+                        failed_routes.add(route)
+                if code not in RETRYABLE_HTTP_STATUSES or not idempotent or attempt >= self.max_retries:
+                    if attempt and code == 400 and api_method.startswith("edit") \
+                            and b"message is not modified" in payload:
+                        # Lần gửi trước đã tới Telegram nhưng mất phản hồi: coi như thành công
+                        return 200, b'{"ok":true,"result":true}'
+                    if attempt:
+                        logger.info("%s: HTTP %s sau %s lần gửi lại", api_method, code, attempt)
+                    return code, payload
+                reason = outcome
+                detail = f"HTTP {code}"
+
+            attempt += 1
+            delay = self.retry_backoff(attempt)
+            HTTP_RETRIES.inc(api_method, reason)
+            if route is not None:
+                detail += f", qua {route.name}"
+            logger.warning("Lỗi mạng khi gọi %s (%s), gửi lại lần %s/%s sau %.1fs",
+                           api_method, detail, attempt, self.max_retries, delay)
+            await asyncio.sleep(delay)
+
+def create_bot_request(pool_size=HTTP_POOL_SIZE, retrying=True, proxy_pool=proxy_pool):
+    """Request cho Bot API: pool keep-alive pool_size kết nối, timeout theo cấu hình network.
+
+    retrying=False cho getUpdates (long polling), vốn đã được Updater của PTB tự gọi lại;
+    khi có proxy_pool, getUpdates vẫn đi qua proxy tốt nhất nhưng không tự gửi lại.
+    """
+    if not retrying and proxy_pool is None:
+        return HTTPXRequest(**_http_request_kwargs(pool_size))
+    return RetryingHTTPXRequest(max_retries=MAX_RETRIES if retrying else 0, proxy_pool=proxy_pool,
+                                **_http_request_kwargs(pool_size))
+
+# ============================================================================
+# KIOTVIET API (lấy dữ liệu trực tiếp thay cho file export)
+# ============================================================================
+
+class KiotVietError(Exception):
+    """Lỗi khi lấy dữ liệu từ KiotViet API (sai cấu hình, bị từ chối, server lỗi...)."""
+
+# Tên cột giống file export để dùng chung schema và các hàm process_*
+KIOTVIET_INVOICE_HEADER = ("Mã hóa đơn", "Thời gian", "Khách hàng", "Khách cần trả", "Khách đã trả")
+KIOTVIET_CASHFLOW_HEADER = ("Mã phiếu", "Thời gian", "Loại thu chi", "Người nộp/nhận", "Giá trị", "Ghi chú")
+KIOTVIET_PRODUCT_HEADER = ("Mã hàng", "Nhóm hàng(3 Cấp)", "Tên hàng", "Giá vốn", "Tồn kho")
+KIOTVIET_PURCHASE_ORDER_HEADER = ("Mã đặt hàng nhập", "Thời gian", "Tên nhà cung cấp", "Tên hàng", "Số lượng",
+                                  "Giá nhập")
+
+def _invoice_record_rows(record):
+    return [(record.get("code"), record.get("purchaseDate"), record.get("customerName") or "Khách lẻ",
+             record.get("total") or 0, record.get("totalPayment") or 0)]
+
+def _cashflow_record_rows(record):
+    # Như file export: phiếu thu dương, phiếu chi âm
+    amount = record.get("amount") or 0
+    if "isReceipt" in record:
+        amount = abs(amount) if record["isReceipt"] else -abs(amount)
+    return [(record.get("code"), record.get("transDate"), record.get("cashGroup"), record.get("partnerName"),
+             amount, record.get("description") or None)]
+
+def _product_record_rows(record):
+    inventories = [inventory for inventory in record.get("inventories") or []
+                   if not KIOTVIET_BRANCH_ID or str(inventory.get("branchId")) == KIOTVIET_BRANCH_ID]
+    on_hand = sum(inventory.get("onHand") or 0 for inventory in inventories)
+    cost = next((inventory["cost"] for inventory in inventories if inventory.get("cost") is not None), None)
+    return [(record.get("code"), record.get("categoryName"), record.get("fullName") or record.get("name"),
+             cost, on_hand)]
+
+def _purchase_order_record_rows(record):
+    return [(record.get("code"), record.get("purchaseDate"), record.get("supplierName"), detail.get("productName"),
+             detail.get("quantity"), detail.get("price"))
+            for detail in record.get("purchaseOrderDetails") or []]
+
+class KiotVietEntity(NamedTuple):
+    """Một loại dữ liệu đồng bộ từ KiotViet và cách đổi bản ghi API thành dòng giống file export."""
+    name: str                           # tên endpoint, cũng là tên file checkpoint
+    file_prefix: str                    # loại file export tương ứng (danhsachhoadon...)
+    header: Tuple[str, ...]
+    to_rows: Callable                   # bản ghi API -> danh sách dòng
+    date_field: Optional[str]           # thời gian giao dịch (lọc theo ngày); None = dữ liệu hiện tại
+    window_param: Optional[str] = None  # API không có lastModifiedFrom: đồng bộ lại từ ngày checkpoint
+    params: Tuple[Tuple[str, str], ...] = ()
+
+KIOTVIET_ENTITIES = {entity.name: entity for entity in (
+    KiotVietEntity("invoices", "danhsachhoadon", KIOTVIET_INVOICE_HEADER, _invoice_record_rows, "purchaseDate"),
+    KiotVietEntity("cashflow", "soquy", KIOTVIET_CASHFLOW_HEADER, _cashflow_record_rows, "transDate",
+                   window_param="startDate"),
+    KiotVietEntity("products", "danhsachsanpham", KIOTVIET_PRODUCT_HEADER, _product_record_rows, None,
+                   params=(("includeInventory", "true"), ("includeRemoveIds", "true"))),
+    KiotVietEntity("purchaseorders", "danhsachchitietdathang", KIOTVIET_PURCHASE_ORDER_HEADER,
+                   _purchase_order_record_rows, "purchaseDate", window_param="fromPurchaseDate"),
+)}
+
+def _is_cancelled_record(record):
+    return "hủy" in str(record.get("statusValue") or "").lower()
+
+class KiotVietStore:
+    """Bản sao cục bộ một loại dữ liệu KiotViet ({id: [ngày, các dòng]}) và checkpoint đồng bộ.
+
+    Lưu thành file JSON (ghi file tạm rồi đổi tên); file hỏng hoặc khác phiên bản thì đồng bộ lại từ đầu.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint = None
+        self.records = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Không đọc được checkpoint %s, đồng bộ lại từ đầu: %s", path, e)
+            return
+        if data.get("version") == self.VERSION:
+            self.checkpoint = data.get("checkpoint")
+            self.records = data.get("records", {})
+
+    def prune(self, before_day):
+        """Bỏ các bản ghi có ngày giao dịch trước before_day (YYYY-MM-DD)."""
+        for key in [key for key, (day, _) in self.records.items() if day and day < before_day]:
+            del self.records[key]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": self.VERSION, "checkpoint": self.checkpoint, "records": self.records},
+                      f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+class KiotVietClient:
+    """Đồng bộ dữ liệu từ KiotViet Public API vào KiotVietStore, trả về RecordReader cho các hàm process_*.
+
+    - Token OAuth (client credentials) được giữ đến gần lúc hết hạn, lấy lại khi API trả về 401.
+    - Phân trang bằng pageSize/currentItem: trang đầu cho biết tổng số bản ghi, các trang còn
+      lại tải song song qua pool kết nối keep-alive (KIOTVIET_POOL_SIZE).
+    - Đồng bộ tăng dần: lastModifiedFrom = thời gian sửa lớn nhất đã thấy (lùi SYNC_OVERLAP để
+      không sót), hoặc tải lại từ ngày đồng bộ trước với endpoint chỉ lọc được theo ngày.
+      Lần đầu lấy KIOTVIET_RETENTION_DAYS ngày gần nhất (sản phẩm: toàn bộ).
+    - Lỗi mạng, 429 và 5xx được gửi lại theo retry_backoff (tối đa MAX_RETRIES lần).
+    """
+
+    SYNC_OVERLAP = timedelta(minutes=5)
+
+    def __init__(self, client_id, client_secret, retailer, api_url=KIOTVIET_API_URL, token_url=KIOTVIET_TOKEN_URL,
+                 sync_dir=KIOTVIET_SYNC_DIR, page_size=KIOTVIET_PAGE_SIZE, pool_size=KIOTVIET_POOL_SIZE,
+                 retention_days=KIOTVIET_RETENTION_DAYS):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.retailer = retailer
+        self.api_url = api_url
+        self.token_url = token_url
+        self.sync_dir = sync_dir
+        self.page_size = page_size
+        self.pool_size = pool_size
+        self.retention_days = retention_days
+        self._client = None
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = asyncio.Lock()
+        self._sync_lock = asyncio.Lock()
+        self._stores = {}
+
+    def _http(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(NETWORK_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size,
+                                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def store(self, name):
+        store = self._stores.get(name)
+        if store is None:
+            store = self._stores[name] = KiotVietStore(os.path.join(self.sync_dir, f"{name}.json"))
+        return store
+
+    async def _access_token(self, refresh=False):
+        async with self._token_lock:
+            if refresh or self._token is None or time.monotonic() >= self._token_expires:
+                response = await self._request("POST", self.token_url, "token", authorized=False, data={
+                    "scopes": "PublicApi.Access",
+                    "grant_type": "client_credentials",
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                })
+                payload = self._json(response)
+                if not payload.get("access_token"):
+                    raise KiotVietError("KiotViet không cấp access token, kiểm tra client_id/secret")
+                self._token = payload["access_token"]
+                self._token_expires = time.monotonic() + max(60, int(payload.get("expires_in", 3600)) - 60)
+            return self._token
+
+    @staticmethod
+    def _json(response):
+        try:
+            return response.json()
+        except ValueError:
+            raise KiotVietError(f"KiotViet trả về dữ liệu không phải JSON (HTTP {response.status_code})")
+
+    async def _request(self, method, url, label, authorized=True, **kwargs):
+        """Gửi request tới KiotViet, gửi lại khi lỗi tạm thời; trả về response thành công."""
+        metric_label = f"kiotviet/{label}"
+        token_refreshed = False
+        attempt = 0
+        while True:
+            headers = {}
+            if authorized:
+                headers = {"Retailer": self.retailer, "Authorization": f"Bearer {await self._access_token()}"}
+            started = time.monotonic()
+            try:
+                response = await self._http().request(method, url, headers=headers, **kwargs)
+            except httpx.TransportError as e:
+                HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, metric_label, "network")
+                reason, detail, delay = "network", f"{type(e).__name__}: {e}", None
+            else:
+                code = response.status_code
+                HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, metric_label,
+                                             "ok" if code < 400 else f"http_{code}")
+                if code < 400:
+                    return response
+                if code == 401 and authorized and not token_refreshed:
+                    token_refreshed = True
+                    await self._access_token(refresh=True)
+                    continue
+                if code != 429 and code not in RETRYABLE_HTTP_STATUSES:
+                    raise KiotVietError(f"KiotViet trả về HTTP {code} ({label}): {response.text[:200]}")
+                reason, detail = f"http_{code}", f"HTTP {code}"
+                retry_after = response.headers.get("Retry-After", "")
+                delay = min(float(retry_after), RETRY_MAX_DELAY) if retry_after.isdigit() else None
+
+            if attempt >= MAX_RETRIES:
+                raise KiotVietError(f"Không gọi được KiotViet ({label}: {detail}) sau {attempt} lần thử lại")
+            attempt += 1
+            delay = delay if delay is not None else retry_backoff(attempt)
+            HTTP_RETRIES.inc(metric_label, reason)
+            logger.warning("Lỗi khi gọi KiotViet %s (%s), thử lại lần %s/%s sau %.1fs",
+                           label, detail, attempt, MAX_RETRIES, delay)
+            await asyncio.sleep(delay)
+
+    async def _fetch_page(self, entity, params, current_item):
+        response = await self._request("GET", f"{self.api_url}/{entity.name}", entity.name,
+                                       params={**params, "pageSize": self.page_size, "currentItem": current_item})
+        payload = self._json(response)
+        return payload.get("total") or 0, payload.get("data") or [], payload.get("removeIds") or []
+
+    async def _fetch_all(self, entity, params):
+        """Tải mọi trang: trang đầu lấy tổng số bản ghi, các trang sau tải song song."""
+        total, records, removed_ids = await self._fetch_page(entity, params, 0)
+        step = len(records)
+        if step and total > step:
+            pages = await asyncio.gather(*(
+                self._fetch_page(entity, params, current_item) for current_item in range(step, total, step)
+            ))
+            for _, page_records, page_removed_ids in pages:
+                records.extend(page_records)
+                removed_ids.extend(page_removed_ids)
+        return records, removed_ids
+
+    async def _sync_entity(self, entity):
+        store = self.store(entity.name)
+        started_at = datetime.now()
+        earliest_day = (started_at - timedelta(days=self.retention_days)).date().isoformat() \
+            if entity.date_field else None
+        params = dict(entity.params)
+        if KIOTVIET_BRANCH_ID and entity.name != "products":
+            params["branchIds"] = KIOTVIET_BRANCH_ID
+        if entity.window_param:
+            params[entity.window_param] = store.checkpoint or earliest_day
+        elif store.checkpoint:
+            params["lastModifiedFrom"] = (datetime.fromisoformat(store.checkpoint[:19])
+                                          - self.SYNC_OVERLAP).isoformat()
+        elif earliest_day:
+            params["lastModifiedFrom"] = earliest_day
+
+        records, removed_ids = await self._fetch_all(entity, params)
+
+        checkpoint = store.checkpoint
+        removed = 0
+        for record in records:
+            key = str(record.get("id"))
+            if _is_cancelled_record(record):
+                removed += store.records.pop(key, None) is not None
+                continue
+            day = None
+            if entity.date_field:
+                day = (record.get(entity.date_field) or "")[:10] or None
+            store.records[key] = [day, entity.to_rows(record)]
+            if not entity.window_param:
+                modified = record.get("modifiedDate") or record.get("createdDate")
+                if modified and (checkpoint is None or modified[:19] > checkpoint[:19]):
+                    checkpoint = modified
+        for key in removed_ids:
+            removed += store.records.pop(str(key), None) is not None
+        store.checkpoint = started_at.date().isoformat() if entity.window_param else checkpoint
+        if earliest_day:
+            store.prune(earliest_day)
+        await asyncio.to_thread(store.save)
+
+        KIOTVIET_RECORDS.inc(entity.name, "upsert", amount=len(records))
+        KIOTVIET_RECORDS.inc(entity.name, "remove", amount=removed)
+        logger.info("KiotViet %s: %s bản ghi mới/cập nhật, %s bị xóa/hủy, %s bản ghi lưu cục bộ (checkpoint %s)",
+                    entity.name, len(records), removed, len(store.records), store.checkpoint)
+        return len(records)
+
+    async def sync(self, names):
+        """Đồng bộ song song các loại dữ liệu; trả về {tên: số bản ghi mới/cập nhật}."""
+        async with self._sync_lock:
+            counts = await asyncio.gather(*(self._sync_entity(KIOTVIET_ENTITIES[name]) for name in names))
+        return dict(zip(names, counts))
+
+    def reader(self, name, day=None):
+        """RecordReader của dữ liệu đã đồng bộ; day (date) lọc theo ngày giao dịch."""
+        entity = KIOTVIET_ENTITIES[name]
+        day_key = day.isoformat() if day and entity.date_field else None
+        rows = [tuple(row) for record_day, record_rows in self.store(name).records.values()
+                if day_key is None or record_day == day_key for row in record_rows]
+        # Theo thời gian giao dịch (sản phẩm: theo nhóm) rồi theo mã
+        rows.sort(key=lambda row: (str(row[1]), str(row[0])))
+        return RecordReader(entity.header, rows)
+
+    def file_name(self, name, day=None):
+        """Tên file tương đương (vd: danhsachhoadon_kiotviet_17102026.xlsx) để nhận diện loại dữ liệu."""
+        suffix = f"_{day.strftime('%d%m%Y')}" if day and KIOTVIET_ENTITIES[name].date_field else ""
+        return f"{KIOTVIET_ENTITIES[name].file_prefix}_kiotviet{suffix}.xlsx"
+
+kiotviet_client = KiotVietClient(KIOTVIET_CLIENT_ID, KIOTVIET_CLIENT_SECRET, KIOTVIET_RETAILER) \
+    if KIOTVIET_ENABLED else None
+
+# ============================================================================
+# MESSAGE SENDING (chia tin nhắn dài và gửi có giới hạn tốc độ)
+# ============================================================================
+
+# Telegram giới hạn 4096 ký tự/tin nhắn, chừa lại một khoảng an toàn
+MESSAGE_CHUNK_LIMIT = 4000
+
+# Giới hạn gửi tin của Telegram: ~1 tin/giây mỗi chat (cho phép burst ngắn), ~30 tin/giây toàn bot
+CHAT_SEND_RATE = 1.0
+CHAT_SEND_BURST = 10
+GLOBAL_SEND_RATE = 30.0
+GLOBAL_SEND_BURST = 30
+
+def _split_long_line(line, limit):
+    """Chia một dòng dài hơn limit tại khoảng trắng, không tách ký tự khỏi dấu đi kèm."""
+    while len(line) > limit:
+        cut = line.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+            while cut > 1 and unicodedata.combining(line[cut]):
+                cut -= 1
+        yield line[:cut]
+        line = line[cut:].lstrip(" ")
+    yield line
+
+def render_message_chunks(blocks, limit=MESSAGE_CHUNK_LIMIT, continued_suffix=" (tiếp)"):
+    """Ghép các khối dòng thành các tin nhắn không vượt quá limit ký tự.
+
+    Mỗi khối (vd: một nhóm sản phẩm, dòng đầu là tiêu đề nhóm) được giữ nguyên trong
+    một tin nhắn nếu vừa; khối quá dài được chia theo dòng và lặp lại tiêu đề ở tin
+    nhắn tiếp theo. Không bao giờ cắt ngang một dòng trừ khi bản thân dòng dài hơn limit.
+    """
+    chunks = []
+    current = []
+    current_length = 0
+
+    def flush():
+        text = "\n".join(current).strip()
+        if text:
+            chunks.append(text)
+        current.clear()
+        return 0
+
+    for block in blocks:
+        block_length = sum(len(line) for line in block) + len(block) - 1
+        separator = 1 if current else 0
+        if current_length + separator + block_length <= limit:
+            current.extend(block)
+            current_length += separator + block_length
+            continue
+        if block_length <= limit:
+            current_length = flush()
+            current.extend(block)
+            current_length = block_length
+            continue
+
+        # Khối dài hơn một tin nhắn: dồn từng dòng
+        heading = f"{block[0]}{continued_suffix}"
+        for line_idx, line in enumerate(block):
+            for piece in _split_long_line(line, limit):
+                if current_length + (1 if current else 0) + len(piece) > limit:
+                    current_length = flush()
+                    if line_idx > 0 and len(heading) + 1 + len(piece) <= limit:
+                        current.append(heading)
+                        current_length = len(heading)
+                current_length += (1 if current else 0) + len(piece)
+                current.append(piece)
+
+    flush()
+    return chunks
+
+class TokenBucket:
+    """Token bucket cho asyncio: tối đa capacity lần liên tiếp, sau đó rate lần/giây."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.updated:
+                    # Đang bị tạm dừng (sau RetryAfter)
+                    await asyncio.sleep(self.updated - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Không cấp token trong seconds giây tới (Telegram yêu cầu chờ), sau đó chỉ cho gửi từng tin."""
+        self.tokens = 1
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+    @property
+    def idle(self):
+        """Bucket đã đầy lại (có thể bỏ đi mà không ảnh hưởng giới hạn)."""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+_global_send_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_BURST)
+_chat_send_buckets = {}
+
+def get_chat_send_bucket(chat_id):
+    """Token bucket gửi tin của một chat (dọn các bucket không dùng khi quá nhiều)."""
+    bucket = _chat_send_buckets.get(chat_id)
+    if bucket is None:
+        if len(_chat_send_buckets) >= 1000:
+            for idle_chat_id in [key for key, value in _chat_send_buckets.items() if value.idle]:
+                del _chat_send_buckets[idle_chat_id]
+        bucket = _chat_send_buckets[chat_id] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+    return bucket
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+async def send_message_chunks(message, chunks):
+    """Gửi các tin nhắn theo đúng thứ tự, giãn cách theo token bucket.
+
+    Tin nhắn bị Telegram trả về RetryAfter (429) được gửi lại sau thời gian yêu cầu,
+    đồng thời tạm dừng bucket của chat để các tin sau không bị từ chối tiếp.
+    """
+    chat_bucket = get_chat_send_bucket(message.chat_id)
+    for chunk in chunks:
+        for attempt in range(MAX_RETRIES + 1):
+            await chat_bucket.acquire()
+            await _global_send_bucket.acquire()
+            try:
+                await message.reply_text(chunk)
+                break
+            except RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                if attempt == MAX_RETRIES:
+                    raise
+                logger.warning("Telegram yêu cầu chờ %s giây trước khi gửi tiếp (chat %s)",
+                               delay, message.chat_id)
+                chat_bucket.pause(delay)
+
+# ============================================================================
+# RESULT PAGINATION (duyệt kết quả dài bằng inline keyboard)
+# ============================================================================
+
+# Số nút chọn nhóm tối đa (Telegram giới hạn 100 nút/keyboard)
+PAGE_GROUP_BUTTONS_LIMIT = 90
+
+class PagedResult(NamedTuple):
+    """Các trang đã render của một kết quả, kèm trang bắt đầu của từng nhóm."""
+    pages: Tuple[str, ...]
+    groups: Tuple[Tuple[str, int], ...]
+    expires_at: float
+
+class ResultPager:
+    """Lưu các trang kết quả trong bộ nhớ để nút ◀ ▶ sửa tin nhắn tại chỗ; hết hạn sau ttl giây."""
+
+    def __init__(self, ttl, max_entries=500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+
+    def add(self, pages, groups=()):
+        """Lưu kết quả, trả về token dùng trong callback_data."""
+        now = time.monotonic()
+        for token in [t for t, r in self._results.items() if r.expires_at <= now]:
+            del self._results[token]
+        while len(self._results) >= self.max_entries:
+            self._results.popitem(last=False)
+        token = secrets.token_urlsafe(6)
+        self._results[token] = PagedResult(tuple(pages), tuple(groups), now + self.ttl)
+        return token
+
+    def get(self, token):
+        """Trả về PagedResult còn hạn, None nếu không có hoặc đã hết hạn."""
+        result = self._results.get(token)
+        if result is None or result.expires_at <= time.monotonic():
+            self._results.pop(token, None)
             return None
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý file hóa đơn: {e}")
-        return None
+        return result
 
-def process_purchase_order_detail_file(file_path):
-    """Xử lý file Excel chi tiết đơn mua hàng từ KiotViet."""
-    try:
-        workbook = load_workbook(filename=file_path, data_only=True)
-        sheet = workbook.active
-        
-        # Tìm các cột quan trọng
-        header = [str(cell.value).strip() if cell.value else "" for cell in sheet[1]]
-        logger.info(f"Các cột tìm thấy trong file: {header}")
-        
-        try:
-            # Tìm chính xác cột "Tên nhà cung cấp", phân biệt hoa thường
-            supplier_col_index = None
-            product_name_col_index = None
-            quantity_col_index = None
-            unit_price_col_index = None
-            
-            for i, col in enumerate(header):
-                if col == "Tên nhà cung cấp":
-                    supplier_col_index = i
-                    logger.info(f"Đã tìm thấy cột Tên nhà cung cấp chính xác tại vị trí {i}: {col}")
-                elif col == "Tên hàng":
-                    product_name_col_index = i
-                    logger.info(f"Đã tìm thấy cột Tên hàng chính xác tại vị trí {i}: {col}")
-                elif col == "Số lượng":
-                    quantity_col_index = i
-                    logger.info(f"Đã tìm thấy cột Số lượng chính xác tại vị trí {i}: {col}")
-                elif col == "Giá nhập":
-                    unit_price_col_index = i
-                    logger.info(f"Đã tìm thấy cột Giá nhập chính xác tại vị trí {i}: {col}")
-            
-            # Nếu không tìm thấy, thử tìm cách khác không phân biệt hoa thường
-            if supplier_col_index is None:
-                supplier_col_index = next((i for i, col in enumerate(header) if col.lower() == "tên nhà cung cấp"), None)
-                if supplier_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột tên nhà cung cấp (không phân biệt hoa thường) tại vị trí {supplier_col_index}: {header[supplier_col_index]}")
-            
-            if product_name_col_index is None:
-                product_name_col_index = next((i for i, col in enumerate(header) if col.lower() == "tên hàng"), None)
-                if product_name_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột tên hàng (không phân biệt hoa thường) tại vị trí {product_name_col_index}: {header[product_name_col_index]}")
-            
-            if quantity_col_index is None:
-                quantity_col_index = next((i for i, col in enumerate(header) if col.lower() == "số lượng"), None)
-                if quantity_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột số lượng (không phân biệt hoa thường) tại vị trí {quantity_col_index}: {header[quantity_col_index]}")
-            
-            if unit_price_col_index is None:
-                unit_price_col_index = next((i for i, col in enumerate(header) if col.lower() == "giá nhập"), None)
-                if unit_price_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột giá nhập (không phân biệt hoa thường) tại vị trí {unit_price_col_index}: {header[unit_price_col_index]}")
-            
-            # Nếu vẫn không tìm thấy, thử tìm kiếm mờ
-            if supplier_col_index is None:
-                supplier_col_index = next((i for i, col in enumerate(header) if "tên nhà cung cấp" in col.lower()), None)
-                if supplier_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột tên nhà cung cấp (tìm mờ) tại vị trí {supplier_col_index}: {header[supplier_col_index]}")
-            
-            if product_name_col_index is None:
-                product_name_col_index = next((i for i, col in enumerate(header) if "tên hàng" in col.lower()), None)
-                if product_name_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột tên hàng (tìm mờ) tại vị trí {product_name_col_index}: {header[product_name_col_index]}")
-            
-            if quantity_col_index is None:
-                quantity_col_index = next((i for i, col in enumerate(header) if "số lượng" in col.lower()), None)
-                if quantity_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột số lượng (tìm mờ) tại vị trí {quantity_col_index}: {header[quantity_col_index]}")
-            
-            if unit_price_col_index is None:
-                unit_price_col_index = next((i for i, col in enumerate(header) if "giá nhập" in col.lower()), None)
-                if unit_price_col_index is not None:
-                    logger.info(f"Đã tìm thấy cột giá nhập (tìm mờ) tại vị trí {unit_price_col_index}: {header[unit_price_col_index]}")
-            
-            if supplier_col_index is None or product_name_col_index is None or quantity_col_index is None:
-                logger.error("Không tìm thấy một hoặc nhiều cột cần thiết trong file đơn mua hàng")
-                logger.error(f"Supplier col: {supplier_col_index}, Product name col: {product_name_col_index}, Quantity col: {quantity_col_index}, Unit price col: {unit_price_col_index}")
-                return f"Lỗi: Không tìm thấy các cột cần thiết trong file. Cần có 'Tên nhà cung cấp', 'Tên hàng', 'Số lượng'."
-            
-            # Chú ý: cột "Giá nhập" là optional, nếu không có thì sẽ skip tính tổng tiền
-            if unit_price_col_index is None:
-                logger.warning("Không tìm thấy cột 'Giá nhập' - sẽ bỏ qua tính tổng tiền")
-        
-        except Exception as e:
-            logger.error(f"Lỗi khi tìm vị trí các cột: {e}")
-            return f"Lỗi khi tìm vị trí các cột: {e}"
-        
-        # Dictionary lưu trữ dữ liệu theo nhà cung cấp
-        suppliers_data = {}
-        
-        # Duyệt qua các dòng từ dòng thứ 2 (dữ liệu)
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=2), start=2):
-            supplier = row[supplier_col_index].value
-            product_name = row[product_name_col_index].value
-            quantity = row[quantity_col_index].value
-            
-            # Bỏ qua dòng nếu thiếu thông tin
-            if not supplier or not product_name or quantity is None:
-                continue
-            
-            # Chuyển đổi số lượng sang số
-            try:
-                quantity_num = float(quantity)
-                if quantity_num <= 0:
-                    continue
-            except (ValueError, TypeError):
-                logger.warning(f"Số lượng không hợp lệ ở dòng {row_idx}: {quantity}")
-                continue
-            
-            # Lấy giá nhập và tính tổng tiền = giá nhập × số lượng
-            total_price = 0
-            if unit_price_col_index is not None:
-                unit_price_value = row[unit_price_col_index].value
-                if unit_price_value is not None:
-                    try:
-                        unit_price = float(unit_price_value)
-                        total_price = unit_price * quantity_num
-                    except (ValueError, TypeError):
-                        logger.warning(f"Giá nhập không hợp lệ ở dòng {row_idx}: {unit_price_value}")
-                        total_price = 0
-            
-            # Khởi tạo dictionary cho nhà cung cấp nếu chưa có
-            if supplier not in suppliers_data:
-                suppliers_data[supplier] = {}
-            
-            # Cộng dồn số lượng và tổng tiền cho sản phẩm
-            if product_name in suppliers_data[supplier]:
-                suppliers_data[supplier][product_name]["quantity"] += quantity_num
-                suppliers_data[supplier][product_name]["total_price"] += total_price
-            else:
-                suppliers_data[supplier][product_name] = {
-                    "quantity": quantity_num,
-                    "total_price": total_price
-                }
-        
-        # Sắp xếp kết quả theo tên nhà cung cấp (theo bảng chữ cái tiếng Việt)
-        sorted_suppliers = sorted(suppliers_data.keys(), key=locale.strxfrm)
-        sorted_result = {supplier: suppliers_data[supplier] for supplier in sorted_suppliers}
-        
-        # Với mỗi nhà cung cấp, sắp xếp sản phẩm theo tên
-        for supplier in sorted_result:
-            sorted_products = {k: v for k, v in sorted(sorted_result[supplier].items(), key=lambda item: locale.strxfrm(str(item[0])))}
-            sorted_result[supplier] = sorted_products
-        
-        return sorted_result
+result_pager = ResultPager(RESULT_PAGE_TTL)
+
+def build_page_keyboard(token, result, page):
+    """Keyboard điều hướng: ◀ trang/tổng ▶, thêm nút chọn nhóm nếu có."""
+    total = len(result.pages)
+    rows = [[
+        InlineKeyboardButton("◀", callback_data=f"pg:{token}:{(page - 1) % total}"),
+        InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"pg:{token}:{page}"),
+        InlineKeyboardButton("▶", callback_data=f"pg:{token}:{(page + 1) % total}"),
+    ]]
+    if result.groups:
+        rows.append([InlineKeyboardButton("📂 Chọn nhóm", callback_data=f"pg:{token}:g:{page}")])
+    return InlineKeyboardMarkup(rows)
+
+def build_group_keyboard(token, result, page):
+    """Keyboard danh sách nhóm, mỗi nút nhảy tới trang đầu tiên của nhóm."""
+    buttons = [
+        InlineKeyboardButton(label[:30], callback_data=f"pg:{token}:{group_page}")
+        for label, group_page in result.groups[:PAGE_GROUP_BUTTONS_LIMIT]
+    ]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton("↩ Quay lại", callback_data=f"pg:{token}:{page}")])
+    return InlineKeyboardMarkup(rows)
+
+async def send_result_pages(message, pages, group_headings=()):
+    """Gửi kết quả nhiều trang: chỉ gửi trang 1 kèm nút ◀ ▶, các trang còn lại giữ ở server.
+
+    group_headings là danh sách (tên nhóm, dòng tiêu đề nhóm) để tạo nút nhảy tới nhóm.
+    """
+    if len(pages) <= 1:
+        await send_message_chunks(message, pages)
+        return
     
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý file đơn mua hàng: {e}")
-        return f"Lỗi khi xử lý file đơn mua hàng: {e}"
+    page_lines = [set(page.split("\n")) for page in pages]
+    groups = []
+    for label, heading in group_headings:
+        group_page = next((i for i, lines in enumerate(page_lines) if heading in lines), None)
+        if group_page is not None:
+            groups.append((label, group_page))
+    
+    token = result_pager.add(pages, groups)
+    result = result_pager.get(token)
+    await get_chat_send_bucket(message.chat_id).acquire()
+    await _global_send_bucket.acquire()
+    await message.reply_text(pages[0], reply_markup=build_page_keyboard(token, result, 0))
+
+async def handle_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý nút ◀ ▶ / chọn nhóm: sửa tin nhắn tại chỗ bằng trang đã render sẵn."""
+    query = update.callback_query
+    parts = query.data.split(":")
+    result = result_pager.get(parts[1]) if len(parts) >= 3 else None
+    if result is None:
+        await query.answer("⌛ Kết quả đã hết hạn, vui lòng gửi lại file.", show_alert=True)
+        return
+    
+    token = parts[1]
+    try:
+        if parts[2] == "g":
+            page = min(int(parts[3]), len(result.pages) - 1)
+            await query.edit_message_reply_markup(reply_markup=build_group_keyboard(token, result, page))
+        else:
+            page = min(int(parts[2]), len(result.pages) - 1)
+            await query.edit_message_text(result.pages[page], reply_markup=build_page_keyboard(token, result, page))
+    except BadRequest as e:
+        # Bấm lại đúng trang đang xem: Telegram báo "message is not modified"
+        if "not modified" not in str(e).lower():
+            raise
+    await query.answer()
 
 # ============================================================================
 # BOT HANDLERS (từ bot.py)
@@ -939,7 +4122,10 @@ def restricted(func):
         
         # Kiểm tra user_id có trong danh sách cho phép
         if user_id not in ALLOWED_USERS:
-            logger.warning(f"Từ chối truy cập từ user {user_id}")
+            logger.warning("Từ chối truy cập từ user %s", user_id)
+            if update.callback_query:
+                await update.callback_query.answer("❌ Bạn không có quyền sử dụng bot này.", show_alert=True)
+                return
             await update.message.reply_text(
                 "❌ Bạn không có quyền sử dụng bot này.\n"
                 f"User ID của bạn: {user_id}"
@@ -950,6 +4136,36 @@ def restricted(func):
     
     return wrapped
 
+def scheduled(func):
+    """Decorator chạy handler qua job_scheduler (lần lượt theo user, giới hạn đồng thời)."""
+    @wraps(func)
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        async def notify_queued(position):
+            await update.message.reply_text(
+                f"⏳ Bot đang bận, yêu cầu của bạn ở vị trí {position} trong hàng đợi."
+            )
+
+        queued_at = time.perf_counter()
+
+        async def run_job():
+            # Thời gian chờ trong hàng đợi (chỉ đo với file gửi vào)
+            if update.message and update.message.document:
+                STAGE_SECONDS.observe(time.perf_counter() - queued_at,
+                                      get_export_type(update.message.document.file_name), "queue")
+            return await func(update, context, *args, **kwargs)
+
+        try:
+            return await job_scheduler.run(
+                update.effective_user.id,
+                run_job,
+                on_queued=notify_queued
+            )
+        except QueueFullError as e:
+            logger.warning("Từ chối yêu cầu của user %s: %s", update.effective_user.id, e)
+            await update.message.reply_text(f"❌ {e}. Vui lòng gửi lại sau ít phút.")
+    
+    return wrapped
+
 # Command handlers
 @restricted
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -998,28 +4214,36 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "• Cần có cột: Tên nhà cung cấp, Tên hàng, Số lượng\n"
         "• Kết quả: Danh sách nhóm theo nhà cung cấp\n\n"
         "🔄 Gộp File:\n"
-        "Gửi 1 file danhsachhoadon + 1 file soquy → Bot tự động tổng hợp!\n\n"
+        "Gửi 1 hoặc nhiều file soquy, sau đó 1 file danhsachhoadon → Bot tự động tổng hợp!\n\n"
         "📞 Lệnh hỗ trợ:\n"
         "/start - Khởi động bot\n"
         "/help - Xem hướng dẫn\n"
         "/clear - Xóa dữ liệu tạm\n"
-        "/tinhluong - Gửi file bảng lương"
+        "/tinhluong - Gửi file bảng lương\n"
+        "/kiotviet - Lấy dữ liệu thẳng từ KiotViet (baocao, sanpham, dathang [dd/mm/yyyy])\n"
+        "/dangky, /huydangky - Nhận/ngừng nhận báo cáo định kỳ"
     )
     
     await update.message.reply_text(help_text)
 
-@restricted
-async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Xóa dữ liệu tạm trong context."""
-    # Cleanup temp directories nếu có
-    for key in ['invoice_tempdir', 'soquy_tempdir', 'combine_tempdir']:
-        tempdir = context.user_data.get(key)
+def cleanup_user_tempdirs(user_data):
+    """Xóa các thư mục tạm của file đang chờ tổng hợp (chỉ có với file lớn lưu trên đĩa)."""
+    tempdirs = [('invoice_tempdir', user_data.get('invoice_tempdir'))]
+    tempdirs += [('soquy_tempdir', pending['tempdir']) for pending in user_data.get('soquy_files', [])]
+    for key, tempdir in tempdirs:
         if tempdir and os.path.exists(tempdir):
             try:
                 shutil.rmtree(tempdir)
-                logger.info(f"Cleaned up {key}: {tempdir}")
+                logger.info("Cleaned up %s: %s", key, tempdir)
             except Exception as e:
-                logger.error(f"Error cleaning {key}: {e}")
+                logger.error("Error cleaning %s: %s", key, e)
+
+@restricted
+@scheduled
+async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Xóa dữ liệu tạm trong context."""
+    # Cleanup temp directories nếu có
+    cleanup_user_tempdirs(context.user_data)
     
     # Clear user data
     context.user_data.clear()
@@ -1030,70 +4254,75 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def tinhluong_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Gửi file bảng lương từ biến môi trường BANGLUONG."""
     await update.message.reply_text("⏳ Đang chuẩn bị file bảng lương...")
-    logger.info(f"User {update.effective_user.id} yêu cầu file bảng lương.")
+    logger.info("User %s yêu cầu file bảng lương.", update.effective_user.id)
     
-    temp_payroll_dir = None
     try:
-        # Lấy dữ liệu bảng lương từ biến môi trường
-        if not BANGLUONG:
+        # Lấy dữ liệu bảng lương (đã decode sẵn trong bộ nhớ)
+        try:
+            payroll = get_payroll_document()
+        except (base64.binascii.Error, TypeError, ValueError) as decode_error:
+            logger.error("Failed to decode BANGLUONG base64: %s", decode_error)
+            await update.message.reply_text("❌ Lỗi: Dữ liệu bảng lương bị lỗi.")
+            return
+
+        if payroll is None:
             logger.warning("BANGLUONG env var not found.")
             await update.message.reply_text("❌ Lỗi: Không tìm thấy dữ liệu bảng lương (BANGLUONG).")
             return
 
-        # Giải mã dữ liệu base64
-        try:
-            excel_binary = base64.b64decode(BANGLUONG)
-        except (base64.binascii.Error, TypeError) as decode_error:
-            logger.error(f"Failed to decode BANGLUONG base64: {decode_error}")
-            await update.message.reply_text("❌ Lỗi: Dữ liệu bảng lương bị lỗi.")
-            return
-            
-        # Tạo file tạm và lưu dữ liệu
-        temp_payroll_dir = tempfile.mkdtemp(prefix="payroll_")
+        caption = "💰 Bảng lương đã sẵn sàng!"
+
+        # Đã upload file này trước đó → gửi lại theo file_id, không upload lại
+        file_id = get_payroll_file_id(payroll.content_hash)
+        if file_id:
+            try:
+                await update.message.reply_document(document=file_id, caption=caption)
+                logger.info("Sent payroll file by file_id to user %s", update.effective_user.id)
+                return
+            except BadRequest as e:
+                # file_id không còn dùng được (vd: đổi bot token) → upload lại
+                logger.warning("Cached payroll file_id is invalid, re-uploading: %s", e)
+                set_payroll_file_id(payroll.content_hash, None)
+
         file_name = f"BangLuong_{datetime.now().strftime('%d%m')}.xlsx"
-        file_path = os.path.join(temp_payroll_dir, file_name)
-        
-        with open(file_path, 'wb') as f:
-            f.write(excel_binary)
-        
-        logger.info(f"Created temp payroll file: {file_path}")
-        
-        # Gửi file đến người dùng
-        with open(file_path, 'rb') as f:
-            await update.message.reply_document(
-                document=f,
-                filename=file_name,
-                caption="💰 Bảng lương đã sẵn sàng!"
-            )
+        sent_message = await update.message.reply_document(
+            document=payroll.data,
+            filename=file_name,
+            caption=caption
+        )
+        if sent_message and sent_message.document:
+            set_payroll_file_id(payroll.content_hash, sent_message.document.file_id)
         
-        logger.info(f"Sent payroll file '{file_name}' to user {update.effective_user.id}")
+        logger.info("Sent payroll file '%s' to user %s", file_name, update.effective_user.id)
 
     except Exception as e:
-        logger.error(f"Error in /tinhluong: {e}", exc_info=True)
+        logger.error("Error in /tinhluong: %s", e, exc_info=True)
         await update.message.reply_text(f"❌ Lỗi không mong muốn khi xử lý bảng lương: {str(e)[:100]}")
-        
-    finally:
-        # Dọn dẹp thư mục tạm
-        if temp_payroll_dir and os.path.exists(temp_payroll_dir):
-            try:
-                shutil.rmtree(temp_payroll_dir)
-                logger.info(f"Cleaned payroll temp: {temp_payroll_dir}")
-            except Exception as ce:
-                logger.error(f"Error cleaning payroll temp {temp_payroll_dir}: {ce}")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Thống kê hiệu năng xử lý file (chỉ ADMIN_USER_ID)."""
+    if ADMIN_USER_ID is None or update.effective_user.id != ADMIN_USER_ID:
+        logger.warning("User %s không có quyền dùng /stats", update.effective_user.id)
+        await update.message.reply_text("❌ Lệnh này chỉ dành cho quản trị viên.")
+        return
+    await send_message_chunks(update.message, render_message_chunks(render_stats_blocks()))
 
 # File handlers
 @restricted
+@scheduled
 async def handle_excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Xử lý file Excel được gửi vào."""
     if not update.message or not update.message.document:
         logger.warning("handle_excel_file được gọi nhưng không có document.")
         return
 
-    file = await update.message.document.get_file()
-    file_name = update.message.document.file_name
+    document = update.message.document
+    file_name = document.file_name
+    export_type = get_export_type(file_name)
+    timer = StageTimer(export_type)
     
     # Kiểm tra kích thước file
-    file_size = update.message.document.file_size
+    file_size = document.file_size
     if file_size:
         file_size_mb = file_size / (1024 * 1024)
         if file_size_mb > MAX_FILE_SIZE_MB:
@@ -1103,29 +4332,76 @@ async def handle_excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
     
-    temp_dir = tempfile.mkdtemp(prefix="telegram_dl_")
-    file_path = os.path.join(temp_dir, file_name)
+    # File đã xử lý trước đó (cùng file_unique_id) → trả kết quả cũ, không cần tải lại
+    cache_kind = get_cache_kind(file_name, context.user_data)
+    if cache_kind:
+        entry = result_cache.get(cache_kind, file_unique_id=document.file_unique_id)
+        if entry is not None:
+            logger.info("Cache hit (file_unique_id) cho file '%s'", file_name)
+            FILES_TOTAL.inc(export_type, "cache_hit")
+            timer.lap("cache_lookup")
+            await reply_cached_result(update.message, entry)
+            timer.lap("reply")
+            return
+
+    # File nhỏ được tải thẳng vào bộ nhớ; file lớn (hoặc không rõ kích thước) mới ghi ra đĩa
+    in_memory = bool(file_size) and file_size <= IN_MEMORY_MAX_FILE_MB * 1024 * 1024
+    temp_dir = None
     should_cleanup_immediately = False
 
     try:
-        await file.download_to_drive(file_path)
-        logger.info(f"Downloaded file '{file_name}' to '{file_path}'")
+        timer.lap("cache_lookup")
+        file = await document.get_file()
+        timer.lap("get_file")
+        if in_memory:
+            buffer = BytesIO()
+            await file.download_to_memory(out=buffer)
+            source = buffer.getvalue()
+            logger.info("Downloaded file '%s' to memory (%s bytes)", file_name, len(source))
+        else:
+            temp_dir = tempfile.mkdtemp(prefix="telegram_dl_")
+            source = os.path.join(temp_dir, file_name)
+            await file.download_to_drive(source)
+            logger.info("Downloaded file '%s' to '%s'", file_name, source)
+        timer.lap("download")
+        FILE_BYTES.observe(source_size(source), export_type, "in")
+
+        content_hash = hash_source(source) if cache_kind or stored_exports.enabled else None
+        if stored_exports.enabled:
+            # Đầu vào cho báo cáo định kỳ
+            await asyncio.to_thread(stored_exports.save, file_name, content_hash, source)
+
+        # Cùng nội dung với file đã xử lý (SHA-256) → không cần xử lý lại
+        cache_key = None
+        if cache_kind:
+            entry = result_cache.get(cache_kind, content_hash=content_hash)
+            if entry is not None:
+                logger.info("Cache hit (SHA-256) cho file '%s'", file_name)
+                FILES_TOTAL.inc(export_type, "cache_hit")
+                result_cache.link_unique_id(cache_kind, content_hash, document.file_unique_id)
+                timer.lap("hash")
+                await reply_cached_result(update.message, entry)
+                timer.lap("reply")
+                should_cleanup_immediately = True
+                return
+            cache_key = (cache_kind, content_hash, document.file_unique_id)
+            timer.lap("hash")
 
         file_name_lower = file_name.lower()
 
         # Phát hiện loại file và xử lý
         if file_name_lower.startswith("danhsachhoadon_"):
-            await handle_danhsachhoadon_file(update, context, file_path, file_name, temp_dir)
+            await handle_danhsachhoadon_file(update, context, source, file_name, temp_dir, cache_key)
             
         elif file_name_lower.startswith("soquy_"):
-            await handle_soquy_file(update, context, file_path, file_name, temp_dir)
+            await handle_soquy_file(update, context, source, file_name, temp_dir)
             
         elif file_name_lower.startswith("danhsachsanpham_"):
-            await handle_danhsachsanpham_file(update, context, file_path, file_name)
+            await handle_danhsachsanpham_file(update, context, source, file_name, cache_key)
             should_cleanup_immediately = True
             
         elif file_name_lower.startswith("danhsachchitietdathang_"):
-            await handle_danhsachchitietdathang_file(update, context, file_path, file_name)
+            await handle_danhsachchitietdathang_file(update, context, source, file_name, cache_key)
             should_cleanup_immediately = True
         
         else:
@@ -1138,9 +4414,11 @@ async def handle_excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 "• danhsachchitietdathang_*.xlsx"
             )
             should_cleanup_immediately = True
+        FILES_TOTAL.inc(export_type, "processed")
 
     except Exception as e:
-        logger.error(f"Lỗi khi xử lý file {file_name}: {e}", exc_info=True)
+        FILES_TOTAL.inc(export_type, "error")
+        logger.error("Lỗi khi xử lý file %s: %s", file_name, e, exc_info=True)
         await update.message.reply_text(
             f"❌ Đã xảy ra lỗi khi xử lý file '{file_name}'.\n"
             f"Chi tiết: {str(e)[:100]}..."
@@ -1148,52 +4426,64 @@ async def handle_excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         should_cleanup_immediately = True
         
     finally:
-        if should_cleanup_immediately and os.path.exists(temp_dir):
+        if should_cleanup_immediately and temp_dir and os.path.exists(temp_dir):
             try:
                 shutil.rmtree(temp_dir)
-                logger.info(f"Cleaned up temp directory: {temp_dir}")
+                logger.info("Cleaned up temp directory: %s", temp_dir)
             except Exception as cleanup_error:
-                logger.error(f"Error cleaning up {temp_dir}: {cleanup_error}")
+                logger.error("Error cleaning up %s: %s", temp_dir, cleanup_error)
 
-async def handle_danhsachhoadon_file(update, context, file_path, file_name, temp_dir):
+async def handle_danhsachhoadon_file(update, context, source, file_name, temp_dir, cache_key=None):
     """Xử lý file danh sách hóa đơn."""
     status_msg = await update.message.reply_text("⏳ Đang xử lý file danh sách hóa đơn...")
     
     try:
         # Kiểm tra có file soquy đang chờ không
-        has_soquy = context.user_data.get('soquy_file') is not None
+        has_soquy = bool(context.user_data.get('soquy_files'))
         
         if has_soquy:
             # Nếu có file soquy → Lưu file và tổng hợp
-            context.user_data['invoice_file'] = file_path
+            context.user_data['invoice_file'] = source
+            context.user_data['invoice_name'] = file_name
             context.user_data['invoice_tempdir'] = temp_dir
             
             await status_msg.edit_text("✅ Đã nhận file hóa đơn!")
             await auto_combine_reports(update, context)
         else:
             # Nếu KHÔNG có file soquy → Xử lý riêng lẻ, KHÔNG lưu vào context
-            output_path = os.path.join(temp_dir, f"processed_{file_name}")
-            result = process_invoice_file(file_path, output_path)
+            # File trong bộ nhớ → kết quả cũng trả về trong bộ nhớ
+            output_path = os.path.join(temp_dir, f"processed_{file_name}") if temp_dir else None
+            result = await run_processing_job(process_invoice_file, source, output_path,
+                                              export_type="danhsachhoadon")
+            document = open_report_document(result)
             
-            if result and result.get('file_path'):
+            if document is not None:
                 # Gửi file kết quả riêng lẻ
-                with open(result['file_path'], 'rb') as f:
-                    await update.message.reply_document(
+                caption = f"✅ Đã xử lý file: {file_name}"
+                FILE_BYTES.observe(report_output_size(result), "danhsachhoadon", "out")
+                timer = StageTimer("danhsachhoadon")
+                with document as f:
+                    sent_message = await update.message.reply_document(
                         document=f,
                         filename=f"KetQua_{file_name}",
-                        caption=f"✅ Đã xử lý file: {file_name}"
+                        caption=caption
                     )
+                timer.lap("reply")
+                
+                # Lần sau gửi lại theo file_id, không cần xử lý và upload lại
+                if cache_key and sent_message and sent_message.document:
+                    result_cache.put(*cache_key, file_id=sent_message.document.file_id, caption=caption)
                 
                 await status_msg.edit_text("✅ Xử lý file danh sách hóa đơn thành công!")
                 
                 # KHÔNG lưu vào context vì đã xử lý xong riêng lẻ
                 # Cleanup temp dir ngay
-                if os.path.exists(temp_dir):
+                if temp_dir and os.path.exists(temp_dir):
                     try:
                         shutil.rmtree(temp_dir)
-                        logger.info(f"Cleaned up temp dir after standalone processing: {temp_dir}")
+                        logger.info("Cleaned up temp dir after standalone processing: %s", temp_dir)
                     except Exception as cleanup_error:
-                        logger.error(f"Error cleaning temp dir: {cleanup_error}")
+                        logger.error("Error cleaning temp dir: %s", cleanup_error)
             else:
                 # Xử lý lỗi
                 missing_info = result.get('missing_columns_info', []) if result else []
@@ -1203,180 +4493,588 @@ async def handle_danhsachhoadon_file(update, context, file_path, file_name, temp
                 await status_msg.edit_text(error_msg)
             
     except Exception as e:
-        logger.error(f"Lỗi xử lý file hóa đơn: {e}", exc_info=True)
+        logger.error("Lỗi xử lý file hóa đơn: %s", e, exc_info=True)
         await status_msg.edit_text(f"❌ Lỗi: {str(e)[:100]}")
 
-async def handle_soquy_file(update, context, file_path, file_name, temp_dir):
+async def handle_soquy_file(update, context, source, file_name, temp_dir):
     """Xử lý file sổ quỹ."""
     status_msg = await update.message.reply_text("⏳ Đang lưu file sổ quỹ...")
     
     try:
-        # Lưu file vào context (chỉ lưu 1 file)
-        context.user_data['soquy_file'] = file_path
-        context.user_data['soquy_tempdir'] = temp_dir
+        # Lưu file vào context (có thể lưu nhiều file, vd: sổ quỹ cả tuần/tháng)
+        soquy_files = context.user_data.setdefault('soquy_files', [])
+
+        # Gửi lại file cùng tên thì thay thế file cũ thay vì cộng trùng dữ liệu
+        for idx, pending in enumerate(soquy_files):
+            if pending['file_name'] == file_name:
+                soquy_files.pop(idx)
+                if pending['tempdir']:
+                    shutil.rmtree(pending['tempdir'], ignore_errors=True)
+                break
+
+        # source là bytes (file nhỏ) hoặc đường dẫn trong tempdir (file lớn)
+        soquy_files.append({'file_name': file_name, 'source': source, 'tempdir': temp_dir})
         
-        await status_msg.edit_text("✅ Đã lưu file sổ quỹ!")
+        await status_msg.edit_text(f"✅ Đã lưu file sổ quỹ! ({len(soquy_files)} file đang chờ)")
         
         # Thông báo chờ file hóa đơn MỚI
         # KHÔNG tổng hợp với file invoice cũ (nếu có)
         await update.message.reply_text(
             "💡 Đã lưu file sổ quỹ.\n"
-            "Hãy gửi file danhsachhoadon_*.xlsx để tạo báo cáo tổng hợp!"
+            "Có thể gửi thêm file soquy_*.xlsx, hoặc gửi file danhsachhoadon_*.xlsx để tạo báo cáo tổng hợp!"
         )
             
     except Exception as e:
-        logger.error(f"Lỗi xử lý file sổ quỹ: {e}", exc_info=True)
+        logger.error("Lỗi xử lý file sổ quỹ: %s", e, exc_info=True)
         await status_msg.edit_text(f"❌ Lỗi: {str(e)[:100]}")
 
-async def handle_danhsachsanpham_file(update, context, file_path, file_name):
+def render_product_pages(result_data):
+    """Các trang tin nhắn và nút nhóm của kết quả process_excel_file_updated."""
+    # Mỗi nhóm là một khối, không bị cắt giữa chừng
+    blocks = [["📦 E gửi danh Sách Sản Phẩm Tồn Kho ≠ 0", ""]]
+    groups = []
+    
+    for group in result_data.get('sorted_groups', []):
+        products = result_data['grouped_products'].get(group, [])
+        if products:
+            blocks.append([f"Nhóm: {group}", *products, ""])
+            groups.append((group, f"Nhóm: {group}"))
+    
+    # Kiểm tra missing columns
+    missing_info = result_data.get('missing_columns_info', [])
+    if missing_info:
+        blocks.append(["", "⚠️ Cảnh báo:", ", ".join(missing_info)])
+    return render_message_chunks(blocks), groups
+
+async def handle_danhsachsanpham_file(update, context, source, file_name, cache_key=None):
     """Xử lý file danh sách sản phẩm."""
     status_msg = await update.message.reply_text("⏳ Đang xử lý file danh sách sản phẩm...")
     
     try:
-        result_data = process_excel_file_updated(file_path)
+        result_data = await run_processing_job(process_excel_file_updated, source, export_type="danhsachsanpham")
         
         if isinstance(result_data, dict):
-            # Tạo message từ grouped_products
-            output_string = "📦 E gửi danh Sách Sản Phẩm Tồn Kho ≠ 0\n\n"
-            
-            for group in result_data.get('sorted_groups', []):
-                products = result_data['grouped_products'].get(group, [])
-                if products:
-                    output_string += f"Nhóm: {group}\n"
-                    for product in products:
-                        output_string += f"{product}\n"
-                    output_string += "\n"
-            
-            # Kiểm tra missing columns
-            missing_info = result_data.get('missing_columns_info', [])
-            if missing_info:
-                output_string += f"\n⚠️ Cảnh báo:\n{', '.join(missing_info)}\n"
-            
-            # Gửi kết quả (chia nhỏ nếu quá dài)
-            if len(output_string) > 4000:
-                # Chia thành nhiều message
-                parts = [output_string[i:i+4000] for i in range(0, len(output_string), 4000)]
-                for part in parts:
-                    await update.message.reply_text(part)
-            else:
-                await update.message.reply_text(output_string)
+            # Gửi trang đầu, các trang sau xem bằng nút ◀ ▶
+            messages, groups = render_product_pages(result_data)
+            timer = StageTimer("danhsachsanpham")
+            await send_result_pages(update.message, messages, groups)
+            timer.lap("reply")
+            if cache_key:
+                result_cache.put(*cache_key, messages=messages, groups=groups)
             
             await status_msg.edit_text("✅ Xử lý file danh sách sản phẩm thành công!")
         else:
             await status_msg.edit_text(f"❌ Lỗi: {result_data}")
             
     except Exception as e:
-        logger.error(f"Lỗi xử lý file sản phẩm: {e}", exc_info=True)
+        logger.error("Lỗi xử lý file sản phẩm: %s", e, exc_info=True)
         await status_msg.edit_text(f"❌ Lỗi: {str(e)[:100]}")
 
-async def handle_danhsachchitietdathang_file(update, context, file_path, file_name):
+def render_purchase_order_pages(result_data):
+    """Các trang tin nhắn và nút nhóm của kết quả process_purchase_order_detail_file."""
+    # Mỗi nhà cung cấp là một khối
+    blocks = [["🛒 Chi Tiết Đơn Đặt Hàng Theo Nhà Cung Cấp", ""]]
+    groups = []
+    
+    for supplier, products in result_data.items():
+        lines = [f"{supplier}:"]
+        groups.append((supplier, f"{supplier}:"))
+        total_supplier_amount = 0
+        
+        for product_name, info in products.items():
+            quantity = info.get('quantity', 0)
+            total_price = info.get('total_price', 0)
+            total_supplier_amount += total_price
+            
+            if total_price > 0:
+                lines.append(f"• {product_name}: {quantity} (Tổng: {total_price:,.0f}đ)")
+            else:
+                lines.append(f"• {product_name}: {quantity}")
+        
+        if total_supplier_amount > 0:
+            lines.append(f"Tổng: {total_supplier_amount:,.0f}đ")
+        lines.append("")
+        blocks.append(lines)
+    return render_message_chunks(blocks), groups
+
+async def handle_danhsachchitietdathang_file(update, context, source, file_name, cache_key=None):
     """Xử lý file chi tiết đơn đặt hàng."""
     status_msg = await update.message.reply_text("⏳ Đang xử lý file chi tiết đơn đặt hàng...")
     
     try:
-        result_data = process_purchase_order_detail_file(file_path)
+        result_data = await run_processing_job(process_purchase_order_detail_file, source,
+                                               export_type="danhsachchitietdathang")
         
         if isinstance(result_data, dict):
-            # Tạo message từ suppliers_data
-            output_string = "🛒 Chi Tiết Đơn Đặt Hàng Theo Nhà Cung Cấp\n\n"
-            
-            for supplier, products in result_data.items():
-                output_string += f"{supplier}:\n"
-                total_supplier_amount = 0
-                
-                for product_name, info in products.items():
-                    quantity = info.get('quantity', 0)
-                    total_price = info.get('total_price', 0)
-                    total_supplier_amount += total_price
-                    
-                    if total_price > 0:
-                        output_string += f"• {product_name}: {quantity} (Tổng: {total_price:,.0f}đ)\n"
-                    else:
-                        output_string += f"• {product_name}: {quantity}\n"
-                
-                if total_supplier_amount > 0:
-                    output_string += f"Tổng: {total_supplier_amount:,.0f}đ\n\n"
-                else:
-                    output_string += "\n"
-            
-            # Gửi kết quả (chia nhỏ nếu quá dài)
-            if len(output_string) > 4000:
-                parts = [output_string[i:i+4000] for i in range(0, len(output_string), 4000)]
-                for part in parts:
-                    await update.message.reply_text(part)
-            else:
-                await update.message.reply_text(output_string)
+            # Gửi trang đầu, các trang sau xem bằng nút ◀ ▶
+            messages, groups = render_purchase_order_pages(result_data)
+            timer = StageTimer("danhsachchitietdathang")
+            await send_result_pages(update.message, messages, groups)
+            timer.lap("reply")
+            if cache_key:
+                result_cache.put(*cache_key, messages=messages, groups=groups)
             
             await status_msg.edit_text("✅ Xử lý file chi tiết đơn đặt hàng thành công!")
         else:
             await status_msg.edit_text(f"❌ Lỗi: {result_data}")
             
     except Exception as e:
-        logger.error(f"Lỗi xử lý file đơn đặt hàng: {e}", exc_info=True)
+        logger.error("Lỗi xử lý file đơn đặt hàng: %s", e, exc_info=True)
         await status_msg.edit_text(f"❌ Lỗi: {str(e)[:100]}")
 
+async def reply_combined_report(message, result, output_file_name):
+    """Gửi báo cáo tổng hợp (kết quả combine_report_files) kèm cảnh báo thiếu cột; False nếu không có báo cáo."""
+    document = open_report_document(result)
+    if document is None:
+        return False
+    FILE_BYTES.observe(report_output_size(result), "tonghop", "out")
+    timer = StageTimer("tonghop")
+    with document as f:
+        await message.reply_document(
+            document=f,
+            filename=output_file_name,
+            caption="✅ Báo cáo tổng hợp đã sẵn sàng!"
+        )
+    timer.lap("reply")
+    
+    # Hiển thị warning nếu có missing columns
+    missing_info = result.get('missing_columns_info', [])
+    if missing_info:
+        warning_msg = "⚠️ Cảnh báo:\n" + "\n".join(missing_info)
+        await message.reply_text(warning_msg)
+    return True
+
 async def auto_combine_reports(update, context):
-    """Tự động tổng hợp 1 file hóa đơn + 1 file sổ quỹ."""
+    """Tự động tổng hợp 1 file hóa đơn + các file sổ quỹ đang chờ."""
     status_msg = await update.message.reply_text("⏳ Đang tổng hợp báo cáo...")
     
     try:
         invoice_file = context.user_data.get('invoice_file')
-        soquy_file = context.user_data.get('soquy_file')
+        soquy_files = context.user_data.get('soquy_files', [])
         
-        if not invoice_file or not soquy_file:
+        if not invoice_file or not soquy_files:
             await status_msg.edit_text("❌ Thiếu file hóa đơn hoặc sổ quỹ!")
             return
         
-        # Kiểm tra file tồn tại
-        if not os.path.exists(invoice_file) or not os.path.exists(soquy_file):
+        # Gộp file hóa đơn + tất cả file sổ quỹ (theo thứ tự gửi)
+        all_files = [invoice_file] + [pending['source'] for pending in soquy_files]
+        file_names = [context.user_data.get('invoice_name')] + [pending['file_name'] for pending in soquy_files]
+        
+        # Kiểm tra file tồn tại (chỉ với file lớn lưu trên đĩa)
+        if not all(os.path.exists(path) for path in all_files if isinstance(path, str)):
             await status_msg.edit_text("❌ File không tồn tại!")
             return
         
-        logger.info(f"Tự động tổng hợp: {os.path.basename(invoice_file)} + {os.path.basename(soquy_file)}")
+        logger.info("Tự động tổng hợp: %s", ', '.join(file_names))
         
-        # Tạo temp dir cho output
-        combine_temp_dir = tempfile.mkdtemp(prefix="combine_")
-        context.user_data['combine_tempdir'] = combine_temp_dir
+        output_file_name = f"TongHop_{datetime.now().strftime('%d%m%Y_%H%M%S')}.xlsx"
         
-        output_file_path = os.path.join(
-            combine_temp_dir,
-            f"TongHop_{datetime.now().strftime('%d%m%Y_%H%M%S')}.xlsx"
-        )
-        
-        # Gộp 2 files
-        all_files = [invoice_file, soquy_file]
+        # Xử lý (đọc song song từng file, gộp theo thứ tự); báo cáo tổng hợp nhỏ nên giữ trong bộ nhớ
+        result = await combine_report_files(all_files, None, file_names)
         
-        # Xử lý
-        result = process_multiple_invoice_files(all_files, output_file_path)
-        
-        if result and result.get('file_path'):
-            # Gửi file kết quả
-            with open(result['file_path'], 'rb') as f:
-                await update.message.reply_document(
-                    document=f,
-                    filename=os.path.basename(result['file_path']),
-                    caption="✅ Báo cáo tổng hợp đã sẵn sàng!"
-                )
-            
-            # Hiển thị warning nếu có missing columns
-            missing_info = result.get('missing_columns_info', [])
-            if missing_info:
-                warning_msg = "⚠️ Cảnh báo:\n" + "\n".join(missing_info)
-                await update.message.reply_text(warning_msg)
-            
+        if await reply_combined_report(update.message, result, output_file_name):
             await status_msg.edit_text("✅ Tổng hợp thành công!")
             
             # Cleanup
-            shutil.rmtree(combine_temp_dir)
+            cleanup_user_tempdirs(context.user_data)
             context.user_data.clear()
             
-            logger.info(f"Đã gửi file tổng hợp: {os.path.basename(result['file_path'])}")
+            logger.info("Đã gửi file tổng hợp: %s", output_file_name)
         else:
             await status_msg.edit_text("❌ Không thể tổng hợp báo cáo!")
             
     except Exception as e:
-        logger.error(f"Lỗi tổng hợp báo cáo: {e}", exc_info=True)
+        logger.error("Lỗi tổng hợp báo cáo: %s", e, exc_info=True)
+        await status_msg.edit_text(f"❌ Lỗi: {str(e)[:100]}")
+
+# Lệnh con của /kiotviet -> các loại dữ liệu cần đồng bộ
+KIOTVIET_COMMANDS = {
+    "baocao": ("invoices", "cashflow"),
+    "sanpham": ("products",),
+    "dathang": ("purchaseorders",),
+}
+
+def parse_report_date(text):
+    """Ngày dạng dd/mm/yyyy hoặc dd/mm (năm nay); None nếu không hợp lệ."""
+    for fmt in ("%d/%m/%Y", "%d/%m"):
+        try:
+            value = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%d/%m":
+            value = value.replace(year=datetime.now().year)
+        return value.date()
+    return None
+
+# Lệnh con -> tên báo cáo hiển thị
+KIOTVIET_REPORT_TITLES = {
+    "baocao": "báo cáo tổng hợp ngày {day:%d/%m/%Y}",
+    "sanpham": "danh sách sản phẩm tồn kho",
+    "dathang": "đơn đặt hàng ngày {day:%d/%m/%Y}",
+}
+
+# Báo cáo từ file export đã lưu (StoredExports): loại báo cáo -> các loại file đầu vào (file đầu tiên bắt buộc)
+STORED_REPORT_INPUTS = {
+    "baocao": ("danhsachhoadon", "soquy"),
+    "sanpham": ("danhsachsanpham",),
+    "dathang": ("danhsachchitietdathang",),
+}
+STORED_REPORT_TITLES = {
+    "baocao": "báo cáo tổng hợp (file gửi lúc {saved_at:%H:%M %d/%m})",
+    "sanpham": "danh sách sản phẩm tồn kho (file gửi lúc {saved_at:%H:%M %d/%m})",
+    "dathang": "đơn đặt hàng (file gửi lúc {saved_at:%H:%M %d/%m})",
+}
+
+class ReportError(Exception):
+    """Không dựng được báo cáo (chưa có dữ liệu, thiếu cột, lỗi xử lý...)."""
+
+def records_digest(named_readers):
+    """SHA-256 của dữ liệu đầu vào báo cáo ((tên file, RecordReader)...); cùng dữ liệu thì cùng kết quả."""
+    digest = hashlib.sha256()
+    for file_name, reader in named_readers:
+        digest.update(pickle.dumps((file_name, reader.header, reader.records), protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+async def build_report_entry(kind, sources, file_names, output_file_name):
+    """Dựng báo cáo kind (lệnh con của /kiotviet) từ sources (RecordReader hoặc file export).
+
+    Returns:
+        dict: entry cho result_cache (file_data base64 hoặc messages/groups)
+
+    Raises:
+        ProcessingJobError, ReportError
+    """
+    if kind == "baocao":
+        result = await combine_report_files(sources, None, file_names)
+        document = open_report_document(result)
+        if document is None:
+            raise ReportError("Không thể tổng hợp báo cáo!")
+        with document as f:
+            file_data = f.read()
+        FILE_BYTES.observe(len(file_data), "tonghop", "out")
+        missing_info = result.get('missing_columns_info', [])
+        entry = {
+            'file_data': base64.b64encode(file_data).decode("ascii"),
+            'file_name': output_file_name,
+            'caption': "✅ Báo cáo tổng hợp đã sẵn sàng!",
+            'messages': ["⚠️ Cảnh báo:\n" + "\n".join(missing_info)] if missing_info else [],
+        }
+    else:
+        func, render_pages, export_type = {
+            "sanpham": (process_excel_file_updated, render_product_pages, "danhsachsanpham"),
+            "dathang": (process_purchase_order_detail_file, render_purchase_order_pages, "danhsachchitietdathang"),
+        }[kind]
+        result_data = await run_processing_job(func, sources[0], export_type=export_type)
+        if not isinstance(result_data, dict):
+            raise ReportError(result_data)
+        messages, groups = render_pages(result_data)
+        entry = {'messages': messages, 'groups': groups}
+    entry['built_at'] = datetime.now().strftime("%H:%M %d/%m")
+    return entry
+
+async def cached_report(kind, trigger, cache_key, build):
+    """Entry của cache_key trong result_cache, hoặc dựng bằng build() (coroutine function) rồi lưu lại.
+
+    Returns:
+        tuple: (entry, lấy từ cache hay không)
+    """
+    outcome = "error"
+    try:
+        entry = result_cache.get(*cache_key)
+        if entry is not None:
+            outcome = "cache_hit"
+            return entry, True
+        entry = await build()
+        result_cache.put(*cache_key, **entry)
+        outcome = "built"
+        return entry, False
+    finally:
+        REPORTS_TOTAL.inc(kind, trigger, outcome)
+
+async def prepare_kiotviet_report(client, kind, day, trigger):
+    """Đồng bộ dữ liệu rồi dựng báo cáo kind (lệnh con của /kiotviet) của ngày day.
+
+    Dữ liệu không đổi so với lần dựng trước (vd: báo cáo định kỳ đã dựng sẵn) thì lấy từ result_cache.
+
+    Returns:
+        tuple: (entry: messages/groups hoặc file_data/file_id..., khóa trong result_cache, lấy từ cache hay không)
+
+    Raises:
+        KiotVietError, ProcessingJobError, ReportError
+    """
+    names = KIOTVIET_COMMANDS[kind]
+    try:
+        counts = await client.sync(names)
+    except KiotVietError:
+        REPORTS_TOTAL.inc(kind, trigger, "error")
+        raise
+    logger.info("Đồng bộ KiotViet (%s): %s", kind, counts)
+    readers = [client.reader(name, day) for name in names]
+    file_names = [client.file_name(name, day) for name in names]
+    cache_key = (f"kiotviet_{kind}", records_digest(zip(file_names, readers)))
+    entry, cached = await cached_report(
+        kind, trigger, cache_key,
+        lambda: build_report_entry(kind, readers, file_names, f"TongHop_KiotViet_{day:%d%m%Y}.xlsx"))
+    return entry, cache_key, cached
+
+async def prepare_stored_report(kind, trigger):
+    """Dựng báo cáo kind từ các file export gửi gần nhất (stored_exports).
+
+    File sản phẩm/đơn đặt hàng dùng chung khóa cache với lúc gửi file, nên file đã được
+    xử lý khi gửi thì không phải xử lý lại.
+
+    Returns:
+        tuple: (entry, khóa trong result_cache, tên báo cáo)
+
+    Raises:
+        ProcessingJobError, ReportError
+    """
+    input_kinds = STORED_REPORT_INPUTS[kind]
+    exports = [stored_exports.latest(input_kind) for input_kind in input_kinds]
+    if exports[0] is None:
+        REPORTS_TOTAL.inc(kind, trigger, "no_input")
+        raise ReportError(f"chưa có file {input_kinds[0]}_*.xlsx nào được gửi")
+    exports = [export for export in exports if export is not None]
+    main_export = exports[0]
+    if len(input_kinds) == 1:
+        cache_key = (input_kinds[0], main_export.content_hash)
+    else:
+        cache_key = (f"stored_{kind}", hashlib.sha256(
+            ",".join(export.content_hash for export in exports).encode("ascii")).hexdigest())
+    entry, _ = await cached_report(
+        kind, trigger, cache_key,
+        lambda: build_report_entry(kind, [export.path for export in exports],
+                                   [os.path.basename(export.path) for export in exports],
+                                   f"TongHop_{main_export.saved_at:%d%m%Y}.xlsx"))
+    return entry, cache_key, STORED_REPORT_TITLES[kind].format(saved_at=main_export.saved_at)
+
+async def send_report_entry(message, entry, cache_key):
+    """Gửi báo cáo đã dựng; file upload lần đầu được lưu file_id để lần sau không upload lại.
+
+    Returns:
+        entry để gửi cho các chat tiếp theo (file_data đã thay bằng file_id nếu vừa upload)
+    """
+    uploaded = await reply_cached_result(message, entry)
+    if uploaded is not None and uploaded.document:
+        entry = {key: entry[key] for key in ('file_name', 'caption', 'messages', 'groups', 'built_at') if key in entry}
+        entry['file_id'] = uploaded.document.file_id
+        result_cache.put(*cache_key, **entry)
+    return entry
+
+@restricted
+@scheduled
+async def kiotviet_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler cho lệnh /kiotviet [baocao|sanpham|dathang] [dd/mm/yyyy]: lấy dữ liệu thẳng từ KiotViet API."""
+    if kiotviet_client is None:
+        await update.message.reply_text(
+            "❌ Chưa cấu hình KiotViet API (KIOTVIET_CLIENT_ID, KIOTVIET_CLIENT_SECRET, KIOTVIET_RETAILER)."
+        )
+        return
+
+    args = [arg.lower() for arg in context.args or []]
+    kind = args.pop(0) if args and args[0] in KIOTVIET_COMMANDS else "baocao"
+    day = parse_report_date(args[0]) if args else datetime.now().date()
+    if day is None or len(args) > 1:
+        await update.message.reply_text(
+            "❌ Cú pháp: /kiotviet [baocao|sanpham|dathang] [dd/mm/yyyy]\n"
+            "• baocao: báo cáo tổng hợp hóa đơn + sổ quỹ trong ngày (mặc định hôm nay)\n"
+            "• sanpham: danh sách sản phẩm tồn kho ≠ 0\n"
+            "• dathang: chi tiết đơn đặt hàng nhập trong ngày, theo nhà cung cấp"
+        )
+        return
+
+    status_msg = await update.message.reply_text("⏳ Đang lấy dữ liệu từ KiotViet...")
+    try:
+        entry, cache_key, cached = await prepare_kiotviet_report(kiotviet_client, kind, day, "command")
+    except KiotVietError as e:
+        logger.error("Lỗi đồng bộ KiotViet: %s", e)
+        await status_msg.edit_text(f"❌ Không lấy được dữ liệu KiotViet: {str(e)[:200]}")
+        return
+    except (ProcessingJobError, ReportError) as e:
+        logger.error("Lỗi dựng báo cáo KiotViet (%s): %s", kind, e)
         await status_msg.edit_text(f"❌ Lỗi: {str(e)[:100]}")
+        return
+
+    # Báo cáo định kỳ đã dựng sẵn với cùng dữ liệu → gửi ngay
+    note = f" (dựng sẵn lúc {entry['built_at']})" if cached and entry.get('built_at') else ""
+    await status_msg.edit_text(f"✅ Đã lấy {KIOTVIET_REPORT_TITLES[kind].format(day=day)} từ KiotViet{note}")
+    try:
+        await send_report_entry(update.message, entry, cache_key)
+    except Exception as e:
+        logger.error("Lỗi gửi báo cáo KiotViet (%s): %s", kind, e, exc_info=True)
+        await update.message.reply_text(f"❌ Lỗi: {str(e)[:100]}")
+
+# ============================================================================
+# SCHEDULED REPORTS (dựng sẵn báo cáo qua job queue, gửi cho các chat đã đăng ký)
+# ============================================================================
+
+# Khóa trong job_scheduler: báo cáo định kỳ chạy lần lượt và chiếm một slot như job của user
+SCHEDULED_REPORTS_JOB_KEY = "scheduled_reports"
+
+class ReportSubscribers:
+    """Các chat nhận báo cáo định kỳ, lưu thành file JSON (ghi file tạm rồi đổi tên)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._chat_ids = None
+
+    def _load(self):
+        if self._chat_ids is None:
+            self._chat_ids = set()
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._chat_ids = {int(chat_id) for chat_id in json.load(f)}
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("Không đọc được danh sách đăng ký báo cáo %s: %s", self.path, e)
+        return self._chat_ids
+
+    def __iter__(self):
+        return iter(sorted(self._load()))
+
+    def __contains__(self, chat_id):
+        return chat_id in self._load()
+
+    def add(self, chat_id):
+        self._load().add(chat_id)
+        self._save()
+
+    def remove(self, chat_id):
+        self._load().discard(chat_id)
+        self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(self._chat_ids), f)
+        os.replace(temp_path, self.path)
+
+report_subscribers = ReportSubscribers(REPORT_SUBSCRIBERS_PATH)
+
+class ChatTarget:
+    """Gửi tới một chat qua bot với giao diện như Message (chat_id, reply_text, reply_document),
+    để dùng lại send_message_chunks/reply_cached_result khi không có tin nhắn nào để trả lời."""
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def reply_document(self, document, **kwargs):
+        return await self.bot.send_document(self.chat_id, document, **kwargs)
+
+def scheduled_report_day(now=None):
+    """Ngày của báo cáo định kỳ: chạy trước 12:00 thì là ngày hôm trước."""
+    now = now or datetime.now()
+    return (now - timedelta(days=1)).date() if now.hour < 12 else now.date()
+
+def describe_report_schedule():
+    return "\n".join(f"• {report_time:%H:%M}: {', '.join(kinds)}"
+                     for report_time, kinds in sorted(REPORT_SCHEDULE.items()))
+
+async def prepare_scheduled_report(kind, day):
+    """Dựng báo cáo định kỳ từ KiotViet API (nếu đã cấu hình) hoặc từ file export gửi gần nhất.
+
+    Returns:
+        tuple: (entry, khóa trong result_cache, tên báo cáo)
+    """
+    if kiotviet_client is None:
+        return await prepare_stored_report(kind, "schedule")
+    entry, cache_key, _ = await prepare_kiotviet_report(kiotviet_client, kind, day, "schedule")
+    return entry, cache_key, KIOTVIET_REPORT_TITLES[kind].format(day=day)
+
+async def run_scheduled_reports(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job của job queue: dựng các báo cáo trong context.job.data và gửi cho các chat đã đăng ký."""
+    kinds = context.job.data
+    day = scheduled_report_day()
+
+    async def build_and_push():
+        for kind in kinds:
+            try:
+                entry, cache_key, title = await prepare_scheduled_report(kind, day)
+            except (KiotVietError, ProcessingJobError, ReportError) as e:
+                logger.error("Không dựng được báo cáo định kỳ %s: %s", kind, e)
+                continue
+
+            sent = 0
+            for chat_id in list(report_subscribers):
+                target = ChatTarget(context.bot, chat_id)
+                try:
+                    await send_message_chunks(target, [f"🗓 Báo cáo định kỳ: {title}"])
+                    entry = await send_report_entry(target, entry, cache_key)
+                    sent += 1
+                except Forbidden as e:
+                    # User đã chặn bot hoặc bot bị xóa khỏi nhóm
+                    logger.warning("Hủy đăng ký báo cáo định kỳ của chat %s: %s", chat_id, e)
+                    report_subscribers.remove(chat_id)
+                except TelegramError as e:
+                    logger.error("Không gửi được báo cáo định kỳ %s cho chat %s: %s", kind, chat_id, e)
+            logger.info("Báo cáo định kỳ %s: đã dựng sẵn, gửi cho %s chat", title, sent)
+
+    try:
+        await job_scheduler.run(SCHEDULED_REPORTS_JOB_KEY, build_and_push)
+    except QueueFullError as e:
+        logger.warning("Bỏ qua báo cáo định kỳ %s: %s", ", ".join(kinds), e)
+
+def schedule_reports(application):
+    """Đăng ký các báo cáo định kỳ (REPORT_SCHEDULE) vào job queue của application."""
+    for warning in REPORT_SCHEDULE_WARNINGS:
+        logger.warning("Báo cáo định kỳ: %s", warning)
+    if not REPORT_SCHEDULE:
+        return
+    if application.job_queue is None:
+        logger.error('Báo cáo định kỳ cần job queue: pip install "python-telegram-bot[job-queue]"')
+        return
+    for report_time, kinds in sorted(REPORT_SCHEDULE.items()):
+        application.job_queue.run_daily(run_scheduled_reports, report_time, data=kinds,
+                                        name=f"baocao_{report_time:%H%M}")
+    source = "KiotViet API" if kiotviet_client is not None else f"file export gửi gần nhất ({stored_exports.store_dir})"
+    logger.info("Báo cáo định kỳ (dữ liệu: %s):\n%s", source, describe_report_schedule())
+
+@restricted
+async def dangky_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler cho lệnh /dangky: nhận báo cáo định kỳ trong chat này."""
+    if not REPORT_SCHEDULE:
+        await update.message.reply_text("❌ Chưa bật báo cáo định kỳ (AUTO_REPORTS_ENABLED, REPORT_SCHEDULES).")
+        return
+    report_subscribers.add(update.effective_chat.id)
+    await update.message.reply_text(
+        f"✅ Đã đăng ký nhận báo cáo định kỳ:\n{describe_report_schedule()}\n\nHủy bằng /huydangky"
+    )
+
+@restricted
+async def huydangky_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler cho lệnh /huydangky: ngừng nhận báo cáo định kỳ trong chat này."""
+    if update.effective_chat.id not in report_subscribers:
+        await update.message.reply_text("ℹ️ Chat này chưa đăng ký nhận báo cáo định kỳ.")
+        return
+    report_subscribers.remove(update.effective_chat.id)
+    await update.message.reply_text("✅ Đã hủy nhận báo cáo định kỳ.")
+
+async def on_startup(application):
+    """Chạy sau khi application khởi tạo: nạp template báo cáo, bảng lương, chuẩn bị process pool và endpoint metrics."""
+    try:
+        get_report_template()
+    except Exception as e:
+        logger.error("Không thể nạp template báo cáo: %s", e)
+    try:
+        get_payroll_document()
+    except Exception as e:
+        logger.error("Không thể decode bảng lương (BANGLUONG): %s", e)
+    get_process_pool()
+    start_metrics_server()
+
+async def on_shutdown(application):
+    """Chạy khi bot dừng: giải phóng process pool, đóng kết nối KiotViet và dừng endpoint metrics."""
+    kill_retired_process_pools()
+    shutdown_process_pool()
+    if kiotviet_client is not None:
+        await kiotviet_client.close()
+    stop_metrics_server()
 
 def bot_main():
     """Khởi động bot."""
@@ -1385,13 +5083,37 @@ def bot_main():
         return
     
     # Tạo application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        # Xử lý update song song; thứ tự và giới hạn theo user do job_scheduler đảm nhận
+        .concurrent_updates(True)
+        # Pool kết nối + gửi lại khi lỗi mạng cho get_file, tải file, gửi/sửa tin nhắn...
+        .request(create_bot_request())
+        .get_updates_request(create_bot_request(pool_size=1, retrying=False))
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+        logger.info("Dùng Bot API tại %s", TELEGRAM_BASE_URL)
+    application = builder.build()
     
     # Đăng ký handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("tinhluong", tinhluong_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("kiotviet", kiotviet_command))
+    application.add_handler(CommandHandler("dangky", dangky_command))
+    application.add_handler(CommandHandler("huydangky", huydangky_command))
+    
+    # Báo cáo định kỳ (REPORT_SCHEDULES/SCHEDULE_DETAIL) chạy trên job queue của application
+    schedule_reports(application)
+    
+    # Handler cho nút chuyển trang kết quả
+    application.add_handler(CallbackQueryHandler(restricted(handle_page_callback), pattern=r"^pg:"))
     
     # Handler cho file Excel
     application.add_handler(MessageHandler(
@@ -1400,8 +5122,24 @@ def bot_main():
     ))
     
     # Khởi động bot
-    logger.info("🤖 Bot đang khởi động...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Khi dừng (SIGINT/SIGTERM), PTB ngừng nhận update trước rồi chờ các update đang
+    # xử lý/đang chờ trong job_scheduler chạy xong; process pool tắt sau cùng (on_shutdown)
+    if BOT_MODE == "webhook":
+        logger.info("🤖 Bot đang khởi động (webhook %s/%s, lắng nghe %s:%s)...",
+                    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            cert=WEBHOOK_CERT or None,
+            key=WEBHOOK_KEY or None,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        logger.info("🤖 Bot đang khởi động...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 # ============================================================================
 # MAIN ENTRY POINT (từ main.py)
@@ -1424,15 +5162,12 @@ def main():
         logger.info("\n⏹️  Bot đã dừng (Ctrl+C)")
         sys.exit(0)
     except Exception as e:
-        logger.error(f"❌ Lỗi khi khởi động bot: {e}", exc_info=True)
+        logger.error("❌ Lỗi khi khởi động bot: %s", e, exc_info=True)
         sys.exit(1)
 
 if __name__ == "__main__":
-    # Thiết lập logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    # Thiết lập logging (LOG_LEVEL, LOG_LEVELS, LOG_TO_FILE)
+    setup_logging()
     
     main()
 